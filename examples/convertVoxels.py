@@ -0,0 +1,18 @@
+import sys, argparse
+
+from tk3dv.nocstools import voxelshards
+
+# Converts a directory tree of binvox/npy/npz voxel grids into bit-packed shards that can be opened with voxelshards.VoxelShards
+# (or examples/visualizeVG.py --shard-dir). Re-running with the same output directory resumes an interrupted conversion
+
+if __name__ == '__main__':
+    Parser = argparse.ArgumentParser(description='Convert voxel grids to bit-packed shards.', fromfile_prefix_chars='@')
+    Parser.add_argument('-i', '--input-dir', help='Directory to search for binvox, npy and npz files.', required=True)
+    Parser.add_argument('-o', '--output-dir', help='Directory to write shards to.', required=True)
+    Parser.add_argument('-s', '--shard-size', help='Number of grids per shard.', default=1000, type=int)
+    Parser.add_argument('-n', '--num-workers', help='Number of worker processes. Defaults to the number of CPUs.', default=None, type=int)
+    Parser.add_argument('--npz-key', help='Array to read from npz files.', default=voxelshards.NPZ_KEY)
+    Args = Parser.parse_args()
+
+    _, Failed = voxelshards.convertVoxels(Args.input_dir, Args.output_dir, ShardSize=Args.shard_size, nWorkers=Args.num_workers, NPZKey=Args.npz_key)
+    sys.exit(1 if len(Failed) > 0 else 0)
@@ -4,8 +4,8 @@ from tk3dv.common import drawing
 from PyQt5.QtWidgets import QApplication
 
 from tk3dv.pyEasel import *
-from EaselModule import EaselModule
-from Easel import Easel
+from tk3dv.pyEasel.EaselModule import EaselModule
+from tk3dv.pyEasel.Easel import Easel
 from PyQt5.QtGui import QKeyEvent, QMouseEvent, QWheelEvent
 import OpenGL.GL as gl
 
@@ -43,9 +43,9 @@ class ModelNOCVizModule(EaselModule):
             self.Models.append(datastructures.PointSet3D())
             if self.Args.normalize == True:
                 print('[ INFO ]: Normalizing models to lie within NOCS.')
-                self.OBJLoaders.append(obj_loader.Loader(m, isNormalize=True))
+                self.OBJLoaders.append(obj_loader.Loader(m, isNormalize=True, isIndexed=True))
             else:
-                self.OBJLoaders.append(obj_loader.Loader(m, isNormalize=False))
+                self.OBJLoaders.append(obj_loader.Loader(m, isNormalize=False, isIndexed=True))
             if len(self.OBJLoaders[-1].vertices) > 0:
                 self.Models[-1].Points = np.array(self.OBJLoaders[-1].vertices)
             if len(self.OBJLoaders[-1].vertcolors) > 0:
@@ -4,8 +4,8 @@ from tk3dv.common import drawing
 from PyQt5.QtWidgets import QApplication
 
 from tk3dv.pyEasel import *
-from EaselModule import EaselModule
-from Easel import Easel
+from tk3dv.pyEasel.EaselModule import EaselModule
+from tk3dv.pyEasel.Easel import Easel
 from PyQt5.QtGui import QKeyEvent, QMouseEvent, QWheelEvent
 import OpenGL.GL as gl
 
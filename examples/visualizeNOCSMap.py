@@ -5,16 +5,16 @@ from PyQt5.QtWidgets import QApplication
 import PyQt5.QtCore as QtCore
 from PyQt5.QtGui import QKeyEvent, QMouseEvent, QWheelEvent
 
-from EaselModule import EaselModule
-from Easel import Easel
+from tk3dv.pyEasel.EaselModule import EaselModule
+from tk3dv.pyEasel.Easel import Easel
 import numpy as np
 import OpenGL.GL as gl
 from tk3dv.nocstools import datastructures as ds
-from tk3dv.nocstools import obj_loader
+from tk3dv.nocstools import obj_loader, loading
 
 from palettable.tableau import Tableau_20, BlueRed_12, ColorBlind_10, GreenOrange_12
 from palettable.cartocolors.diverging import Earth_2
-import calibration
+from tk3dv.nocstools import calibration
 from tk3dv.common import drawing, utilities
 from tk3dv.extern import quaternions
 
@@ -35,6 +35,7 @@ class NOCSMapModule(EaselModule):
                               help='Specify OBJ models to load additionally. * globbing is supported.',
                               required=False)
         ArgGroup.add_argument('--num-points', help='Specify the number of pixels to use for camera pose registration.', default=1000, type=int, required=False)
+        ArgGroup.add_argument('--num-workers', help='Specify the number of processes used to load NOCS maps. Defaults to the number of CPUs.', default=None, type=int, required=False)
         ArgGroup.add_argument('--error-viz', help='Specify error wrto Nth NOCS map. If multiple NOCS maps are provided. Will compute the L2 errors between the Nth NOCS map and the rest. Will render this instead of RGB or colors.', default=-1, type=int, required=False)
 
         ArgGroup.add_argument('--est-pose', help='Choose to estimate pose.', action='store_true')
@@ -100,8 +101,12 @@ class NOCSMapModule(EaselModule):
 
 
         if self.isVizError == True:
+            Reference = self.NOCSMaps[self.ErrorReferenceNM].astype(np.float32)
             for i in range(0, len(self.NOCSMaps)):
-                DM = self.NOCSMaps[i].astype(np.float)-self.NOCSMaps[self.ErrorReferenceNM].astype(np.float) # Convert to float
+                if self.NOCSMaps[i].shape != Reference.shape:
+                    print('[ WARN ]: NOCS map {} has a different size than the reference, skipping error computation.'.format(i))
+                    continue
+                DM = self.NOCSMaps[i].astype(np.float32) - Reference
                 Norm = np.linalg.norm(DM, axis=2)
                 Frac = 10
                 NormFact = (441.6729 / Frac) / 255 # Maximum possible error in NOCS is 441.6729 == sqrt(3 * 255^2). Let's take a fraction of that
@@ -109,7 +114,7 @@ class NOCSMapModule(EaselModule):
                 Norm = Norm.astype(np.uint8)
                 NormCol = cv2.applyColorMap(Norm, cv2.COLORMAP_JET)
                 #cv2.imwrite('norm_{}.png'.format(str(i).zfill(3)), NormCol)
-                self.NOCS[i] = ds.NOCSMap(self.NOCSMaps[i], RGB=cv2.cvtColor(NormCol, cv2.COLOR_BGR2RGB))# IMPORTANT: OpenCV loads as BGR, so convert to RGB
+                self.NOCS[i].updateColors(cv2.cvtColor(NormCol, cv2.COLOR_BGR2RGB)) # Points and connectivity are unchanged. IMPORTANT: OpenCV loads as BGR, so convert to RGB
 
     @staticmethod
     def estimateCameraPoseFromNM(NOCSMap, NOCS, N=None, Intrinsics=None):
@@ -221,49 +226,16 @@ class NOCSMapModule(EaselModule):
         if self.Args.poses is not None:
             PoseFiles = self.getFileNames(self.Args.poses)
 
-        for (NMF, CF, PF) in zip(NMFiles, ColorFiles, PoseFiles):
-            NOCSMap = cv2.imread(NMF, -1)
-            NOCSMap = NOCSMap[:, :, :3] # Ignore alpha if present
-            NOCSMap = cv2.cvtColor(NOCSMap, cv2.COLOR_BGR2RGB) # IMPORTANT: OpenCV loads as BGR, so convert to RGB
-            if self.Intrinsics is None:
-                self.ImageSize = (NOCSMap.shape[1], NOCSMap.shape[0])
-            else:
-                NOCSMap = self.resizeAndPad(NOCSMap)
-            CFIm = None
-            if CF is not None:
-                CFIm = cv2.imread(CF)
-                CFIm = cv2.cvtColor(CFIm, cv2.COLOR_BGR2RGB) # IMPORTANT: OpenCV loads as BGR, so convert to RGB
-                if CFIm.shape != NOCSMap.shape: # Re-size only if not the same size as NOCSMap
-                    CFIm = cv2.resize(CFIm, (NOCSMap.shape[1], NOCSMap.shape[0]), interpolation=cv2.INTER_CUBIC) # Ok to use cubic interpolation for RGB
-            NOCS = ds.NOCSMap(NOCSMap, RGB=CFIm)
-            self.NOCSMaps.append(NOCSMap)
-            self.NOCS.append(NOCS)
-
-            if self.Args.est_pose == True:
-                _, K, R, C, Flip = self.estimateCameraPoseFromNM(NOCSMap, NOCS, N=self.Args.num_points, Intrinsics=self.Intrinsics) # The rotation and translation are about the NOCS origin
-                self.CamIntrinsics.append(K)
-                self.CamRots.append(R)
-                self.CamPos.append(C)
-                self.CamFlip.append(Flip)
-                self.Cameras.append(ds.Camera(ds.CameraExtrinsics(self.CamRots[-1], self.CamPos[-1]), ds.CameraIntrinsics(self.CamIntrinsics[-1])))
-
-            if PF is not None:
-                with open(PF) as f:
-                    data = json.load(f)
-                    # Loading convention: Flip sign of x postiion, flip signs of quaternion z, w
-                    P = np.array([data['position']['x'], data['position']['y'], data['position']['z']]) / self.Args.pose_scale
-                    Quat = np.array([data['rotation']['w'], data['rotation']['x'], data['rotation']['y'], data['rotation']['z']]) # NOTE: order is w, x, y, z
-                    # Cajole transforms to work
-                    P[0] *= -1
-                    P += 0.5
-                    Quat = np.array([Quat[0], Quat[1], -Quat[2], -Quat[3]])
-
-                    self.PosesPos.append(P)
-                    R = quaternions.quat2mat(Quat).T
-                    self.PosesRots.append(R)
-            else:
-                self.PosesPos.append(None)
-                self.PosesRots.append(None)
+        ColorFiles = ColorFiles[:len(NMFiles)] + [None] * (len(NMFiles) - len(ColorFiles))
+        PoseFiles = PoseFiles[:len(NMFiles)] + [None] * (len(NMFiles) - len(PoseFiles))
+        # NOCS maps are decoded and meshed in parallel. VBOs are created when they are first drawn
+        with loading.NOCSMapLoader(nWorkers=self.Args.num_workers) as Loader:
+            for (NOCSMap, NOCS), PF in zip(Loader.load(NMFiles, ColorFiles, ImageSize=self.ImageSize), PoseFiles):
+                self.NOCSMaps.append(NOCSMap)
+                self.NOCS.append(NOCS)
+                self.loadPose(NOCSMap, NOCS, PF)
+            Loader.printTimings()
+        sys.stdout.flush()
 
         self.nNM = len(NMFiles)
         self.activeNMIdx = self.nNM # len(NMFiles) will show all
@@ -271,7 +243,34 @@ class NOCSMapModule(EaselModule):
         # Load OBJ models
         ModelFiles = self.getFileNames(self.Args.models)
         for MF in ModelFiles:
-            self.OBJModels.append(obj_loader.Loader(MF, isNormalize=True))
+            self.OBJModels.append(obj_loader.Loader(MF, isNormalize=True, isIndexed=True))
+
+    def loadPose(self, NOCSMap, NOCS, PF):
+        if self.Args.est_pose == True:
+            _, K, R, C, Flip = self.estimateCameraPoseFromNM(NOCSMap, NOCS, N=self.Args.num_points, Intrinsics=self.Intrinsics) # The rotation and translation are about the NOCS origin
+            self.CamIntrinsics.append(K)
+            self.CamRots.append(R)
+            self.CamPos.append(C)
+            self.CamFlip.append(Flip)
+            self.Cameras.append(ds.Camera(ds.CameraExtrinsics(self.CamRots[-1], self.CamPos[-1]), ds.CameraIntrinsics(self.CamIntrinsics[-1])))
+
+        if PF is not None:
+            with open(PF) as f:
+                data = json.load(f)
+                # Loading convention: Flip sign of x postiion, flip signs of quaternion z, w
+                P = np.array([data['position']['x'], data['position']['y'], data['position']['z']]) / self.Args.pose_scale
+                Quat = np.array([data['rotation']['w'], data['rotation']['x'], data['rotation']['y'], data['rotation']['z']]) # NOTE: order is w, x, y, z
+                # Cajole transforms to work
+                P[0] *= -1
+                P += 0.5
+                Quat = np.array([Quat[0], Quat[1], -Quat[2], -Quat[3]])
+
+                self.PosesPos.append(P)
+                R = quaternions.quat2mat(Quat).T
+                self.PosesRots.append(R)
+        else:
+            self.PosesPos.append(None)
+            self.PosesRots.append(None)
 
     def step(self):
         pass
@@ -5,14 +5,15 @@ from OpenGL.GL.SUN import vertex
 from tk3dv.extern.binvox import binvox_rw
 from tk3dv.common import drawing
 import tk3dv.nocstools.datastructures as ds
+from tk3dv.nocstools import voxelshards
 from PyQt5.QtWidgets import QApplication
 import PyQt5.QtCore as QtCore
 from PyQt5.QtGui import QKeyEvent, QMouseEvent, QWheelEvent
 import numpy as np
 
 from tk3dv.pyEasel import *
-from EaselModule import EaselModule
-from Easel import Easel
+from tk3dv.pyEasel.EaselModule import EaselModule
+from tk3dv.pyEasel.Easel import Easel
 import OpenGL.GL as gl
 
 class VGVizModule(EaselModule):
@@ -22,7 +23,11 @@ class VGVizModule(EaselModule):
     def init(self, argv=None):
         self.Parser = argparse.ArgumentParser(description='This module visualizes voxel grids.', fromfile_prefix_chars='@')
         ArgGroup = self.Parser.add_argument_group()
-        ArgGroup.add_argument('-v', '--voxel-grid', help='Specify binvox or numpy file.', required=True)
+        ArgGroup.add_argument('-v', '--voxel-grid', help='Specify binvox or numpy file, or a grid name with --shard-dir.', required=True)
+        ArgGroup.add_argument('--shard-dir', help='Read the grid from shards written by examples/convertVoxels.py.', default=None)
+        ArgGroup.add_argument('--surface-only', help='Only mesh voxel faces that are visible (between filled and empty voxels).', action='store_true')
+        ArgGroup.add_argument('--greedy-merge', help='Merge coplanar visible voxel faces into larger quads. Implies --surface-only.', action='store_true')
+        self.Parser.set_defaults(surface_only=False, greedy_merge=False)
 
         self.Args, _ = self.Parser.parse_known_args(argv)
         if len(sys.argv) <= 1:
@@ -30,20 +35,25 @@ class VGVizModule(EaselModule):
             exit()
 
         _, Ext = os.path.splitext(self.Args.voxel_grid)
-        if 'binvox' not in Ext and 'npz' not in Ext and 'npy' not in Ext:
+        if self.Args.shard_dir is None and 'binvox' not in Ext and 'npz' not in Ext and 'npy' not in Ext:
             raise RuntimeError('Not a binvox or numpy file')
 
-        print('[ INFO ]: Opening voxel grid from file:', self.Args.voxel_grid)
-        if 'binvox' in Ext:
+        if self.Args.shard_dir is not None:
+            print('[ INFO ]: Opening voxel grid {} from shards in {}'.format(self.Args.voxel_grid, self.Args.shard_dir))
+            self.VG = voxelshards.VoxelShards(self.Args.shard_dir)[self.Args.voxel_grid]
+            self.VGDS = ds.VoxelGrid(self.VG, isSurfaceOnly=self.Args.surface_only, isGreedyMerge=self.Args.greedy_merge)
+        elif 'binvox' in Ext:
+            print('[ INFO ]: Opening voxel grid from file:', self.Args.voxel_grid)
             with open(self.Args.voxel_grid, 'rb') as f:
                 self.VG = binvox_rw.read_as_3d_array(f)
 
-            self.VGDS = ds.VoxelGrid(self.VG)
+            self.VGDS = ds.VoxelGrid(self.VG, isSurfaceOnly=self.Args.surface_only, isGreedyMerge=self.Args.greedy_merge)
         else:
+            print('[ INFO ]: Opening voxel grid from file:', self.Args.voxel_grid)
             VGData = np.load(self.Args.voxel_grid)
             # print(VGData.files) # 'full_voxel_grid', 'surface_voxel_grid'
             self.VG = VGData['surface_voxel_grid']
-            self.VGDS = ds.VoxelGrid(self.VG)
+            self.VGDS = ds.VoxelGrid(self.VG, isSurfaceOnly=self.Args.surface_only, isGreedyMerge=self.Args.greedy_merge)
 
         self.PointSize = 3
         self.showObjIdx = 0 # 0, 1, 2
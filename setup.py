@@ -17,7 +17,7 @@ DESCRIPTION = 'The Toolkit for 3D Vision (tk3dv) is a collection of tools for de
 URL = 'https://github.com/drsrinathsridhar/tk3dv'
 EMAIL = 'ssrinath@cs.stanford.edu'
 AUTHOR = 'Srinath Sridhar'
-REQUIRES_PYTHON = '>=3.6.0'
+REQUIRES_PYTHON = '>=3.7.0'
 VERSION = '0.1'
 
 # What packages are required for this module to be executed?
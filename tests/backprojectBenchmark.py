@@ -0,0 +1,53 @@
+import time, argparse
+import numpy as np
+
+from tk3dv.common import utilities
+
+# Compares the old per-call pixel grid backprojection with the cached Backprojector on a depth stream
+
+def backprojectLegacy(DepthImage, Intrinsics):
+    IntrinsicsInv = np.linalg.inv(Intrinsics)
+    idxs = np.where(DepthImage >= 0)
+    grid = np.array([idxs[1], idxs[0]])
+    uv_grid = np.concatenate((grid, np.ones([1, grid.shape[1]])), axis=0)
+    xyz = np.transpose(IntrinsicsInv @ uv_grid)
+    z = DepthImage[idxs[0], idxs[1]]
+    pts = xyz * z[:, np.newaxis] / xyz[:, -1:]
+    pts[:, 0] = -pts[:, 0]
+    pts[:, 1] = -pts[:, 1]
+    return pts
+
+if __name__ == '__main__':
+    Parser = argparse.ArgumentParser(description='Benchmark depth image backprojection.')
+    Parser.add_argument('--width', default=640, type=int)
+    Parser.add_argument('--height', default=480, type=int)
+    Parser.add_argument('-n', '--num-frames', help='Number of frames to backproject.', default=60, type=int)
+    Parser.add_argument('--invalid', help='Fraction of pixels with zero depth.', default=0.3, type=float)
+    Args = Parser.parse_args()
+
+    K = np.array([[571.0, 0, Args.width / 2 - 0.5], [0, 571.0, Args.height / 2 - 0.5], [0, 0, 1]])
+    Depths = np.random.randint(500, 4000, size=(Args.num_frames, Args.height, Args.width)).astype(np.uint16)
+    Depths[np.random.uniform(size=Depths.shape) < Args.invalid] = 0
+
+    # Sanity check: valid points agree with the old implementation
+    Ref = backprojectLegacy(Depths[0], K)[Depths[0].reshape(-1) > 0]
+    assert np.allclose(Ref, utilities.backproject(Depths[0], K))
+
+    Tic = time.perf_counter()
+    for D in Depths:
+        backprojectLegacy(D, K)
+    Legacy = (time.perf_counter() - Tic) / Args.num_frames
+
+    Tic = time.perf_counter()
+    for D in Depths:
+        utilities.backproject(D, K)
+    Cached = (time.perf_counter() - Tic) / Args.num_frames
+
+    Tic = time.perf_counter()
+    utilities.backprojectBatch(Depths, K)
+    Batched = (time.perf_counter() - Tic) / Args.num_frames
+
+    print('[ INFO ]: {}x{} depth, {} frames, {:.0f}% invalid pixels.'.format(Args.width, Args.height, Args.num_frames, Args.invalid * 100))
+    print('\tPer-call grid (before): {:8.3f} ms/frame'.format(Legacy * 1e3))
+    print('\tCached rays:            {:8.3f} ms/frame'.format(Cached * 1e3))
+    print('\tCached rays, batched:   {:8.3f} ms/frame'.format(Batched * 1e3))
@@ -0,0 +1,133 @@
+import io, os, sys, time, argparse, tempfile, tracemalloc
+import numpy as np
+
+from tk3dv.extern.binvox import binvox_rw
+
+# Compares the binvox RLE writer before (Python loop over voxels) with the vectorized dense and sparse writers
+# Every output is read back and checked against the input grid
+# Readers are compared in time and peak memory (numpy allocations are tracked by tracemalloc): dense, coordinates before
+# (Python loop over runs), vectorized coordinates and linear indices, and packed bits
+# Finally --num-grids packed grids are written to one memory-mapped file and queried without loading them
+
+def writeLoop(Model, fp):
+    # Writer before vectorization, with bytes instead of chr() so it runs on Python 3
+    fp.write(b'#binvox 1\ndim ' + ' '.join(map(str, Model.dims)).encode() + b'\ntranslate ' + ' '.join(map(str, Model.translate)).encode()
+             + b'\nscale ' + str(Model.scale).encode() + b'\ndata\n')
+    VoxelsFlat = np.transpose(Model.data, (0, 2, 1)).flatten()
+    State, Ctr = VoxelsFlat[0], 0
+    for c in VoxelsFlat:
+        if c == State:
+            Ctr += 1
+            if Ctr == 255:
+                fp.write(bytes([int(State), Ctr]))
+                Ctr = 0
+        else:
+            fp.write(bytes([int(State), Ctr]))
+            State, Ctr = c, 1
+    if Ctr > 0:
+        fp.write(bytes([int(State), Ctr]))
+
+def readCoordsLoop(fp):
+    # Coordinate reader before vectorization, with floor division so coordinates are integers
+    Dims, Translate, Scale = binvox_rw.read_header(fp)
+    RawData = np.frombuffer(fp.read(), dtype=np.uint8)
+    Values, Counts = RawData[::2], RawData[1::2]
+    EndIndices = np.cumsum(Counts, dtype=np.int64)
+    Indices = np.concatenate(([0], EndIndices[:-1]))
+    NZVoxels = []
+    for Index, EndIndex in zip(Indices[Values > 0], EndIndices[Values > 0]):
+        NZVoxels.extend(range(Index, EndIndex))
+    NZVoxels = np.array(NZVoxels)
+    return binvox_rw.linear_index_to_coords(NZVoxels, Dims)
+
+def measureRead(ReadFunc, Buffer, nRepeats):
+    tracemalloc.start()
+    Tic = time.perf_counter()
+    for i in range(nRepeats):
+        Data = ReadFunc(io.BytesIO(Buffer))
+    Time = (time.perf_counter() - Tic) / nRepeats
+    Peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return Time, Peak / 2**20, Data
+
+def createSphereShell(Dim, Thickness=2):
+    # Hollow sphere, a typical sparse voxelized surface
+    Coords = np.indices((Dim, Dim, Dim), dtype=np.float32) - (Dim - 1) / 2
+    Radius = np.sqrt((Coords**2).sum(axis=0))
+    return np.abs(Radius - Dim / 3) < Thickness / 2
+
+def measure(WriteFunc, Model, nRepeats):
+    Tic = time.perf_counter()
+    for i in range(nRepeats):
+        Buffer = io.BytesIO()
+        WriteFunc(Model, Buffer)
+    return (time.perf_counter() - Tic) / nRepeats, Buffer.getvalue()
+
+def isSame(Buffer, Dense):
+    return np.array_equal(binvox_rw.read_as_3d_array(io.BytesIO(Buffer)).data, Dense)
+
+if __name__ == '__main__':
+    Parser = argparse.ArgumentParser(description='Benchmark binvox writers.')
+    Parser.add_argument('-d', '--dims', help='Grid sizes.', nargs='+', default=[64, 128, 256], type=int)
+    Parser.add_argument('-r', '--repeats', help='Number of runs to average over.', default=3, type=int)
+    Parser.add_argument('-g', '--num-grids', help='Number of grids in the memory-mapped file.', default=32, type=int)
+    Parser.add_argument('-q', '--num-queries', help='Number of occupancy queries per memory-mapped grid.', default=10000, type=int)
+    Parser.add_argument('--max-loop', help='Largest grid size to run the Python loop writer with.', default=128, type=int)
+    Args = Parser.parse_args()
+
+    for Dim in Args.dims:
+        Dense = createSphereShell(Dim)
+        DenseModel = binvox_rw.Voxels(Dense, [Dim] * 3, [0.0] * 3, 1.0, 'xyz')
+        SparseModel = binvox_rw.Voxels(binvox_rw.dense_to_sparse(Dense), [Dim] * 3, [0.0] * 3, 1.0, 'xyz')
+        print('[ INFO ]: Grid {}^3, {} occupied voxels.'.format(Dim, Dense.sum()))
+        if Dim <= Args.max_loop:
+            Time, Buffer = measure(writeLoop, DenseModel, 1)
+            print('\tloop:   {:10.2f} ms, correct: {}'.format(Time * 1e3, isSame(Buffer, Dense)))
+        else:
+            print('\tloop:   skipped, grid larger than --max-loop')
+        for Name, Model in [('dense', DenseModel), ('sparse', SparseModel)]:
+            Time, Buffer = measure(binvox_rw.write, Model, Args.repeats)
+            print('\t{:7s} {:10.2f} ms, correct: {}, {} bytes'.format(Name + ':', Time * 1e3, isSame(Buffer, Dense), len(Buffer)))
+
+        Readers = [('read dense', lambda fp: binvox_rw.read_as_3d_array(fp).data)
+                   , ('read coords loop', readCoordsLoop)
+                   , ('read coords', lambda fp: binvox_rw.read_as_coord_array(fp).data)
+                   , ('read linear', lambda fp: binvox_rw.read_as_coord_array(fp, linear_index=True).data)
+                   , ('read packed', binvox_rw.read_as_packed_array)]
+        for Name, ReadFunc in Readers:
+            if Name == 'read coords loop' and Dim > Args.max_loop:
+                print('\t{:17s} skipped, grid larger than --max-loop'.format(Name + ':'))
+                continue
+            Time, Peak, Data = measureRead(ReadFunc, Buffer, Args.repeats)
+            if isinstance(Data, binvox_rw.PackedVoxels):
+                isCorrect = np.array_equal(Data.to_dense(), Dense)
+            elif Data.ndim == 3:
+                isCorrect = np.array_equal(Data, Dense)
+            elif Data.ndim == 2:
+                isCorrect = np.array_equal(binvox_rw.sparse_to_dense(Data, Dense.shape), Dense)
+            else:
+                isCorrect = np.array_equal(Data, np.flatnonzero(np.transpose(Dense, (0, 2, 1))))
+            print('\t{:17s} {:10.2f} ms, peak {:8.2f} MB, correct: {}'.format(Name + ':', Time * 1e3, Peak, isCorrect))
+        sys.stdout.flush()
+
+    Dim = max(Args.dims)
+    Packed = binvox_rw.pack(binvox_rw.Voxels(createSphereShell(Dim), [Dim] * 3, [0.0] * 3, 1.0, 'xyz'))
+    with tempfile.TemporaryDirectory() as TempDir:
+        FileName = os.path.join(TempDir, 'grids.pvox')
+        with open(FileName, 'wb') as f:
+            Offsets = [i * binvox_rw.packed_record_size(Packed.dims) for i in range(Args.num_grids)]
+            for i in range(Args.num_grids):
+                binvox_rw.write_packed(Packed, f)
+        Queries = np.random.randint(0, Dim, size=(3, Args.num_queries))
+        tracemalloc.start()
+        Tic = time.perf_counter()
+        Buffer = np.memmap(FileName, dtype=np.uint8, mode='r')
+        Grids = [binvox_rw.read_packed(Buffer, Offset) for Offset in Offsets]
+        OpenTime = time.perf_counter() - Tic
+        nOccupied = sum(Grid.is_occupied(Queries).sum() for Grid in Grids)
+        QueryTime = time.perf_counter() - Tic - OpenTime
+        Peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print('[ INFO ]: {} memory-mapped {}^3 grids, {:.2f} MB on disk ({:.2f} MB as dense bool).'.format(Args.num_grids, Dim, os.path.getsize(FileName) / 2**20, Args.num_grids * Dim**3 / 2**20))
+        print('\topen {:8.2f} ms, {} queries per grid {:8.2f} ms, {} occupied, peak {:8.2f} MB'.format(OpenTime * 1e3, Args.num_queries, QueryTime * 1e3, nOccupied, Peak / 2**20))
+        del Grids, Buffer
@@ -0,0 +1,68 @@
+import sys, time, argparse
+import torch
+
+from tk3dv.extern.chamfer import ChamferDistance
+
+# Compares the CPU chamfer distance backends and the pure PyTorch implementation over batch sizes and point counts (forward + backward)
+# Brute force and PyTorch are O(N*M), so they are only run up to --max-brute points. Where both run, outputs are checked for equality
+# Mixed-size batches are compared between a Python loop over items and a single padded call
+
+def measure(Chamfer, xyz1, xyz2, nRepeats):
+    Tic = time.perf_counter()
+    for i in range(nRepeats):
+        x1, x2 = xyz1.clone().requires_grad_(), xyz2.clone().requires_grad_()
+        dist1, dist2 = Chamfer(x1, x2)
+        (dist1.mean() + dist2.mean()).backward()
+    return (time.perf_counter() - Tic) / nRepeats, (dist1.detach(), dist2.detach(), x1.grad, x2.grad)
+
+def measureRagged(Chamfer, Items1, Items2, nRepeats, isLoop):
+    Lengths1, Lengths2 = torch.tensor([len(x) for x in Items1]), torch.tensor([len(x) for x in Items2])
+    Tic = time.perf_counter()
+    for i in range(nRepeats):
+        if isLoop:
+            Loss = torch.stack([Chamfer(x1.unsqueeze(0), x2.unsqueeze(0), reduction='mean') for x1, x2 in zip(Items1, Items2)]).mean()
+        else:
+            Padded1 = torch.nn.utils.rnn.pad_sequence(Items1, batch_first=True)
+            Padded2 = torch.nn.utils.rnn.pad_sequence(Items2, batch_first=True)
+            Loss = Chamfer(Padded1, Padded2, Lengths1, Lengths2, reduction='mean')
+    return (time.perf_counter() - Tic) / nRepeats, Loss.item()
+
+if __name__ == '__main__':
+    Parser = argparse.ArgumentParser(description='Benchmark CPU chamfer distance backends.')
+    Parser.add_argument('-b', '--batch-sizes', help='Batch sizes.', nargs='+', default=[1, 8], type=int)
+    Parser.add_argument('-n', '--num-points', help='Number of points per cloud.', nargs='+', default=[1000, 10000, 100000], type=int)
+    Parser.add_argument('-r', '--repeats', help='Number of runs to average over.', default=3, type=int)
+    Parser.add_argument('-c', '--chunk-size', help='Chunk size of the PyTorch implementation.', default=2048, type=int)
+    Parser.add_argument('--ragged-batch-size', help='Batch size of the mixed-size benchmark, 0 to skip it.', default=32, type=int)
+    Parser.add_argument('--max-brute', help='Largest point count to run brute force with.', default=10000, type=int)
+    Args = Parser.parse_args()
+
+    torch.manual_seed(0)
+    KDTree, BruteForce = ChamferDistance(cpu_backend='kdtree', backend='extension'), ChamferDistance(cpu_backend='bruteforce', backend='extension')
+    Torch = ChamferDistance(backend='torch', chunk_size=Args.chunk_size)
+    print('[ INFO ]: Using {} threads.'.format(torch.get_num_threads()))
+    for BatchSize in Args.batch_sizes:
+        for N in Args.num_points:
+            xyz1, xyz2 = torch.rand(BatchSize, N, 3), torch.rand(BatchSize, N, 3)
+            print('[ INFO ]: Batch size {}, {} points.'.format(BatchSize, N))
+            Time, KDResult = measure(KDTree, xyz1, xyz2, Args.repeats)
+            print('\tkdtree:     {:10.2f} ms'.format(Time * 1e3))
+            if N <= Args.max_brute:
+                Time, BFResult = measure(BruteForce, xyz1, xyz2, Args.repeats)
+                isEqual = all(torch.equal(a, b) for a, b in zip(KDResult, BFResult))
+                print('\tbruteforce: {:10.2f} ms, identical: {}'.format(Time * 1e3, isEqual))
+                Time, TorchResult = measure(Torch, xyz1, xyz2, Args.repeats)
+                MaxDiff = max((a - b).abs().max().item() for a, b in zip(KDResult[:2], TorchResult[:2]))
+                print('\ttorch:      {:10.2f} ms, max distance difference {:.2e}'.format(Time * 1e3, MaxDiff))
+            else:
+                print('\tbruteforce, torch: skipped, quadratic in number of points')
+            sys.stdout.flush()
+
+    if Args.ragged_batch_size > 0:
+        Sizes = torch.randint(100, max(101, Args.max_brute // 4), (2, Args.ragged_batch_size))
+        Items1, Items2 = [torch.rand(n, 3) for n in Sizes[0].tolist()], [torch.rand(n, 3) for n in Sizes[1].tolist()]
+        print('[ INFO ]: Mixed-size batch of {}, {} to {} points.'.format(Args.ragged_batch_size, Sizes.min().item(), Sizes.max().item()))
+        for Name, Chamfer in [('kdtree', KDTree), ('torch', Torch)]:
+            LoopTime, LoopLoss = measureRagged(Chamfer, Items1, Items2, Args.repeats, isLoop=True)
+            BatchTime, BatchLoss = measureRagged(Chamfer, Items1, Items2, Args.repeats, isLoop=False)
+            print('\t{:10s} loop {:10.2f} ms, padded {:10.2f} ms, loss difference {:.2e}'.format(Name + ':', LoopTime * 1e3, BatchTime * 1e3, abs(LoopLoss - BatchLoss)))
@@ -0,0 +1,56 @@
+import sys, time, argparse
+import numpy as np
+
+from tk3dv.nocstools import datastructures as ds
+
+# Compares NOCSMap connectivity creation from the old isin/searchsorted lookups with the pixel to vertex ID image
+# The old approach wraps around at the last column, so the test maps leave it empty and the outputs can be compared
+
+def connectivityLegacy(ValidIdx, Width):
+    ValidIdx1D = (ValidIdx[0] * Width + ValidIdx[1]).astype(np.int32)
+    LeftTop = ValidIdx1D
+    LeftBottom = (ValidIdx[0] + 1) * Width + ValidIdx[1]
+    RightTop = LeftTop + 1
+    RightBottom = LeftBottom + 1
+
+    RemoveIdx = np.zeros([0, 1], dtype=np.int32)
+    for Corner in [LeftBottom, RightTop, RightBottom]:
+        RemoveIdx = np.vstack([RemoveIdx, np.where(np.isin(Corner, ValidIdx1D, invert=True))[0].reshape(-1, 1)])
+    RemoveIdx = np.unique(RemoveIdx.squeeze()).astype(np.int32)
+
+    SortIdx = ValidIdx1D.argsort()
+    LT, LB, RT, RB = [SortIdx[np.searchsorted(ValidIdx1D, np.delete(Corner, RemoveIdx), sorter=SortIdx)] for Corner in [LeftTop, LeftBottom, RightTop, RightBottom]]
+    TriangleSoup = np.vstack([LB, LT, RT, RT, RB, LB])
+    return TriangleSoup.T.reshape((-1, 1)).astype(np.int32)
+
+def createNOCSMap(Height, Width, Seed=0):
+    # A disc of valid pixels with some noise, and an invalid last column
+    Rng = np.random.RandomState(Seed)
+    Y, X = np.mgrid[:Height, :Width]
+    Mask = ((Y - Height / 2)**2 + (X - Width / 2)**2 < (0.45 * Height)**2) | (Rng.uniform(size=(Height, Width)) < 0.05)
+    Mask[:, -1] = False
+    NOCSMap = np.full((Height, Width, 3), 255, dtype=np.uint8)
+    NOCSMap[Mask] = np.stack([X[Mask] * 254 // Width, Y[Mask] * 254 // Height, np.full(Mask.sum(), 127)], axis=1)
+    return NOCSMap
+
+def measure(Func, nRepeats):
+    Tic = time.perf_counter()
+    for i in range(nRepeats):
+        Result = Func()
+    return (time.perf_counter() - Tic) / nRepeats, Result
+
+if __name__ == '__main__':
+    Parser = argparse.ArgumentParser(description='Benchmark NOCSMap connectivity creation.')
+    Parser.add_argument('-r', '--repeats', help='Number of runs to average over.', default=10, type=int)
+    Args = Parser.parse_args()
+
+    for Width, Height in [(640, 480), (1280, 960)]:
+        NM = ds.NOCSMap(createNOCSMap(Height, Width))
+        print('[ INFO ]: {}x{} NOCS map with {} valid pixels.'.format(Width, Height, NM.Points.shape[0]))
+        Time, Legacy = measure(lambda: connectivityLegacy(NM.ValidIdx, Width), Args.repeats)
+        print('\tisin/searchsorted (before): {:8.2f} ms'.format(Time * 1e3))
+        Time, _ = measure(lambda: NM.createConnectivity(PruneSlivers=False), Args.repeats)
+        print('\tvertex ID image:            {:8.2f} ms, {} triangles, identical: {}'.format(Time * 1e3, NM.PixTIdx.shape[0] // 3, np.array_equal(Legacy, NM.PixTIdx)))
+        Time, _ = measure(lambda: NM.createConnectivity(PruneSlivers=True, SliverThreshold=0.01), Args.repeats)
+        print('\twith PruneSlivers:          {:8.2f} ms, {} triangles'.format(Time * 1e3, NM.PixTIdx.shape[0] // 3))
+        sys.stdout.flush()
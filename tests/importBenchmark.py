@@ -0,0 +1,60 @@
+import sys, os, subprocess, argparse
+import numpy as np
+
+# Measures import times in fresh interpreters and checks that heavy dependencies are only pulled in where needed
+# Exits with an error if a forbidden module gets imported or import tk3dv takes longer than --max-ms, so it can guard regressions
+
+HEAVY_MODULES = ['OpenGL', 'PyQt5', 'cv2', 'torch']
+# Import -> heavy modules it must not load
+TARGETS = [
+    ('tk3dv', HEAVY_MODULES),
+    ('tk3dv.common', HEAVY_MODULES),
+    ('tk3dv.common.utilities', HEAVY_MODULES),
+    ('tk3dv.nocstools', HEAVY_MODULES),
+    ('tk3dv.extern.chamfer', HEAVY_MODULES),
+    ('tk3dv.nocstools.datastructures', ['OpenGL', 'PyQt5', 'torch']),
+    ('tk3dv.nocstools.pipeline', ['OpenGL', 'PyQt5', 'torch']),
+    ('tk3dv.pyEasel.Easel', ['torch']),
+]
+CHILD_CODE = '''
+import sys, time
+Tic = time.perf_counter()
+import {}
+Toc = time.perf_counter()
+print((Toc - Tic) * 1e3, ','.join(m for m in {} if m in sys.modules))
+'''
+
+def measureImport(Module, nRepeats):
+    Times = []
+    for i in range(nRepeats):
+        Output = subprocess.run([sys.executable, '-c', CHILD_CODE.format(Module, HEAVY_MODULES)], capture_output=True, text=True
+                                , cwd=os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+        if Output.returncode != 0:
+            return None, Output.stderr.strip().splitlines()[-1]
+        Time, _, Loaded = Output.stdout.strip().splitlines()[-1].partition(' ')
+        Times.append(float(Time))
+    return np.median(Times), [m for m in Loaded.split(',') if m]
+
+if __name__ == '__main__':
+    Parser = argparse.ArgumentParser(description='Benchmark tk3dv import times.')
+    Parser.add_argument('-r', '--repeats', help='Number of fresh interpreters to take the median over.', default=5, type=int)
+    Parser.add_argument('--max-ms', help='Maximum time for import tk3dv in ms.', default=50.0, type=float)
+    Args = Parser.parse_args()
+
+    isFailed = False
+    for Module, Forbidden in TARGETS:
+        Time, Loaded = measureImport(Module, Args.repeats)
+        if Time is None:
+            print('\t{:32s} skipped, import failed: {}'.format(Module, Loaded))
+            continue
+        Bad = [m for m in Loaded if m in Forbidden]
+        print('\t{:32s} {:8.2f} ms, heavy modules: {}'.format(Module, Time, ', '.join(Loaded) if len(Loaded) > 0 else 'none'))
+        if len(Bad) > 0:
+            print('[ ERR ]: import {} should not load {}.'.format(Module, ', '.join(Bad)))
+            isFailed = True
+        if Module == 'tk3dv' and Time > Args.max_ms:
+            print('[ ERR ]: import tk3dv took {:.2f} ms, more than {:.2f} ms.'.format(Time, Args.max_ms))
+            isFailed = True
+        sys.stdout.flush()
+
+    sys.exit(1 if isFailed else 0)
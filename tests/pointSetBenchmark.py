@@ -0,0 +1,53 @@
+import sys, time, tracemalloc, argparse
+import numpy as np
+
+from tk3dv.nocstools import datastructures as ds
+
+# Compares appending points one at a time with the old np.vstack approach and the growable PointSet3D buffer
+# The old approach is quadratic, so it is only run up to --max-legacy points
+
+def appendLegacy(N):
+    Points = np.zeros([0, 3], dtype=np.float32)
+    Colors = np.zeros([0, 3], dtype=np.float32)
+    for i in range(N):
+        Points = np.vstack([Points, np.array([i, i, i])])
+        Colors = np.vstack([Colors, np.array([0, 0, 0])])
+    return Points, Colors
+
+def appendBuffered(N, isReserve=False):
+    PS = ds.PointSet3D()
+    if isReserve:
+        PS.reserve(N)
+    for i in range(N):
+        PS.add(i, i, i)
+    return PS.Points, PS.Colors
+
+def measure(Func, *Args):
+    # Time and peak memory are measured in separate runs since tracing allocations slows things down
+    Tic = time.perf_counter()
+    Func(*Args)
+    Toc = time.perf_counter()
+    tracemalloc.start()
+    Func(*Args)
+    _, Peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return Toc - Tic, Peak
+
+if __name__ == '__main__':
+    Parser = argparse.ArgumentParser(description='Benchmark point-by-point appends to PointSet3D.')
+    Parser.add_argument('-n', '--num-points', help='Number of points to append.', default=1000000, type=int)
+    Parser.add_argument('--max-legacy', help='Largest point count to run the old np.vstack approach with.', default=20000, type=int)
+    Args = Parser.parse_args()
+
+    for N in sorted({min(Args.num_points, Args.max_legacy), Args.num_points}):
+        print('[ INFO ]: Appending {} points.'.format(N))
+        if N <= Args.max_legacy:
+            Time, Peak = measure(appendLegacy, N)
+            print('\tnp.vstack (before): {:8.3f} s, peak memory {:8.2f} MB'.format(Time, Peak / 2**20))
+        else:
+            print('\tnp.vstack (before): skipped, quadratic in number of points')
+        Time, Peak = measure(appendBuffered, N)
+        print('\tPointSet3D.add:     {:8.3f} s, peak memory {:8.2f} MB'.format(Time, Peak / 2**20))
+        Time, Peak = measure(appendBuffered, N, True)
+        print('\twith reserve():     {:8.3f} s, peak memory {:8.2f} MB'.format(Time, Peak / 2**20))
+        sys.stdout.flush()
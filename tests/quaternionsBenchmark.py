@@ -0,0 +1,59 @@
+import sys, time, argparse
+import numpy as np
+
+from tk3dv.extern import quaternions
+
+# Compares looping the single quaternion functions in Python with their batched versions on N random rotations
+# Loops are timed on --loop-size elements and scaled to N. Outputs are checked against the loops on those elements
+
+def measure(Func, nRepeats):
+    Tic = time.perf_counter()
+    for i in range(nRepeats):
+        Result = Func()
+    return (time.perf_counter() - Tic) / nRepeats, Result
+
+def slerpLoop(Q1, Q2, T):
+    # Single quaternion slerp for reference, there is no scalar version in quaternions
+    Result = []
+    for q1, q2, t in zip(Q1, Q2, T):
+        if q1 @ q2 < 0:
+            q2 = -q2
+        Angle = np.arccos(min(1.0, q1 @ q2))
+        Result.append((np.sin((1 - t) * Angle) * q1 + np.sin(t * Angle) * q2) / np.sin(Angle))
+    return np.array(Result)
+
+if __name__ == '__main__':
+    Parser = argparse.ArgumentParser(description='Benchmark batched quaternion functions.')
+    Parser.add_argument('-n', '--num-rotations', help='Number of rotations.', default=100000, type=int)
+    Parser.add_argument('-l', '--loop-size', help='Number of rotations to time the Python loops on.', default=10000, type=int)
+    Parser.add_argument('-r', '--repeats', help='Number of runs to average the batched versions over.', default=5, type=int)
+    Args = Parser.parse_args()
+
+    Rng = np.random.default_rng(0)
+    N, L = Args.num_rotations, min(Args.loop_size, Args.num_rotations)
+    Quats = Rng.normal(size=(N, 4))
+    Quats /= np.linalg.norm(Quats, axis=1, keepdims=True)
+    Quats2 = Rng.normal(size=(N, 4))
+    Quats2 /= np.linalg.norm(Quats2, axis=1, keepdims=True)
+    Mats = quaternions.quat2mat_batch(Quats)
+    Vectors, Axes, Angles, T = Rng.normal(size=(N, 3)), Rng.normal(size=(N, 3)), Rng.uniform(-np.pi, np.pi, N), Rng.uniform(size=N)
+
+    Benchmarks = [
+        ('quat2mat', lambda n: [quaternions.quat2mat(q) for q in Quats[:n]], lambda n: quaternions.quat2mat_batch(Quats[:n])),
+        ('mat2quat', lambda n: [quaternions.mat2quat(M) for M in Mats[:n]], lambda n: quaternions.mat2quat_batch(Mats[:n])),
+        ('mult', lambda n: [quaternions.mult(a, b) for a, b in zip(Quats[:n], Quats2[:n])], lambda n: quaternions.mult_batch(Quats[:n], Quats2[:n])),
+        ('rotate_vector', lambda n: [quaternions.rotate_vector(v, q) for v, q in zip(Vectors[:n], Quats[:n])]
+         , lambda n: quaternions.rotate_vector_batch(Vectors[:n], Quats[:n])),
+        ('angle_axis2mat', lambda n: [quaternions.angle_axis2mat(t, a) for t, a in zip(Angles[:n], Axes[:n])]
+         , lambda n: quaternions.angle_axis2mat_batch(Angles[:n], Axes[:n])),
+        ('slerp', lambda n: slerpLoop(Quats[:n], Quats2[:n], T[:n]), lambda n: quaternions.slerp(Quats[:n], Quats2[:n], T[:n])),
+    ]
+
+    print('[ INFO ]: {} rotations, loops timed on {}.'.format(N, L))
+    for Name, Loop, Batch in Benchmarks:
+        LoopTime, LoopResult = measure(lambda: Loop(L), 1)
+        LoopTime *= N / L
+        BatchTime, _ = measure(lambda: Batch(N), Args.repeats)
+        MaxDiff = np.abs(np.asarray(LoopResult) - Batch(L)).max()
+        print('\t{:16s} loop {:10.2f} ms, batched {:8.2f} ms, speedup {:8.1f}x, max difference {:.2e}'.format(Name, LoopTime * 1e3, BatchTime * 1e3, LoopTime / BatchTime, MaxDiff))
+        sys.stdout.flush()
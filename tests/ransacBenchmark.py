@@ -0,0 +1,47 @@
+import time, argparse
+import numpy as np
+
+from tk3dv.nocstools import aligning
+from tk3dv.common import utilities
+
+# Compares sequential, batched and adaptive RANSAC hypothesis evaluation for similarity alignment
+
+def makeCorrespondences(N, OutlierRatio, Rng):
+    Source = Rng.uniform(size=(N, 3))
+    Rotation = utilities.rotation_matrix(Rng.uniform(size=3), Rng.uniform(0, np.pi))
+    Target = 50 * Source @ Rotation.T + Rng.uniform(-100, 100, size=3) + Rng.normal(scale=0.02, size=(N, 3))
+    Outliers = Rng.uniform(size=N) < OutlierRatio
+    Target[Outliers] += Rng.normal(scale=50, size=(np.count_nonzero(Outliers), 3))
+    return Source, Target
+
+def toHom(Points):
+    return np.transpose(np.hstack([Points, np.ones([Points.shape[0], 1])]))
+
+if __name__ == '__main__':
+    Parser = argparse.ArgumentParser(description='Benchmark sequential vs. batched RANSAC in nocstools.aligning.')
+    Parser.add_argument('-n', '--num-points', nargs='+', help='Correspondence counts to test.', default=[1000, 10000, 100000], type=int)
+    Parser.add_argument('--iterations', help='Number of RANSAC hypotheses.', default=100, type=int)
+    Parser.add_argument('--outliers', help='Outlier ratio.', default=0.3, type=float)
+    Parser.add_argument('--seed', default=0, type=int)
+    Args = Parser.parse_args()
+
+    for N in Args.num_points:
+        Source, Target = makeCorrespondences(N, Args.outliers, np.random.RandomState(Args.seed))
+        SourceHom, TargetHom = toHom(Source), toHom(Target)
+        # No early stop so that both versions evaluate the same number of hypotheses
+        PassT, StopT = 1.0, 0
+
+        np.random.seed(Args.seed)
+        Tic = time.perf_counter()
+        aligning.getRANSACInliers(SourceHom, TargetHom, MaxIterations=Args.iterations, PassThreshold=PassT, StopThreshold=StopT)
+        Sequential = time.perf_counter() - Tic
+
+        Tic = time.perf_counter()
+        aligning.getRANSACInliersBatched(SourceHom, TargetHom, MaxIterations=Args.iterations, PassThreshold=PassT, StopThreshold=StopT, Seed=Args.seed)
+        Batched = time.perf_counter() - Tic
+
+        print('[ INFO ]: N = {:7d}: sequential {:8.3f} s, batched {:8.3f} s, speedup {:.1f}x'.format(N, Sequential, Batched, Sequential / Batched))
+
+        for nPreemptive in (0, 200):
+            _, _, Ratio, Stats = aligning.getRANSACInliersAdaptive(SourceHom, TargetHom, PassThreshold=PassT, MaxIterations=Args.iterations * 10, nPreemptivePoints=nPreemptive, Seed=Args.seed)
+            print('\tadaptive (preemptive points: {:3d}): {:8.3f} s, {} iterations, {} fully evaluated, inlier ratio {:.3f}'.format(nPreemptive, Stats['RANSACTime'] * 1e-3, Stats['Iterations'], Stats['nFullyEvaluated'], Ratio))
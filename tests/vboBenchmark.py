@@ -0,0 +1,64 @@
+import sys, time, argparse
+import numpy as np
+
+from tk3dv.common import drawing
+
+# Compares VBO memory and upload time of a point cloud for float64 (before), float32 and float32 + uint8 colors
+# Upload times need an OpenGL context, which is created with an offscreen Qt surface. Without one only memory and conversion times are reported
+
+def createContext():
+    try:
+        from PyQt5 import QtGui, QtWidgets
+        App = QtWidgets.QApplication.instance() or QtWidgets.QApplication(sys.argv)
+        Context = QtGui.QOpenGLContext()
+        if not Context.create():
+            return None
+        Surface = QtGui.QOffscreenSurface()
+        Surface.setFormat(Context.format())
+        Surface.create()
+        if not Context.makeCurrent(Surface):
+            return None
+        return App, Context, Surface
+    except Exception as e:
+        print('[ WARN ]: Unable to create OpenGL context:', e)
+        return None
+
+def upload(Points, Colors, nRepeats):
+    import OpenGL.GL as gl
+    import OpenGL.arrays.vbo as glvbo
+    Tic = time.perf_counter()
+    for i in range(nRepeats):
+        VBOPoints, VBOColors = glvbo.VBO(Points), glvbo.VBO(Colors)
+        VBOPoints.bind()
+        VBOColors.bind()
+        gl.glFinish()
+        VBOPoints.delete()
+        VBOColors.delete()
+    return (time.perf_counter() - Tic) / nRepeats
+
+if __name__ == '__main__':
+    Parser = argparse.ArgumentParser(description='Benchmark VBO data types for point clouds.')
+    Parser.add_argument('-n', '--num-points', help='Number of points.', default=1000000, type=int)
+    Parser.add_argument('-r', '--repeats', help='Number of uploads to average over.', default=10, type=int)
+    Args = Parser.parse_args()
+
+    Points = np.random.uniform(size=(Args.num_points, 3))
+    Colors = np.random.uniform(size=(Args.num_points, 3))
+    Context = createContext()
+    if Context is None:
+        print('[ WARN ]: No OpenGL context available, skipping upload times.')
+
+    print('[ INFO ]: Point cloud with {} points.'.format(Args.num_points))
+    for Name, ColorType in [('float64 (before)', np.float64), ('float32', np.float32), ('float32 + uint8 colors', np.uint8)]:
+        Tic = time.perf_counter()
+        if ColorType == np.float64:
+            VertexData, ColorData = Points, Colors
+        else:
+            VertexData, ColorData = drawing.toVertexData(Points), drawing.toColorData(Colors, ColorType)
+        ConvertTime = time.perf_counter() - Tic
+        MB = (VertexData.nbytes + ColorData.nbytes) / 2**20
+        Line = '\t{:24s} {:8.2f} MB, conversion {:8.2f} ms'.format(Name, MB, ConvertTime * 1e3)
+        if Context is not None:
+            Line += ', upload {:8.2f} ms'.format(upload(VertexData, ColorData, Args.repeats) * 1e3)
+        print(Line)
+        sys.stdout.flush()
@@ -0,0 +1,88 @@
+import os, sys, time, argparse, tempfile
+import numpy as np
+
+from tk3dv.extern.binvox import binvox_rw
+from tk3dv.nocstools import voxelshards
+
+# Converts a synthetic tree of binvox/npy/npz grids to shards, resumes after adding more files, and compares random access by name
+# against reading the original files. All grids are checked against their sources
+
+def createGrid(Dim, Seed):
+    # Random ellipsoid shell
+    Rng = np.random.default_rng(Seed)
+    Coords = (np.indices((Dim, Dim, Dim), dtype=np.float32) - (Dim - 1) / 2) / (Dim / 2)
+    Radii = Rng.uniform(0.3, 0.9, size=3).reshape(3, 1, 1, 1)
+    Radius = np.sqrt(((Coords / Radii)**2).sum(axis=0))
+    return np.abs(Radius - 1) < 2 / Dim
+
+def writeGrid(Dir, Idx, Grid):
+    # Returns the grid name of the file written, cycling through the supported formats
+    SubDir = os.path.join(Dir, 'class_{}'.format(Idx % 3))
+    os.makedirs(SubDir, exist_ok=True)
+    Name = 'grid_{:05d}'.format(Idx)
+    Format = Idx % 3
+    if Format == 0:
+        with open(os.path.join(SubDir, Name + '.binvox'), 'wb') as f:
+            binvox_rw.Voxels(Grid, list(Grid.shape), [0.0] * 3, 1.0, 'xyz').write(f)
+    elif Format == 1:
+        np.save(os.path.join(SubDir, Name + '.npy'), Grid)
+    else:
+        np.savez_compressed(os.path.join(SubDir, Name + '.npz'), surface_voxel_grid=Grid)
+    return 'class_{}/{}'.format(Idx % 3, Name)
+
+def readOriginal(InputDir, Name):
+    for Ext in voxelshards.EXTENSIONS:
+        FileName = os.path.join(InputDir, Name + Ext)
+        if os.path.exists(FileName):
+            if Ext == '.binvox':
+                with open(FileName, 'rb') as f:
+                    return binvox_rw.read_as_3d_array(f).data
+            Data = np.load(FileName)
+            return Data['surface_voxel_grid'] if Ext == '.npz' else Data
+
+if __name__ == '__main__':
+    Parser = argparse.ArgumentParser(description='Benchmark voxel grid shards.')
+    Parser.add_argument('-g', '--num-grids', help='Number of grids.', default=300, type=int)
+    Parser.add_argument('-d', '--dim', help='Grid size.', default=64, type=int)
+    Parser.add_argument('-s', '--shard-size', help='Number of grids per shard.', default=50, type=int)
+    Parser.add_argument('-n', '--num-workers', help='Number of worker processes.', default=None, type=int)
+    Parser.add_argument('-q', '--num-queries', help='Number of random accesses.', default=1000, type=int)
+    Args = Parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as TempDir:
+        InputDir, OutputDir = os.path.join(TempDir, 'input'), os.path.join(TempDir, 'shards')
+        Half = Args.num_grids // 2
+        Names = [writeGrid(InputDir, i, createGrid(Args.dim, i)) for i in range(Half)]
+
+        Tic = time.perf_counter()
+        nFirst, _ = voxelshards.convertVoxels(InputDir, OutputDir, ShardSize=Args.shard_size, nWorkers=Args.num_workers, isVerbose=False)
+        FirstTime = time.perf_counter() - Tic
+        Names += [writeGrid(InputDir, i, createGrid(Args.dim, i)) for i in range(Half, Args.num_grids)]
+        Tic = time.perf_counter()
+        nSecond, _ = voxelshards.convertVoxels(InputDir, OutputDir, ShardSize=Args.shard_size, nWorkers=Args.num_workers, isVerbose=False)
+        SecondTime = time.perf_counter() - Tic
+        print('[ INFO ]: Converted {} grids in {:.2f} ms, resumed with {} new grids in {:.2f} ms.'.format(nFirst, FirstTime * 1e3, nSecond, SecondTime * 1e3))
+
+        InputMB = sum(os.path.getsize(os.path.join(Root, f)) for Root, _, Files in os.walk(InputDir) for f in Files) / 2**20
+        OutputMB = sum(os.path.getsize(os.path.join(OutputDir, f)) for f in os.listdir(OutputDir)) / 2**20
+        print('[ INFO ]: {:.2f} MB of input files, {:.2f} MB of shards in {} files.'.format(InputMB, OutputMB, len(os.listdir(OutputDir))))
+
+        Tic = time.perf_counter()
+        Shards = voxelshards.VoxelShards(OutputDir)
+        print('[ INFO ]: Opened {} grids in {:.2f} ms.'.format(len(Shards), (time.perf_counter() - Tic) * 1e3))
+        isCorrect = len(Shards) == len(Names) and all(np.array_equal(Shards[Name].to_dense(), readOriginal(InputDir, Name)) for Name in Names)
+        print('[ INFO ]: All grids match their source files: {}'.format(isCorrect))
+
+        Queries = np.random.choice(Names, Args.num_queries)
+        Tic = time.perf_counter()
+        for Name in Queries:
+            Shards[Name].count()
+        ShardTime = (time.perf_counter() - Tic) / Args.num_queries
+        Tic = time.perf_counter()
+        for Name in Queries:
+            readOriginal(InputDir, Name).sum()
+        FileTime = (time.perf_counter() - Tic) / Args.num_queries
+        print('\tshards: {:8.3f} ms per random access'.format(ShardTime * 1e3))
+        print('\tfiles:  {:8.3f} ms per random access'.format(FileTime * 1e3))
+        del Shards
+        sys.exit(0 if isCorrect else 1)
@@ -1,3 +1,12 @@
-import tk3dv.common
-import tk3dv.nocstools
-import tk3dv.pyEasel
\ No newline at end of file
+# Subpackages are imported on first access (PEP 562). They pull in OpenGL, PyQt5, OpenCV and torch, which tools using only a few of them should not pay for
+import importlib
+
+__all__ = ['common', 'nocstools', 'pyEasel', 'extern', 'ptTools']
+
+def __getattr__(Name):
+    if Name in __all__:
+        return importlib.import_module('.' + Name, __name__)
+    raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, Name))
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
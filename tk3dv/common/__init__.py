@@ -1,10 +1,15 @@
 # Written by Srinath Sridhar (http://srinathsridhar.com)
 
 # Released under the MIT License, see LICENSE.txt
-import os, sys
-FileDirPath = os.path.dirname(os.path.realpath(__file__))
-sys.path.append(os.path.join(FileDirPath, '.'))
+import importlib
+from .defines import __version__
 
-import utilities, drawing, defines
+__all__ = ['defines', 'utilities', 'drawing']
 
-__version__= defines.__version__
+def __getattr__(Name):
+    if Name in __all__:
+        return importlib.import_module('.' + Name, __name__)
+    raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, Name))
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
@@ -1,8 +1,11 @@
-import OpenGL.GL as gl
-import OpenGL.GLU as glu
-import OpenGL.arrays.vbo as glvbo
 import numpy as np
 import math, sys
+from tk3dv.common import utilities
+
+# OpenGL is imported on first use so that the numpy helpers here work without PyOpenGL or a display
+gl = utilities.LazyModule('OpenGL.GL')
+glu = utilities.LazyModule('OpenGL.GLU')
+glvbo = utilities.LazyModule('OpenGL.arrays.vbo')
 
 def drawAxes(Length=100.0, LineWidth=5.0, Color=None):
     gl.glMatrixMode(gl.GL_MODELVIEW)
@@ -98,9 +101,15 @@ def activateCamera(Intrinsics, ImageShape):
     gl.glRotatef(180.0, 0.0, 0.0, 1.0)
 
 
-QUADRIC = glu.gluNewQuadric()
+QUADRIC = None # Created on first use
 # glu.gluDeleteQuadric(QUADRIC)
 
+def getQuadric():
+    global QUADRIC
+    if QUADRIC is None:
+        QUADRIC = glu.gluNewQuadric()
+    return QUADRIC
+
 def drawSolidSphere(radius=1.0, slices=16, stacks=16, Color=None):
     if (Color != None):
         gl.glEnable(gl.GL_DEPTH_TEST)
@@ -112,8 +121,8 @@ def drawSolidSphere(radius=1.0, slices=16, stacks=16, Color=None):
     else:
         gl.glColor3f(0.0, 0.0, 0.0)
 
-    glu.gluQuadricDrawStyle(QUADRIC, glu.GLU_FILL)
-    glu.gluSphere(QUADRIC, radius, slices, stacks)
+    glu.gluQuadricDrawStyle(getQuadric(), glu.GLU_FILL)
+    glu.gluSphere(getQuadric(), radius, slices, stacks)
 
 def drawCylinder(Start=np.array([0, 0, 0]), End=np.array([1.0, 0.0, 0.0]), Radius1=1.0, Radius2=1.0, Color=None):
     if type(Start) is not np.ndarray or type(End) is not np.ndarray:
@@ -148,16 +157,16 @@ def drawCylinder(Start=np.array([0, 0, 0]), End=np.array([1.0, 0.0, 0.0]), Radiu
 
     # Draw cylinder
     # Bottom:
-    glu.gluQuadricOrientation(QUADRIC, glu.GLU_INSIDE)
-    glu.gluDisk(QUADRIC, 0, Radius1, 16, 1)
+    glu.gluQuadricOrientation(getQuadric(), glu.GLU_INSIDE)
+    glu.gluDisk(getQuadric(), 0, Radius1, 16, 1)
 
-    glu.gluQuadricOrientation(QUADRIC, glu.GLU_OUTSIDE)
-    glu.gluCylinder(QUADRIC, Radius1, Radius2, Length, 16, 1)
+    glu.gluQuadricOrientation(getQuadric(), glu.GLU_OUTSIDE)
+    glu.gluCylinder(getQuadric(), Radius1, Radius2, Length, 16, 1)
 
     # Top:
     gl.glTranslatef(0, 0, Length)
-    glu.gluQuadricOrientation(QUADRIC, glu.GLU_OUTSIDE)
-    glu.gluDisk(QUADRIC, 0, Radius2, 16, 1)
+    glu.gluQuadricOrientation(getQuadric(), glu.GLU_OUTSIDE)
+    glu.gluDisk(getQuadric(), 0, Radius2, 16, 1)
 
     gl.glPopMatrix()
 
@@ -334,9 +343,90 @@ def drawUnitWireFrustum(lineWidth=1.0, isRainbow=False, WireColor=(1, 1, 1)):
     gl.glPopAttrib()
 
 
-def getVBOs(V, VC, I):
-    VBO_V = glvbo.VBO(V)
-    VBO_VC = glvbo.VBO(VC)
+# Vertex positions are uploaded as float32. Colors are float32 or uint8, which OpenGL normalizes to 0-1 when drawing
+GL_TYPES = {np.dtype(np.float32): 'GL_FLOAT', np.dtype(np.float64): 'GL_DOUBLE', np.dtype(np.uint8): 'GL_UNSIGNED_BYTE'}
+
+def checkGLType(dtype):
+    if np.dtype(dtype) not in GL_TYPES:
+        raise RuntimeError('[ ERR ]: Unsupported VBO data type {}.'.format(np.dtype(dtype)))
+
+def getGLType(dtype):
+    checkGLType(dtype)
+    return getattr(gl, GL_TYPES[np.dtype(dtype)])
+
+def toVertexData(Array):
+    # No copy if Array is already contiguous float32
+    return np.ascontiguousarray(Array, dtype=np.float32)
+
+def toColorData(Colors, ColorType=np.float32):
+    # Colors are in 0-1, converted to ColorType (float32 or uint8) for upload
+    checkGLType(ColorType)
+    if np.dtype(ColorType) == np.uint8 and np.asarray(Colors).dtype != np.uint8:
+        return np.ascontiguousarray(np.clip(np.rint(np.asarray(Colors) * 255), 0, 255), dtype=np.uint8)
+    return np.ascontiguousarray(Colors, dtype=ColorType)
+
+def updateVBO(VBO, Rows, Start=0):
+    # Writes Rows (same type as the VBO data) into VBO starting at row Start. Once the VBO has been uploaded, only these
+    # rows are copied into the existing buffer (glBufferSubData) the next time it is bound
+    if Rows.shape[0] > 0:
+        VBO[Start:Start + Rows.shape[0]] = Rows
+
+class VBOAdapter():
+    # Render adapter for classes that keep their data in numpy arrays. VBO_ATTRIBUTES maps host array name -> (VBO attribute, kind)
+    # with kind 'Vertex', 'Color' or 'Index'. Users need ColorType, isVBOBound and DirtyRanges (name -> (start, stop) rows to re-upload)
+    # Nothing here runs before upload(), which is called by the draw methods with a current OpenGL context
+    VBO_ATTRIBUTES = {}
+
+    def toVBOData(self, Kind, Data):
+        if Kind == 'Vertex':
+            return toVertexData(Data)
+        if Kind == 'Color':
+            return toColorData(Data, self.ColorType)
+        return np.ascontiguousarray(Data)
+
+    def syncVBO(self, Name):
+        # Creates the VBO of a host array if it does not exist or its size/type changed
+        # Otherwise only dirty rows are written into the existing buffer. Returns True if anything was (re-)uploaded
+        VBOName, Kind = self.VBO_ATTRIBUTES[Name]
+        Data = getattr(self, Name)
+        VBO = getattr(self, VBOName, None)
+        Range = self.DirtyRanges.pop(Name, None)
+        if Data is None:
+            return False
+        if VBO is None or VBO.data.shape != Data.shape or VBO.data.dtype != self.toVBOData(Kind, Data[:0]).dtype:
+            if VBO is not None:
+                VBO.delete()
+            Target = gl.GL_ELEMENT_ARRAY_BUFFER if Kind == 'Index' else gl.GL_ARRAY_BUFFER
+            setattr(self, VBOName, glvbo.VBO(self.toVBOData(Kind, Data), target=Target))
+            return True
+        if Range is None:
+            return False
+
+        Start, Stop = max(Range[0], 0), min(Range[1], Data.shape[0])
+        Rows = self.toVBOData(Kind, Data[Start:Stop])
+        if Start == 0 and Stop == Data.shape[0]:
+            VBO.data = Rows # Array was replaced, don't keep the old one alive
+        updateVBO(VBO, Rows, Start)
+        return True
+
+    def upload(self):
+        # Creates missing VBOs and writes dirty rows of existing ones. Returns True if there is something to draw
+        for Name in self.VBO_ATTRIBUTES:
+            self.syncVBO(Name)
+        self.isVBOBound = True
+        return True
+
+    def deleteVBOs(self):
+        for VBOName, _ in self.VBO_ATTRIBUTES.values():
+            VBO = getattr(self, VBOName, None)
+            if VBO is not None:
+                VBO.delete()
+                setattr(self, VBOName, None)
+        self.isVBOBound = False
+
+def getVBOs(V, VC, I, ColorType=np.float32):
+    VBO_V = glvbo.VBO(toVertexData(V))
+    VBO_VC = glvbo.VBO(toColorData(VC, ColorType))
     VBO_I = glvbo.VBO(I, target=gl.GL_ELEMENT_ARRAY_BUFFER)
 
     return VBO_V, VBO_VC, VBO_I
@@ -355,40 +445,36 @@ CBSceneHeight = 1000
 CBVBOBound = False
 CB_isWire = False
 CB_WireColor = np.array([0.1, 0.1, 0.1, 1.0])
+CB_ColorType = np.float32
 
-def createCBData(floorSize, squareWidthInPixel, squareHeightInPixel, SceneHeight):
-    global CBVBOBound, CB_V, CB_VC, CB_I, CB_V_VBO, CB_VC_VBO, CB_I_VBO, CB_isWire, CB_WireColor
+def createCBData(floorSize, squareWidthInPixel, squareHeightInPixel, SceneHeight, ColorType=np.float32):
+    global CBVBOBound, CB_V, CB_VC, CB_I, CB_V_VBO, CB_VC_VBO, CB_I_VBO, CB_isWire, CB_WireColor, CB_ColorType
     CBVBOBound = False
-    colorBlack = np.array([0.8, 0.8, 0.8, 1.0])
-    colorWhite = np.array([0.1, 0.1, 0.1, 1.0])
-    isWhite = False
-    Idx = 0
-    CB_V = np.zeros([0, 3], dtype=np.float32)  # Each point is a row
-    CB_VC = np.zeros([0, 4], dtype=np.float32)  # Each point is a row
-    CB_I = np.zeros([0, 1], dtype=np.int32)  # Each element is an index
+    CB_ColorType = ColorType
+    colorBlack = np.array([0.8, 0.8, 0.8, 1.0], dtype=np.float32)
+    colorWhite = np.array([0.1, 0.1, 0.1, 1.0], dtype=np.float32)
+
+    # Squares are ordered by x then y, 4 corners each
+    x, y = np.meshgrid(np.arange(-floorSize, floorSize + 1, squareHeightInPixel), np.arange(-floorSize, floorSize + 1, squareWidthInPixel), indexing='ij')
+    x, y = x.reshape(-1), y.reshape(-1)
+    nSquares = x.shape[0]
+    CB_V = np.empty([nSquares, 4, 3], dtype=np.float32)
+    CB_V[:, :, 1] = -SceneHeight
+    CB_V[:, :, 0] = np.stack([x, x + squareHeightInPixel, x + squareHeightInPixel, x], axis=1)
+    CB_V[:, :, 2] = np.stack([y + squareHeightInPixel, y + squareHeightInPixel, y, y], axis=1)
+    CB_V = CB_V.reshape((-1, 3))
+
+    StartIdx = np.arange(nSquares, dtype=np.int32) * 4
+    CB_I = (StartIdx[:, np.newaxis] + np.array([0, 1, 2, 2, 3, 0], dtype=np.int32)[np.newaxis, :]).reshape((-1, 1))
+
+    if CB_isWire:
+        SquareColors = np.tile(np.asarray(CB_WireColor, dtype=np.float32), (nSquares, 1))
+    else:
+        # Alternate colors square by square
+        SquareColors = np.where((np.arange(nSquares) % 2 == 1)[:, np.newaxis], colorWhite, colorBlack)
+    CB_VC = np.repeat(SquareColors, 4, axis=0)
 
-    for x in range(-floorSize, floorSize + 1, squareHeightInPixel):
-        for y in range(-floorSize, floorSize + 1, squareWidthInPixel):
-            CB_V = np.vstack([CB_V, np.array([x, -SceneHeight, y + squareHeightInPixel])])
-            CB_V = np.vstack([CB_V, np.array([x + squareHeightInPixel, -SceneHeight, y + squareHeightInPixel])])
-            CB_V = np.vstack([CB_V, np.array([x + squareHeightInPixel, -SceneHeight, y])])
-            CB_V = np.vstack([CB_V, np.array([x, -SceneHeight, y])])
-
-            CB_I = np.vstack([CB_I, np.array([Idx, Idx + 1, Idx + 2]).reshape(-1, 1)])
-            CB_I = np.vstack([CB_I, np.array([Idx + 2, Idx + 3, Idx]).reshape(-1, 1)])
-            Idx = Idx + 4
-
-            for kk in range(0, 4):
-                if CB_isWire:
-                    CB_VC = np.vstack([CB_VC, CB_WireColor])
-                else:
-                    if (isWhite == True):
-                        CB_VC = np.vstack([CB_VC, colorWhite])
-                    else:
-                        CB_VC = np.vstack([CB_VC, colorBlack])
-            isWhite = not isWhite
-
-    CB_V_VBO, CB_VC_VBO, CB_I_VBO = getVBOs(CB_V, CB_VC, CB_I)
+    CB_V_VBO, CB_VC_VBO, CB_I_VBO = getVBOs(CB_V, CB_VC, CB_I, ColorType)
 
 def drawCheckerBoard(floorSize, squareWidthInPixel, squareHeightInPixel, SceneHeight, isWireFrame=False, LineWidth=3.0, wireColor=np.array([0, 0, 0, 1])):
     global CB_V, CB_VC, CB_I, CBFloorSize, CBSquareWidth, CBSquareHeight, CBVBOBound, CB_V_VBO, CB_VC_VBO, CB_I_VBO, CB_isWire, CB_WireColor
@@ -414,10 +500,10 @@ def drawCheckerBoard(floorSize, squareWidthInPixel, squareHeightInPixel, SceneHe
 
     CB_V_VBO.bind()
     gl.glEnableClientState(gl.GL_VERTEX_ARRAY)
-    gl.glVertexPointer(3, gl.GL_DOUBLE, 0, CB_V_VBO)
+    gl.glVertexPointer(3, gl.GL_FLOAT, 0, CB_V_VBO)
     CB_VC_VBO.bind()
     gl.glEnableClientState(gl.GL_COLOR_ARRAY)
-    gl.glColorPointer(4, gl.GL_DOUBLE, 0, CB_VC_VBO)
+    gl.glColorPointer(4, getGLType(CB_ColorType), 0, CB_VC_VBO)
 
     CB_I_VBO.bind()
     if isWireFrame:
@@ -1,61 +1,97 @@
 from datetime import datetime
 import numpy as np
-import math
+import importlib
+
+from tk3dv.extern.quaternions import rotation_matrix # Batched, also accepts (N, 3) axes and (N,) angles
+
+class LazyModule():
+    # Stands in for a module that is imported on first attribute access, e.g. gl = LazyModule('OpenGL.GL')
+    # Lets modules that only need OpenGL for drawing be imported (and used) without PyOpenGL or a display
+    def __init__(self, Name):
+        self.Name = Name
+        self.Module = None
+
+    def __getattr__(self, Attr):
+        if self.Module is None:
+            self.Module = importlib.import_module(self.Name)
+        return getattr(self.Module, Attr)
 
 def getCurrentEpochTime():
     return int((datetime.utcnow() - datetime(1970, 1, 1)).total_seconds() * 1e6)
 
-def rotation_matrix(axis, theta):
-    """
-    Return the rotation matrix associated with counterclockwise rotation about
-    the given axis by theta radians.
-    """
-    axis = np.asarray(axis)
-    axis = axis/math.sqrt(np.dot(axis, axis))
-    a = math.cos(theta/2.0)
-    b, c, d = -axis*math.sin(theta/2.0)
-    aa, bb, cc, dd = a*a, b*b, c*c, d*d
-    bc, ad, ac, ab, bd, cd = b*c, a*d, a*c, a*b, b*d, c*d
-    return np.array([[aa+bb-cc-dd, 2*(bc+ad), 2*(bd-ac)],
-                     [2*(bc-ad), aa+cc-bb-dd, 2*(cd+ab)],
-                     [2*(bd+ac), 2*(cd-ab), aa+dd-bb-cc]])
+class Backprojector():
+    # Backprojects depth images taken with fixed intrinsics and image size
+    # The ray through every pixel is computed once and cached, scaled so that its z is 1 (unit depth)
+    def __init__(self, Intrinsics, ImageShape):
+        self.Intrinsics = np.asarray(Intrinsics, dtype=np.float64)
+        self.Height, self.Width = int(ImageShape[0]), int(ImageShape[1])
+
+        IntrinsicsInv = np.linalg.inv(self.Intrinsics)
+        v, u = np.mgrid[0:self.Height, 0:self.Width]
+        uv_grid = np.stack([u.reshape(-1), v.reshape(-1), np.ones(self.Height * self.Width)])  # [3, num_pixel]
+        xyz = np.transpose(IntrinsicsInv @ uv_grid)  # [num_pixel, 3]
+        Rays = xyz / xyz[:, -1:]
+        # Because of differences in image coordinate systems
+        Rays[:, 0] = -Rays[:, 0]
+        Rays[:, 1] = -Rays[:, 1]
+        self.Rays = np.ascontiguousarray(Rays) # [num_pixel, 3], row-major pixel order
+
+    def getValidMask(self, DepthImage, mask=None):
+        Valid = DepthImage > 0
+        if mask is not None:
+            Valid &= (mask > 0)
+        return Valid
+
+    def backprojectPixels(self, PixIdx, z, Out=None):
+        # Rays have unit depth, so x and y scale with z and the z coordinate is the depth itself
+        if Out is None:
+            Out = np.empty((PixIdx.shape[0], 3))
+        Out[:, :] = np.take(self.Rays, PixIdx, axis=0)
+        Out[:, 0] *= z
+        Out[:, 1] *= z
+        Out[:, 2] = z
+        return Out
+
+    def backproject(self, DepthImage, mask=None):
+        # Returns an N x 3 array of points for pixels with depth > 0 (and inside mask, if given)
+        if DepthImage.shape[:2] != (self.Height, self.Width):
+            raise RuntimeError('[ ERR ]: Depth image shape {} does not match backprojector shape {}.'.format(DepthImage.shape, (self.Height, self.Width)))
+        PixIdx = np.flatnonzero(self.getValidMask(DepthImage, mask))
+        return self.backprojectPixels(PixIdx, np.take(DepthImage.reshape(-1), PixIdx))
+
+    def backprojectBatch(self, DepthImages, masks=None):
+        # DepthImages is B x H x W (masks, if given, is B x H x W or H x W)
+        # Returns packed points (sum of N_i) x 3 and offsets (B+1) so that frame i is Points[Offsets[i]:Offsets[i+1]]
+        DepthImages = np.asarray(DepthImages)
+        if DepthImages.shape[1:3] != (self.Height, self.Width):
+            raise RuntimeError('[ ERR ]: Depth image shape {} does not match backprojector shape {}.'.format(DepthImages.shape, (self.Height, self.Width)))
+        Valid = self.getValidMask(DepthImages, masks).reshape(DepthImages.shape[0], -1)
+        Counts = np.count_nonzero(Valid, axis=1)
+        Offsets = np.concatenate([[0], np.cumsum(Counts)])
+
+        Points = np.empty((Offsets[-1], 3))
+        for i in range(0, DepthImages.shape[0]):
+            PixIdx = np.flatnonzero(Valid[i])
+            self.backprojectPixels(PixIdx, np.take(DepthImages[i].reshape(-1), PixIdx), Out=Points[Offsets[i]:Offsets[i+1]])
+        return Points, Offsets
+
+BACKPROJECTORS = {} # Cache of Backprojector keyed by (intrinsics, image shape)
+MaxCachedBackprojectors = 8
+
+def getBackprojector(Intrinsics, ImageShape):
+    Intrinsics = np.asarray(Intrinsics, dtype=np.float64)
+    Key = (Intrinsics.tobytes(), int(ImageShape[0]), int(ImageShape[1]))
+    if Key not in BACKPROJECTORS:
+        if len(BACKPROJECTORS) >= MaxCachedBackprojectors:
+            BACKPROJECTORS.pop(next(iter(BACKPROJECTORS))) # Drop the oldest
+        BACKPROJECTORS[Key] = Backprojector(Intrinsics, ImageShape)
+    return BACKPROJECTORS[Key]
 
 def backproject(DepthImage, Intrinsics, mask=None):
-    # OutPoints = np.zeros([0, 3])  # Each point is a row
-
-    # Depth image should be (DepthImage.shape) == 2 and DepthImage.dtype == 'uint16':
-
-    # # Back project and add
-    # if mask is None:
-    #     DepthIdx = np.where(DepthImage > 0)
-    # else:
-    #     DepthIdx = np.where((mask >= 255))
-    # IntrinsicsInv = np.linalg.inv(Intrinsics)
-    # for i in range(0, DepthIdx[0].shape[0]):
-    #     zVal = DepthImage[DepthIdx[0][i], DepthIdx[1][i]]
-    #     UV = np.array([DepthIdx[1][i], DepthIdx[0][i], 1])  # Row/col to uv
-    #     XYZ = np.dot(IntrinsicsInv, UV)
-    #     XYZ = XYZ * (zVal / XYZ[2])
-    #     # Because of differences in image coordinate systems
-    #     OutPoints = np.vstack([OutPoints, np.array([-XYZ[0], -XYZ[1], XYZ[2]])])
-
-    IntrinsicsInv = np.linalg.inv(Intrinsics)
-
-    non_zero_mask = (DepthImage >= 0)
-    idxs = np.where(non_zero_mask)
-    grid = np.array([idxs[1], idxs[0]])
-
-    length = grid.shape[1]
-    ones = np.ones([1, length])
-    uv_grid = np.concatenate((grid, ones), axis=0)  # [3, num_pixel]
-
-    xyz = IntrinsicsInv @ uv_grid  # [3, num_pixel]
-    xyz = np.transpose(xyz)  # [num_pixel, 3]
-
-    z = DepthImage[idxs[0], idxs[1]]
-    pts = xyz * z[:, np.newaxis] / xyz[:, -1:]
-    pts[:, 0] = -pts[:, 0]
-    pts[:, 1] = -pts[:, 1]
-    OutPoints = pts
-
-    return OutPoints
\ No newline at end of file
+    # Depth image should be (DepthImage.shape) == 2 and DepthImage.dtype == 'uint16'
+    # Only pixels with depth > 0 (and mask > 0, if given) are backprojected
+    return getBackprojector(Intrinsics, DepthImage.shape).backproject(DepthImage, mask)
+
+def backprojectBatch(DepthImages, Intrinsics, masks=None):
+    # Backproject B x H x W depth images in one call. See Backprojector.backprojectBatch()
+    return getBackprojector(Intrinsics, DepthImages.shape[1:3]).backprojectBatch(DepthImages, masks)
@@ -27,7 +27,7 @@ Binvox to Numpy and back.
 >>> m1.dims
 [32, 32, 32]
 >>> m1.scale
-41.133000000000003
+41.133
 >>> m1.translate
 [0.0, 0.0, 0.0]
 >>> with open('chair_out.binvox', 'wb') as f:
@@ -59,14 +59,34 @@ True
 >>> # ordering, so to compare for equality we first lexically sort the voxels.
 >>> np.all(ms.data[:, np.lexsort(ms.data)] == data_ds[:, np.lexsort(data_ds)])
 True
+
+>>> with open('chair.binvox', 'rb') as f:
+...     mp = binvox_rw.read_as_packed_array(f)
+...
+>>> mp.bits.nbytes
+4096
+>>> np.all(mp.to_dense()==md.data)
+True
+>>> bool(mp.is_occupied(ms.data).all())
+True
+>>> with open('chair_out.pvox', 'wb') as f:
+...     binvox_rw.write_packed(mp, f)
+...
+4160
+>>> mm = binvox_rw.open_packed('chair_out.pvox')
+>>> np.all(mm.to_dense()==md.data)
+True
 """
 
+import struct
 import numpy as np
 
 class Voxels(object):
     """ Holds a binvox model.
-    data is either a three-dimensional numpy boolean array (dense representation)
-    or a two-dimensional numpy float array (coordinate representation).
+    data is either a three-dimensional numpy boolean array (dense representation),
+    a two-dimensional numpy integer array (coordinate representation) or a
+    one-dimensional numpy integer array of sorted linear indices in binvox
+    (xzy) order (see read_as_coord_array).
 
     dims, translate and scale are the model metadata.
 
@@ -102,6 +122,78 @@ class Voxels(object):
     def write(self, fp):
         write(self, fp)
 
+class PackedVoxels(object):
+    """ Holds a binvox model with 1 bit per voxel.
+
+    bits is a flat numpy uint8 array (np.packbits order) of the dense grid of
+    shape self.shape, which is dims in 'xzy' order and dims[0], dims[2], dims[1]
+    in 'xyz' order, like the arrays returned by read_as_3d_array. It may be a
+    np.memmap (see open_packed), in which case only the bytes that are touched
+    get read from disk.
+
+    dims, translate, scale and axis_order are the same as in Voxels.
+    """
+
+    def __init__(self, bits, dims, translate, scale, axis_order):
+        self.bits = bits
+        self.dims = dims
+        self.translate = translate
+        self.scale = scale
+        assert (axis_order in ('xzy', 'xyz'))
+        self.axis_order = axis_order
+
+    @property
+    def shape(self):
+        if self.axis_order=='xyz':
+            return (self.dims[0], self.dims[2], self.dims[1])
+        return tuple(self.dims)
+
+    @property
+    def size(self):
+        return int(np.prod(self.dims))
+
+    def clone(self):
+        return PackedVoxels(np.array(self.bits), self.dims[:], self.translate[:], self.scale, self.axis_order)
+
+    def count(self):
+        """ Number of occupied voxels. """
+        return int(POPCOUNT[self.bits].sum(dtype=np.int64))
+
+    def linear_index(self):
+        """ Sorted linear indices (in self.shape) of the occupied voxels. """
+        return bits_to_linear_index(self.bits, self.size)
+
+    def nonzero(self):
+        """ Occupied voxels like np.nonzero on the dense grid. """
+        return np.unravel_index(self.linear_index(), self.shape)
+
+    def is_occupied(self, voxel_data):
+        """ Occupancy of the voxels in a 3xN coordinate array (in axis_order),
+        read directly from the packed bits. Voxels outside the grid are empty.
+        """
+        xyz = np.asarray(voxel_data, dtype=np.int64)
+        shape = np.array(self.shape, dtype=np.int64).reshape(3, 1)
+        valid_ix = ~np.any((xyz < 0) | (xyz >= shape), 0)
+        occupied = np.zeros(xyz.shape[1], dtype=bool)
+        indices = np.ravel_multi_index(tuple(xyz[:, valid_ix]), self.shape)
+        occupied[valid_ix] = (self.bits[indices >> 3] >> (7 - (indices & 7)).astype(np.uint8)) & 1
+        return occupied
+
+    def to_dense(self):
+        return np.unpackbits(self.bits, count=self.size).view(bool).reshape(self.shape)
+
+    def to_voxels(self, dense=True):
+        """ Voxels model with dense or coordinate data. """
+        if dense:
+            data = self.to_dense()
+        else:
+            data = np.vstack(self.nonzero())
+        return Voxels(data, self.dims[:], self.translate[:], self.scale, self.axis_order)
+
+    def write(self, fp):
+        """ Write binary binvox format, without converting to dense format. """
+        write(Voxels(np.vstack(self.nonzero()), self.dims, self.translate, self.scale, self.axis_order), fp)
+
 def read_header(fp):
     """ Read binvox header. Mostly meant for internal use.
     """
@@ -140,7 +232,7 @@ def read_as_3d_array(fp, fix_coords=True):
     # j -> y
     # k -> z
     values, counts = raw_data[::2], raw_data[1::2]
-    data = np.repeat(values, counts).astype(np.bool)
+    data = np.repeat(values, counts).astype(bool)
     data = data.reshape(dims)
     if fix_coords:
         # xzy to xyz TODO the right thing
@@ -150,16 +242,51 @@ def read_as_3d_array(fp, fix_coords=True):
         axis_order = 'xzy'
     return Voxels(data, dims, translate, scale, axis_order)
 
-def read_as_coord_array(fp, fix_coords=True):
+def rle_to_linear_index(values, counts):
+    """ Sorted binvox (xzy) linear indices of the occupied voxels in RLE data.
+
+    Runs are expanded with a cumulative sum over per-voxel increments (the
+    increment is 1 inside a run and jumps to the next run's start at run
+    boundaries), so the cost is proportional to the number of occupied voxels.
+    """
+    counts = counts.astype(np.int64)
+    starts = np.cumsum(counts) - counts
+    occupied = (values != 0) & (counts > 0)
+    starts, lengths = starts[occupied], counts[occupied]
+    if starts.size == 0:
+        return np.zeros(0, dtype=np.int64)
+    steps = np.ones(lengths.sum(), dtype=np.int64)
+    steps[0] = starts[0]
+    # first output position of every run after the first
+    firsts = np.cumsum(lengths)[:-1]
+    steps[firsts] = starts[1:] - (starts[:-1] + lengths[:-1] - 1)
+    return np.cumsum(steps)
+
+def linear_index_to_coords(indices, dims, fix_coords=True):
+    """ 3xN integer coordinates of binvox (xzy) linear indices, in (x, y, z)
+    order if fix_coords, else in (x, z, y) order.
+    """
+    # index = x * (dims[1]*dims[2]) + z * dims[2] + y
+    x, zwpy = np.divmod(indices, dims[1]*dims[2])
+    z, y = np.divmod(zwpy, dims[2])
+    if fix_coords:
+        return np.vstack((x, y, z))
+    return np.vstack((x, z, y))
+
+def read_as_coord_array(fp, fix_coords=True, linear_index=False):
     """ Read binary binvox format as coordinates.
 
     Returns binvox model with voxels in a "coordinate" representation, i.e.  an
-    3 x N array where N is the number of nonzero voxels. Each column
-    corresponds to a nonzero voxel and the 3 rows are the (x, z, y) coordinates
-    of the voxel.  (The odd ordering is due to the way binvox format lays out
-    data).  Note that coordinates refer to the binvox voxels, without any
+    3 x N integer array where N is the number of nonzero voxels. Each column
+    corresponds to a nonzero voxel and the 3 rows are the (x, y, z) coordinates
+    of the voxel, or (x, z, y) if fix_coords is false (the way binvox format lays
+    out data). Note that coordinates refer to the binvox voxels, without any
     scaling or translation.
 
+    If linear_index is true, data is instead the sorted 1D array of linear
+    indices of the nonzero voxels in file order (x * dims[1]*dims[2] + z *
+    dims[2] + y), and axis_order is 'xzy'.
+
     Use this to save memory if your model is very sparse (mostly empty).
 
     Doesn't do any checks on input except for the '#binvox' line.
@@ -168,39 +295,15 @@ def read_as_coord_array(fp, fix_coords=True):
     raw_data = np.frombuffer(fp.read(), dtype=np.uint8)
 
     values, counts = raw_data[::2], raw_data[1::2]
+    nz_voxels = rle_to_linear_index(values, counts)
+    if linear_index:
+        return Voxels(nz_voxels, dims, translate, scale, 'xzy')
 
-    sz = np.prod(dims)
-    index, end_index = 0, 0
-    end_indices = np.cumsum(counts)
-    indices = np.concatenate(([0], end_indices[:-1])).astype(end_indices.dtype)
-
-    values = values.astype(np.bool)
-    indices = indices[values]
-    end_indices = end_indices[values]
-
-    nz_voxels = []
-    for index, end_index in zip(indices, end_indices):
-        nz_voxels.extend(range(index, end_index))
-    nz_voxels = np.array(nz_voxels)
-    # TODO are these dims correct?
-    # according to docs,
-    # index = x * wxh + z * width + y; // wxh = width * height = d * d
-
-    x = nz_voxels / (dims[0]*dims[1])
-    zwpy = nz_voxels % (dims[0]*dims[1]) # z*w + y
-    z = zwpy / dims[0]
-    y = zwpy % dims[0]
-    if fix_coords:
-        data = np.vstack((x, y, z))
-        axis_order = 'xyz'
-    else:
-        data = np.vstack((x, z, y))
-        axis_order = 'xzy'
-
-    #return Voxels(data, dims, translate, scale, axis_order)
-    return Voxels(np.ascontiguousarray(data), dims, translate, scale, axis_order)
+    data = linear_index_to_coords(nz_voxels, dims, fix_coords)
+    axis_order = 'xyz' if fix_coords else 'xzy'
+    return Voxels(data, dims, translate, scale, axis_order)
 
-def dense_to_sparse(voxel_data, dtype=np.int):
+def dense_to_sparse(voxel_data, dtype=np.int64):
     """ From dense representation to sparse (coordinate) representation.
     No coordinate reordering.
     """
@@ -208,14 +311,14 @@ def dense_to_sparse(voxel_data, dtype=np.int):
         raise ValueError('voxel_data is wrong shape; should be 3D array.')
     return np.asarray(np.nonzero(voxel_data), dtype)
 
-def sparse_to_dense(voxel_data, dims, dtype=np.bool):
+def sparse_to_dense(voxel_data, dims, dtype=bool):
     if voxel_data.ndim!=2 or voxel_data.shape[0]!=3:
         raise ValueError('voxel_data is wrong shape; should be 3xN array.')
     if np.isscalar(dims):
         dims = [dims]*3
     dims = np.atleast_2d(dims).T
     # truncate to integers
-    xyz = voxel_data.astype(np.int)
+    xyz = voxel_data.astype(np.int64)
     # discard voxels that fall outside dims
     valid_ix = ~np.any((xyz < 0) | (xyz >= dims), 0)
     xyz = xyz[:,valid_ix]
@@ -229,55 +332,219 @@ def sparse_to_dense(voxel_data, dims, dtype=np.bool):
     #"""
     #return x*(dims[1]*dims[2]) + z*dims[1] + y
 
+def runs_to_rle(values, counts):
+    """ Encode runs of (value, count) as binvox RLE bytes.
+
+    Runs longer than 255 are split into several entries, as binvox stores
+    each count in a single byte. Zero-length runs are dropped.
+    """
+    values = np.asarray(values, dtype=np.uint8)
+    counts = np.asarray(counts, dtype=np.int64)
+    nonempty = counts > 0
+    values, counts = values[nonempty], counts[nonempty]
+    # number of 255-or-less pieces per run, all full except the last
+    pieces = (counts + 254) // 255
+    rle = np.empty((pieces.sum(), 2), dtype=np.uint8)
+    rle[:, 0] = np.repeat(values, pieces)
+    rle[:, 1] = 255
+    rle[np.cumsum(pieces) - 1, 1] = counts - 255 * (pieces - 1)
+    return rle.tobytes()
+
+def dense_to_rle(voxels_flat):
+    """ Encode a flat voxel array (in binvox xzy order) as binvox RLE bytes.
+
+    Runs are found from the positions where the value changes, without a
+    Python loop over voxels.
+    """
+    voxels_flat = np.asarray(voxels_flat, dtype=bool).ravel()
+    if voxels_flat.size == 0:
+        return b''
+    starts = np.flatnonzero(voxels_flat[1:] != voxels_flat[:-1]) + 1
+    starts = np.concatenate(([0], starts))
+    counts = np.diff(np.append(starts, voxels_flat.size))
+    return runs_to_rle(voxels_flat[starts], counts)
+
+def sparse_to_linear_index(voxel_data, dims, axis_order):
+    """ Sorted unique binvox (xzy) linear indices of the voxels in a 3xN
+    coordinate array. Voxels that fall outside dims are discarded, like in
+    sparse_to_dense.
+    """
+    if voxel_data.ndim!=2 or voxel_data.shape[0]!=3:
+        raise ValueError('voxel_data is wrong shape; should be 3xN array.')
+    # binvox stores x, then z, then y (y increasing fastest)
+    xzy = voxel_data.astype(np.int64)
+    if axis_order=='xyz':
+        xzy = xzy[[0, 2, 1]]
+    shape = np.array(dims, dtype=np.int64).reshape(3, 1)
+    valid_ix = ~np.any((xzy < 0) | (xzy >= shape), 0)
+    xzy = xzy[:, valid_ix]
+    return np.unique((xzy[0]*dims[1] + xzy[1])*dims[2] + xzy[2])
+
+def sparse_to_rle(voxel_data, dims, axis_order='xyz'):
+    """ Encode a 3xN coordinate array as binvox RLE bytes.
+
+    Works on the sorted linear indices of the occupied voxels, so memory is
+    proportional to the number of occupied voxels rather than the grid size.
+    """
+    return linear_index_to_rle(sparse_to_linear_index(voxel_data, dims, axis_order), dims)
+
+def linear_index_to_rle(indices, dims):
+    """ Encode sorted unique binvox (xzy) linear indices as binvox RLE bytes.
+    """
+    size = int(np.prod(dims))
+    if indices.size == 0:
+        return runs_to_rle([0], [size])
+    # runs of consecutive occupied voxels
+    breaks = np.flatnonzero(np.diff(indices) != 1) + 1
+    run_starts = indices[np.concatenate(([0], breaks))]
+    run_ends = indices[np.append(breaks - 1, indices.size - 1)] + 1
+    # interleave empty gaps and occupied runs: gap, run, gap, run, ..., gap
+    counts = np.empty(2*run_starts.size + 1, dtype=np.int64)
+    counts[0] = run_starts[0]
+    counts[2:-1:2] = run_starts[1:] - run_ends[:-1]
+    counts[1::2] = run_ends - run_starts
+    counts[-1] = size - run_ends[-1]
+    values = np.zeros(counts.size, dtype=np.uint8)
+    values[1::2] = 1
+    return runs_to_rle(values, counts)
+
+# number of set bits in every byte value
+POPCOUNT = np.unpackbits(np.arange(256, dtype=np.uint8).reshape(-1, 1), axis=1).sum(axis=1)
+
+def linear_index_to_bits(indices, size):
+    """ Packed bits (np.packbits order) of a grid with size voxels, from the
+    sorted unique linear indices of its occupied voxels.
+    """
+    bits = np.zeros((size + 7) // 8, dtype=np.uint8)
+    if indices.size == 0:
+        return bits
+    byte = indices >> 3
+    mask = (128 >> (indices & 7)).astype(np.uint8)
+    # indices are sorted, so the voxels of every byte are contiguous
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(byte)) + 1))
+    bits[byte[starts]] = np.bitwise_or.reduceat(mask, starts)
+    return bits
+
+def bits_to_linear_index(bits, size):
+    """ Sorted linear indices of the set bits. Only the non-zero bytes are
+    unpacked, so this is cheap for sparse grids.
+    """
+    nz_bytes = np.flatnonzero(bits)
+    occupied = np.unpackbits(bits[nz_bytes]).view(bool).reshape(-1, 8)
+    indices = (nz_bytes.reshape(-1, 1)*8 + np.arange(8))[occupied]
+    return indices[indices < size]
+
+def pack(voxel_model):
+    """ PackedVoxels from a Voxels model with dense, coordinate or linear
+    index data.
+    """
+    data = voxel_model.data
+    if data.ndim==3:
+        bits = np.packbits(data.astype(bool, copy=False), axis=None)
+        return PackedVoxels(bits, voxel_model.dims, voxel_model.translate, voxel_model.scale, voxel_model.axis_order)
+    if data.ndim==1:
+        # linear indices are in binvox order
+        indices, axis_order = data, 'xzy'
+    else:
+        axis_order = voxel_model.axis_order
+        packed = PackedVoxels(None, voxel_model.dims, voxel_model.translate, voxel_model.scale, axis_order)
+        xyz = data.astype(np.int64)
+        shape = np.array(packed.shape, dtype=np.int64).reshape(3, 1)
+        xyz = xyz[:, ~np.any((xyz < 0) | (xyz >= shape), 0)]
+        indices = np.unique(np.ravel_multi_index(tuple(xyz), packed.shape))
+    return PackedVoxels(linear_index_to_bits(indices, int(np.prod(voxel_model.dims))), voxel_model.dims
+                        , voxel_model.translate, voxel_model.scale, axis_order)
+
+def read_as_packed_array(fp, fix_coords=True):
+    """ Read binary binvox format as packed bits (1 bit per voxel).
+
+    The runs are decoded to linear indices and packed, the dense grid is never
+    materialized. See PackedVoxels.
+    """
+    model = read_as_coord_array(fp, fix_coords=False, linear_index=True)
+    dims, indices, axis_order = model.dims, model.data, 'xzy'
+    if fix_coords:
+        # reorder from binvox (x, z, y) to (x, y, z) layout
+        x, zwpy = np.divmod(indices, dims[1]*dims[2])
+        z, y = np.divmod(zwpy, dims[2])
+        del zwpy
+        indices = (x*dims[2] + y)*dims[1] + z
+        indices.sort()
+        axis_order = 'xyz'
+    return PackedVoxels(linear_index_to_bits(indices, int(np.prod(dims))), dims, model.translate, model.scale, axis_order)
+
+# On-disk packed format: a fixed size header followed by the packed bits
+# magic, version, dims, axis order, translate, scale, padded to 64 bytes
+PACKED_HEADER = struct.Struct('<4sI3I4s4d8x')
+PACKED_MAGIC = b'PVOX'
+PACKED_VERSION = 1
+
+def packed_record_size(dims):
+    """ Size in bytes of a packed record (header and bits) for a grid of dims. """
+    return PACKED_HEADER.size + (int(np.prod(dims)) + 7) // 8
+
+def write_packed(packed, fp):
+    """ Write a PackedVoxels model in the packed on-disk format. fp must be
+    opened in binary mode. Records can be concatenated in one file, see
+    read_packed. Returns the number of bytes written.
+    """
+    header = PACKED_HEADER.pack(PACKED_MAGIC, PACKED_VERSION, *packed.dims, packed.axis_order.encode('ascii')
+                                , *packed.translate, packed.scale)
+    fp.write(header)
+    fp.write(np.ascontiguousarray(packed.bits, dtype=np.uint8).tobytes())
+    return PACKED_HEADER.size + packed.bits.nbytes
+
+def read_packed(buffer, offset=0):
+    """ PackedVoxels from the packed record starting at offset in buffer, a
+    numpy uint8 array such as a np.memmap of a file. The bits are a view into
+    buffer, nothing is copied.
+    """
+    header = bytes(buffer[offset:offset + PACKED_HEADER.size])
+    if len(header) != PACKED_HEADER.size:
+        raise IOError('Truncated packed voxel record')
+    magic, version, d0, d1, d2, axis_order, t0, t1, t2, scale = PACKED_HEADER.unpack(header)
+    if magic != PACKED_MAGIC:
+        raise IOError('Not a packed voxel record')
+    if version != PACKED_VERSION:
+        raise IOError('Unsupported packed voxel version {}'.format(version))
+    dims = [d0, d1, d2]
+    start = offset + PACKED_HEADER.size
+    end = offset + packed_record_size(dims)
+    if end > buffer.shape[0]:
+        raise IOError('Truncated packed voxel record')
+    return PackedVoxels(buffer[start:end], dims, [t0, t1, t2], scale, axis_order.rstrip(b'\0').decode('ascii'))
+
+def open_packed(filename, offset=0, mode='r'):
+    """ Memory-map a packed voxel file and return the record at offset. """
+    return read_packed(np.memmap(filename, dtype=np.uint8, mode=mode), offset)
+
 def write(voxel_model, fp):
-    """ Write binary binvox format.
+    """ Write binary binvox format. fp must be opened in binary mode.
 
-    Note that when saving a model in sparse (coordinate) format, it is first
-    converted to dense format.
+    Models in sparse (coordinate or linear index) format are encoded directly
+    from their coordinates, without converting to dense format.
 
     Doesn't check if the model is 'sane'.
 
     """
-    if voxel_model.data.ndim==2:
-        # TODO avoid conversion to dense
-        dense_voxel_data = sparse_to_dense(voxel_model.data, voxel_model.dims)
-    else:
-        dense_voxel_data = voxel_model.data
-
-    fp.write('#binvox 1\n')
-    fp.write('dim '+' '.join(map(str, voxel_model.dims))+'\n')
-    fp.write('translate '+' '.join(map(str, voxel_model.translate))+'\n')
-    fp.write('scale '+str(voxel_model.scale)+'\n')
-    fp.write('data\n')
     if not voxel_model.axis_order in ('xzy', 'xyz'):
         raise ValueError('Unsupported voxel model axis order')
 
-    if voxel_model.axis_order=='xzy':
-        voxels_flat = dense_voxel_data.flatten()
-    elif voxel_model.axis_order=='xyz':
-        voxels_flat = np.transpose(dense_voxel_data, (0, 2, 1)).flatten()
-
-    # keep a sort of state machine for writing run length encoding
-    state = voxels_flat[0]
-    ctr = 0
-    for c in voxels_flat:
-        if c==state:
-            ctr += 1
-            # if ctr hits max, dump
-            if ctr==255:
-                fp.write(chr(state))
-                fp.write(chr(ctr))
-                ctr = 0
-        else:
-            # if switch state, dump
-            fp.write(chr(state))
-            fp.write(chr(ctr))
-            state = c
-            ctr = 1
-    # flush out remainders
-    if ctr > 0:
-        fp.write(chr(state))
-        fp.write(chr(ctr))
+    if voxel_model.data.ndim==1:
+        data = linear_index_to_rle(voxel_model.data, voxel_model.dims)
+    elif voxel_model.data.ndim==2:
+        data = sparse_to_rle(voxel_model.data, voxel_model.dims, voxel_model.axis_order)
+    elif voxel_model.axis_order=='xzy':
+        data = dense_to_rle(voxel_model.data)
+    else:
+        data = dense_to_rle(np.transpose(voxel_model.data, (0, 2, 1)))
+
+    header = '#binvox 1\n'
+    header += 'dim '+' '.join(map(str, voxel_model.dims))+'\n'
+    header += 'translate '+' '.join(map(str, voxel_model.translate))+'\n'
+    header += 'scale '+str(voxel_model.scale)+'\n'
+    header += 'data\n'
+    fp.write(header.encode('ascii') + data)
 
 if __name__ == '__main__':
     import doctest
@@ -1 +1,7 @@
-from .chamfer_distance import ChamferDistance
+import importlib
+
+def __getattr__(Name):
+    # Importing torch and compiling the extension only happen when ChamferDistance is used
+    if Name in ('ChamferDistance', 'ChamferDistanceFunction'):
+        return getattr(importlib.import_module('.chamfer_distance', __name__), Name)
+    raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, Name))
@@ -1,5 +1,9 @@
 #include <torch/torch.h>
+#include <ATen/Parallel.h>
+#include <algorithm>
+#include <vector>
 
+#ifdef WITH_CUDA
 // CUDA forward declarations
 int ChamferDistanceKernelLauncher(
     const int b, const int n,
@@ -54,6 +58,7 @@ void chamfer_distance_backward_cuda(
                                            graddist2.data<float>(), idx2.data<int>(),
                                            gradxyz1.data<float>(), gradxyz2.data<float>());
 }
+#endif
 
 
 void nnsearch(
@@ -87,6 +92,163 @@ void nnsearch(
 }
 
 
+// Balanced KD-tree over the target points with the points stored in tree order
+// Node [begin, end) splits at mid = (begin + end) / 2 along axis[mid], leaves have at most KDTREE_LEAF_SIZE points
+const int KDTREE_LEAF_SIZE = 8;
+
+struct KDTree {
+    std::vector<float> points; // tree order, 3 floats per point
+    std::vector<int> index;    // original index of each point in tree order
+    std::vector<unsigned char> axis;
+
+    KDTree(const float* xyz, const int m) : points(m*3), index(m), axis(m, 0) {
+        for (int k = 0; k < m; k++)
+            index[k] = k;
+        build(xyz, 0, m);
+        for (int k = 0; k < m; k++)
+            for (int a = 0; a < 3; a++)
+                points[k*3+a] = xyz[index[k]*3+a];
+    }
+
+    void build(const float* xyz, const int begin, const int end) {
+        if (end - begin <= KDTREE_LEAF_SIZE)
+            return;
+        // Split along the axis with the largest extent
+        float lo[3] = {xyz[index[begin]*3+0], xyz[index[begin]*3+1], xyz[index[begin]*3+2]};
+        float hi[3] = {lo[0], lo[1], lo[2]};
+        for (int k = begin + 1; k < end; k++)
+            for (int a = 0; a < 3; a++) {
+                lo[a] = std::min(lo[a], xyz[index[k]*3+a]);
+                hi[a] = std::max(hi[a], xyz[index[k]*3+a]);
+            }
+        int a = 0;
+        if (hi[1] - lo[1] > hi[a] - lo[a]) a = 1;
+        if (hi[2] - lo[2] > hi[a] - lo[a]) a = 2;
+
+        const int mid = (begin + end) / 2;
+        std::nth_element(index.begin() + begin, index.begin() + mid, index.begin() + end,
+                         [xyz, a](const int i, const int j) { return xyz[i*3+a] < xyz[j*3+a]; });
+        axis[mid] = (unsigned char)a;
+        build(xyz, begin, mid);
+        build(xyz, mid + 1, end);
+    }
+
+    // Same distances and tie-breaking (lowest index) as nnsearch
+    inline void check(const float* q, const int k, double& best, int& besti) const {
+        const float x2 = points[k*3+0] - q[0];
+        const float y2 = points[k*3+1] - q[1];
+        const float z2 = points[k*3+2] - q[2];
+        const double d=x2*x2+y2*y2+z2*z2;
+        if (besti < 0 || d < best || (d == best && index[k] < besti)) {
+            best = d;
+            besti = index[k];
+        }
+    }
+
+    void search(const float* q, const int begin, const int end, double& best, int& besti) const {
+        if (end - begin <= KDTREE_LEAF_SIZE) {
+            for (int k = begin; k < end; k++)
+                check(q, k, best, besti);
+            return;
+        }
+        const int mid = (begin + end) / 2;
+        const int a = axis[mid];
+        check(q, mid, best, besti);
+        // Computed in float like the distances, so the far side is only skipped if none of its points can be closer
+        const float diff = q[a] - points[mid*3+a];
+        const double diff2 = diff*diff;
+        if (diff < 0) {
+            search(q, begin, mid, best, besti);
+            if (diff2 <= best)
+                search(q, mid + 1, end, best, besti);
+        } else {
+            search(q, mid + 1, end, best, besti);
+            if (diff2 <= best)
+                search(q, begin, mid, best, besti);
+        }
+    }
+};
+
+void nnsearch_kdtree_item(
+    const int n, const int m,
+    const float* xyz1,
+    const float* xyz2,
+    float* dist,
+    int* idx)
+{
+    const KDTree tree(xyz2, m);
+    // Queries are independent, split them across threads
+    at::parallel_for(0, n, 256, [&](int64_t start, int64_t end) {
+        for (int64_t j = start; j < end; j++) {
+            double best = 0;
+            int besti = -1;
+            tree.search(xyz1 + j*3, 0, m, best, besti);
+            dist[j] = best;
+            idx[j] = besti;
+        }
+    });
+}
+
+void nnsearch_kdtree(
+    const int b, const int n, const int m,
+    const float* xyz1,
+    const float* xyz2,
+    float* dist,
+    int* idx)
+{
+    for (int i = 0; i < b; i++)
+        nnsearch_kdtree_item(n, m, xyz1 + i*n*3, xyz2 + i*m*3, dist + i*n, idx + i*n);
+}
+
+
+void chamfer_distance_forward_kdtree(
+    const at::Tensor xyz1,
+    const at::Tensor xyz2,
+    const at::Tensor dist1,
+    const at::Tensor dist2,
+    const at::Tensor idx1,
+    const at::Tensor idx2)
+{
+    const int batchsize = xyz1.size(0);
+    const int n = xyz1.size(1);
+    const int m = xyz2.size(1);
+
+    nnsearch_kdtree(batchsize, n, m, xyz1.data<float>(), xyz2.data<float>(), dist1.data<float>(), idx1.data<int>());
+    nnsearch_kdtree(batchsize, m, n, xyz2.data<float>(), xyz1.data<float>(), dist2.data<float>(), idx2.data<int>());
+}
+
+
+// Ragged batches: xyz1 and xyz2 are packed (P x 3), item i owns points offsets[i] to offsets[i+1]
+// Indices are relative to the item's first point, like in the padded layout. Items must not be empty
+void chamfer_distance_forward_kdtree_packed(
+    const at::Tensor xyz1,
+    const at::Tensor offsets1,
+    const at::Tensor xyz2,
+    const at::Tensor offsets2,
+    const at::Tensor dist1,
+    const at::Tensor dist2,
+    const at::Tensor idx1,
+    const at::Tensor idx2)
+{
+    const int batchsize = offsets1.size(0) - 1;
+    const int64_t* o1 = offsets1.data<int64_t>();
+    const int64_t* o2 = offsets2.data<int64_t>();
+    const float* xyz1_data = xyz1.data<float>();
+    const float* xyz2_data = xyz2.data<float>();
+    float* dist1_data = dist1.data<float>();
+    float* dist2_data = dist2.data<float>();
+    int* idx1_data = idx1.data<int>();
+    int* idx2_data = idx2.data<int>();
+
+    for (int i = 0; i < batchsize; i++) {
+        const int n = o1[i+1] - o1[i];
+        const int m = o2[i+1] - o2[i];
+        nnsearch_kdtree_item(n, m, xyz1_data + o1[i]*3, xyz2_data + o2[i]*3, dist1_data + o1[i], idx1_data + o1[i]);
+        nnsearch_kdtree_item(m, n, xyz2_data + o2[i]*3, xyz1_data + o1[i]*3, dist2_data + o2[i], idx2_data + o2[i]);
+    }
+}
+
+
 void chamfer_distance_forward(
     const at::Tensor xyz1, 
     const at::Tensor xyz2, 
@@ -179,7 +341,11 @@ void chamfer_distance_backward(
 
 PYBIND11_MODULE(TORCH_EXTENSION_NAME, m) {
     m.def("forward", &chamfer_distance_forward, "ChamferDistance forward");
-    m.def("forward_cuda", &chamfer_distance_forward_cuda, "ChamferDistance forward (CUDA)");
+    m.def("forward_kdtree", &chamfer_distance_forward_kdtree, "ChamferDistance forward (KD-tree, multithreaded)");
+    m.def("forward_kdtree_packed", &chamfer_distance_forward_kdtree_packed, "ChamferDistance forward on packed ragged batches (KD-tree, multithreaded)");
     m.def("backward", &chamfer_distance_backward, "ChamferDistance backward");
+#ifdef WITH_CUDA
+    m.def("forward_cuda", &chamfer_distance_forward_cuda, "ChamferDistance forward (CUDA)");
     m.def("backward_cuda", &chamfer_distance_backward_cuda, "ChamferDistance backward (CUDA)");
+#endif
 }
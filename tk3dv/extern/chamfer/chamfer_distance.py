@@ -1,16 +1,179 @@
 import torch
-from torch.utils.cpp_extension import load
-import os
+from torch.utils.cpp_extension import load, CUDA_HOME
+import os, sys
 FileDirPath = os.path.dirname(os.path.realpath(__file__))
-print('[ INFO ]: Chamfer directory:', FileDirPath)
 
-# cd = load(name='cd', sources=[os.path.join(FileDirPath, 'chamfer_distance.cpp')])
-# if torch.cuda.is_available():
-cd = load(name='cd', sources=[os.path.join(FileDirPath, 'chamfer_distance.cpp'), os.path.join(FileDirPath, 'chamfer_distance.cu')])
+# The extension is compiled (or loaded from the torch extensions cache) on first use instead of at import
+Extension = None
+ExtensionError = None # Set if building or loading the extension failed
+
+def getExtension():
+    global Extension
+    if Extension is None:
+        print('[ INFO ]: Chamfer directory:', FileDirPath)
+        # The CUDA kernels are only built if a CUDA toolkit is available, the CPU functions are always built
+        # OpenMP is used by the multithreaded KD-tree search
+        OpenMPFlags = ['/openmp'] if sys.platform == 'win32' else ['-fopenmp']
+        if torch.cuda.is_available() and CUDA_HOME is not None:
+            Extension = load(name='cd', sources=[os.path.join(FileDirPath, 'chamfer_distance.cpp'), os.path.join(FileDirPath, 'chamfer_distance.cu')]
+                             , extra_cflags=['-DWITH_CUDA'] + OpenMPFlags, extra_ldflags=OpenMPFlags)
+        else:
+            Extension = load(name='cd_cpu', sources=[os.path.join(FileDirPath, 'chamfer_distance.cpp')], extra_cflags=OpenMPFlags, extra_ldflags=OpenMPFlags)
+    return Extension
+
+def isExtensionAvailable(isCUDA=False):
+    # Tries to build/load the extension once. isCUDA: also require the CUDA kernels
+    global ExtensionError
+    if Extension is None and ExtensionError is None:
+        try:
+            getExtension()
+        except Exception as e:
+            ExtensionError = e
+            print('[ WARN ]: Chamfer extension unavailable, falling back to the PyTorch implementation:', e)
+    return Extension is not None and (not isCUDA or hasattr(Extension, 'forward_cuda'))
+
+def nnsearch_torch(xyz1, xyz2, chunk_size=2048, lengths1=None, lengths2=None):
+    # Index of the nearest point in xyz2 for every point in xyz1 (b x n, int64)
+    # Distances are computed in chunk_size x chunk_size blocks with a running minimum, so memory is O(b * chunk_size^2)
+    # lengths1, lengths2: valid points per item of padded batches. Padding is never picked as a neighbor and padding queries get index 0
+    with torch.no_grad():
+        batchsize, n, _ = xyz1.size()
+        m = xyz2.size(1)
+        idx = torch.zeros(batchsize, n, dtype=torch.long, device=xyz1.device)
+        # Blocks that are padding in every item are skipped. Padding targets are moved far away instead of masking every block,
+        # their squared distances stay finite so any valid point is closer
+        if lengths1 is not None:
+            n = int(lengths1.max())
+        if lengths2 is not None:
+            m = int(lengths2.max())
+            isPadding = torch.arange(xyz2.size(1), device=xyz2.device).unsqueeze(0) >= lengths2.unsqueeze(1)
+            xyz2 = xyz2.masked_fill(isPadding.unsqueeze(-1), torch.finfo(xyz2.dtype).max ** 0.5 / 4)
+        for i in range(0, n, chunk_size):
+            best, besti = None, None
+            for k in range(0, m, chunk_size):
+                dist, disti = torch.cdist(xyz1[:, i:min(i+chunk_size, n)], xyz2[:, k:min(k+chunk_size, m)]).min(dim=2)
+                if best is None:
+                    best, besti = dist, disti
+                else:
+                    isCloser = dist < best # Strict, so ties keep the lowest index like the extension
+                    best = torch.where(isCloser, dist, best)
+                    besti = torch.where(isCloser, disti + k, besti)
+            idx[:, i:i+besti.size(1)] = besti
+        if lengths1 is not None:
+            idx.masked_fill_(torch.arange(idx.size(1), device=idx.device).unsqueeze(0) >= lengths1.unsqueeze(1), 0)
+    return idx
+
+def chamfer_distance_torch(xyz1, xyz2, chunk_size=2048):
+    # Pure PyTorch chamfer distance, needs no compilation and works on any device. Returns squared distances like the extension
+    # Gradients come from autograd through the gathered nearest neighbors, which matches the extension's backward pass
+    # Blocks use torch.cdist's matrix product form, so for near-ties (within float precision) a different neighbor can be picked
+    idx1 = nnsearch_torch(xyz1, xyz2, chunk_size)
+    idx2 = nnsearch_torch(xyz2, xyz1, chunk_size)
+    dist1 = (xyz1 - torch.gather(xyz2, 1, idx1.unsqueeze(-1).expand(-1, -1, 3))).pow(2).sum(dim=-1)
+    dist2 = (xyz2 - torch.gather(xyz1, 1, idx2.unsqueeze(-1).expand(-1, -1, 3))).pow(2).sum(dim=-1)
+    return dist1, dist2
+
+def lengths_to_offsets(lengths):
+    return torch.cat([lengths.new_zeros(1), lengths.cumsum(0)])
+
+def packed_indices(lengths, offsets):
+    # Item and position within the item of every packed point, so padded[item, pos] is the packed batch
+    item = torch.repeat_interleave(torch.arange(lengths.size(0), device=lengths.device), lengths)
+    pos = torch.arange(item.size(0), device=lengths.device) - offsets[item]
+    return item, pos
+
+def bucket_items(lengths1, lengths2, max_padding=2.0):
+    # Groups items of similar size so every group can be searched padded to its own largest item
+    # Items are sorted by size and a group is closed once its padded work (items * max n * max m) would exceed max_padding times the actual work
+    work = (lengths1 * lengths2).tolist()
+    l1, l2 = lengths1.tolist(), lengths2.tolist()
+    buckets, bucket = [], []
+    for i in sorted(range(len(work)), key=lambda i: work[i]):
+        candidate = bucket + [i]
+        padded = len(candidate) * max(l1[j] for j in candidate) * max(l2[j] for j in candidate)
+        if len(bucket) > 0 and padded > max_padding * sum(work[j] for j in candidate):
+            buckets.append(bucket)
+            candidate = [i]
+        bucket = candidate
+    buckets.append(bucket)
+    return [torch.tensor(b, device=lengths1.device) for b in buckets]
+
+def chamfer_distance_ragged(xyz1, xyz2, lengths1=None, lengths2=None, offsets1=None, offsets2=None, chunk_size=2048, use_extension=False):
+    # Chamfer distance of a batch whose items have different numbers of points, given either
+    # padded (b x n x 3 and b x m x 3 with lengths1, lengths2) or packed (P1 x 3 and P2 x 3 with offsets1, offsets2 of size b+1)
+    # Returns dist1, dist2 in the input layout, zero at padding. Gradients come from autograd like chamfer_distance_torch
+    # use_extension: search with the KD-tree extension on the packed points (CPU only), otherwise with nnsearch_torch on groups of similar sized items
+    isPacked = offsets1 is not None
+    with torch.no_grad():
+        if isPacked:
+            lengths1, lengths2 = offsets1[1:] - offsets1[:-1], offsets2[1:] - offsets2[:-1]
+        else:
+            offsets1, offsets2 = lengths_to_offsets(lengths1), lengths_to_offsets(lengths2)
+        item1, pos1 = packed_indices(lengths1, offsets1)
+        item2, pos2 = packed_indices(lengths2, offsets2)
+
+        if use_extension:
+            packed1 = (xyz1 if isPacked else xyz1[item1, pos1]).detach().contiguous()
+            packed2 = (xyz2 if isPacked else xyz2[item2, pos2]).detach().contiguous()
+            idx1, idx2 = torch.zeros(packed1.size(0), dtype=torch.int), torch.zeros(packed2.size(0), dtype=torch.int)
+            getExtension().forward_kdtree_packed(packed1, offsets1.cpu(), packed2, offsets2.cpu()
+                                                 , torch.zeros(packed1.size(0)), torch.zeros(packed2.size(0)), idx1, idx2)
+            idx1, idx2 = idx1.long(), idx2.long()
+            if not isPacked:
+                idx1 = xyz1.new_zeros(xyz1.shape[:2], dtype=torch.long).index_put_((item1, pos1), idx1)
+                idx2 = xyz2.new_zeros(xyz2.shape[:2], dtype=torch.long).index_put_((item2, pos2), idx2)
+        else:
+            if isPacked:
+                padded1 = xyz1.new_zeros(lengths1.size(0), int(lengths1.max()), 3).index_put_((item1, pos1), xyz1)
+                padded2 = xyz2.new_zeros(lengths2.size(0), int(lengths2.max()), 3).index_put_((item2, pos2), xyz2)
+            else:
+                padded1, padded2 = xyz1, xyz2
+            idx1 = torch.zeros(padded1.shape[:2], dtype=torch.long, device=padded1.device)
+            idx2 = torch.zeros(padded2.shape[:2], dtype=torch.long, device=padded2.device)
+            # Batched torch.cdist is slower than per item calls on CPU, so there only items of equal size are grouped
+            for bucket in bucket_items(lengths1, lengths2, 2.0 if xyz1.is_cuda else 1.0):
+                n, m = int(lengths1[bucket].max()), int(lengths2[bucket].max())
+                bucket1, bucket2 = padded1[bucket, :n], padded2[bucket, :m]
+                idx1[bucket, :n] = nnsearch_torch(bucket1, bucket2, chunk_size, lengths1[bucket], lengths2[bucket])
+                idx2[bucket, :m] = nnsearch_torch(bucket2, bucket1, chunk_size, lengths2[bucket], lengths1[bucket])
+            if isPacked:
+                idx1, idx2 = idx1[item1, pos1], idx2[item2, pos2]
+
+    if isPacked:
+        dist1 = (xyz1 - xyz2[offsets2[item1] + idx1]).pow(2).sum(dim=-1)
+        dist2 = (xyz2 - xyz1[offsets1[item2] + idx2]).pow(2).sum(dim=-1)
+        return dist1, dist2
+    isPadding1 = torch.arange(xyz1.size(1), device=xyz1.device).unsqueeze(0) >= lengths1.unsqueeze(1)
+    isPadding2 = torch.arange(xyz2.size(1), device=xyz2.device).unsqueeze(0) >= lengths2.unsqueeze(1)
+    dist1 = (xyz1 - torch.gather(xyz2, 1, idx1.unsqueeze(-1).expand(-1, -1, 3))).pow(2).sum(dim=-1).masked_fill(isPadding1, 0)
+    dist2 = (xyz2 - torch.gather(xyz1, 1, idx2.unsqueeze(-1).expand(-1, -1, 3))).pow(2).sum(dim=-1).masked_fill(isPadding2, 0)
+    return dist1, dist2
+
+def item_mean(dist, lengths=None, offsets=None):
+    # Mean over the valid points of every item (b)
+    if offsets is not None:
+        lengths = offsets[1:] - offsets[:-1]
+        item, _ = packed_indices(lengths, offsets)
+        return dist.new_zeros(lengths.size(0)).index_add(0, item, dist) / lengths
+    if lengths is not None:
+        return dist.sum(dim=1) / lengths
+    return dist.mean(dim=1)
+
+# 'auto' uses the extension if it can be built and supports the device, and the PyTorch implementation otherwise
+BACKENDS = ['auto', 'extension', 'torch']
+
+# 'none': per point distances dist1, dist2 in the input layout. 'per_item': mean(dist1) + mean(dist2) of every item (b)
+# 'mean', 'sum': mean or sum of the per item distances over the batch
+REDUCTIONS = ['none', 'per_item', 'mean', 'sum']
+
+# CPU nearest neighbor search: 'kdtree' (KD-tree on the target points, queries run on torch.get_num_threads() threads)
+# or 'bruteforce' (O(N*M), single thread). Both return the same distances and indices
+CPU_BACKENDS = ['kdtree', 'bruteforce']
 
 class ChamferDistanceFunction(torch.autograd.Function):
     @staticmethod
-    def forward(ctx, xyz1, xyz2):
+    def forward(ctx, xyz1, xyz2, cpu_backend='kdtree'):
+        cd = getExtension()
         with torch.autograd.set_detect_anomaly(True):
             batchsize, n, _ = xyz1.size()
             _, m, _ = xyz2.size()
@@ -23,7 +186,12 @@ class ChamferDistanceFunction(torch.autograd.Function):
             idx2 = torch.zeros(batchsize, m, dtype=torch.int)
 
             if not xyz1.is_cuda:
-                cd.forward(xyz1, xyz2, dist1, dist2, idx1, idx2)
+                if cpu_backend not in CPU_BACKENDS:
+                    raise RuntimeError('[ ERR ]: Unknown CPU backend {}, expected one of {}.'.format(cpu_backend, CPU_BACKENDS))
+                if cpu_backend == 'kdtree':
+                    cd.forward_kdtree(xyz1, xyz2, dist1, dist2, idx1, idx2)
+                else:
+                    cd.forward(xyz1, xyz2, dist1, dist2, idx1, idx2)
             else:
                 dist1 = dist1.cuda()
                 dist2 = dist2.cuda()
@@ -37,6 +205,7 @@ class ChamferDistanceFunction(torch.autograd.Function):
 
     @staticmethod
     def backward(ctx, graddist1, graddist2):
+        cd = getExtension()
         with torch.autograd.set_detect_anomaly(True):
             xyz1, xyz2, idx1, idx2 = ctx.saved_tensors
 
@@ -53,9 +222,66 @@ class ChamferDistanceFunction(torch.autograd.Function):
                 gradxyz2 = gradxyz2.cuda()
                 cd.backward_cuda(xyz1, xyz2, gradxyz1, gradxyz2, graddist1, graddist2, idx1, idx2)
 
-            return gradxyz1, gradxyz2
+            return gradxyz1, gradxyz2, None
 
 
 class ChamferDistance(torch.nn.Module):
-    def forward(self, xyz1, xyz2):
-        return ChamferDistanceFunction.apply(xyz1, xyz2)
+    # backend: 'auto', 'extension' or 'torch' (see BACKENDS). cpu_backend: search used by the extension on CPU (see CPU_BACKENDS)
+    # chunk_size: block size of the PyTorch implementation, peak memory is about batch size * chunk_size^2 * 4 bytes
+    # reduction: default reduction (see REDUCTIONS), can be overridden per call
+    def __init__(self, cpu_backend='kdtree', backend='auto', chunk_size=2048, reduction='none'):
+        super().__init__()
+        if cpu_backend not in CPU_BACKENDS:
+            raise RuntimeError('[ ERR ]: Unknown CPU backend {}, expected one of {}.'.format(cpu_backend, CPU_BACKENDS))
+        if backend not in BACKENDS:
+            raise RuntimeError('[ ERR ]: Unknown backend {}, expected one of {}.'.format(backend, BACKENDS))
+        if reduction not in REDUCTIONS:
+            raise RuntimeError('[ ERR ]: Unknown reduction {}, expected one of {}.'.format(reduction, REDUCTIONS))
+        self.cpu_backend = cpu_backend
+        self.backend = backend
+        self.chunk_size = chunk_size
+        self.reduction = reduction
+
+    def forward(self, xyz1, xyz2, lengths1=None, lengths2=None, offsets1=None, offsets2=None, reduction=None):
+        # Batches with different point counts per item are passed either padded (b x n x 3) with lengths1 and/or lengths2 (b),
+        # where missing lengths mean all points are valid, or packed (P x 3) with offsets1 and offsets2 (b+1). Items must not be empty
+        reduction = self.reduction if reduction is None else reduction
+        if reduction not in REDUCTIONS:
+            raise RuntimeError('[ ERR ]: Unknown reduction {}, expected one of {}.'.format(reduction, REDUCTIONS))
+        if (offsets1 is None) != (offsets2 is None):
+            raise RuntimeError('[ ERR ]: Packed batches need both offsets1 and offsets2.')
+        isPacked = offsets1 is not None
+        isPadded = lengths1 is not None or lengths2 is not None
+        if isPacked and isPadded:
+            raise RuntimeError('[ ERR ]: Pass either lengths (padded batch) or offsets (packed batch), not both.')
+
+        isTorch = self.backend == 'torch' or (self.backend == 'auto' and not isExtensionAvailable(xyz1.is_cuda))
+        if isPacked or isPadded:
+            if isPacked:
+                offsets1, offsets2 = offsets1.to(xyz1.device, torch.long), offsets2.to(xyz2.device, torch.long)
+                if offsets1.size(0) != offsets2.size(0) or int(offsets1[-1]) != xyz1.size(0) or int(offsets2[-1]) != xyz2.size(0):
+                    raise RuntimeError('[ ERR ]: Offsets do not match the packed point clouds.')
+                lengths = torch.cat([offsets1[1:] - offsets1[:-1], offsets2[1:] - offsets2[:-1]])
+            else:
+                lengths1 = torch.full((xyz1.size(0),), xyz1.size(1), dtype=torch.long, device=xyz1.device) if lengths1 is None else lengths1.to(xyz1.device, torch.long)
+                lengths2 = torch.full((xyz2.size(0),), xyz2.size(1), dtype=torch.long, device=xyz2.device) if lengths2 is None else lengths2.to(xyz2.device, torch.long)
+                if int(lengths1.max()) > xyz1.size(1) or int(lengths2.max()) > xyz2.size(1):
+                    raise RuntimeError('[ ERR ]: Lengths exceed the padded point clouds.')
+                lengths = torch.cat([lengths1, lengths2])
+            if int(lengths.min()) < 1:
+                raise RuntimeError('[ ERR ]: Chamfer distance is undefined for empty point clouds.')
+            # The extension only has a ragged search on CPU (always the KD-tree, which matches brute force), CUDA batches use PyTorch
+            dist1, dist2 = chamfer_distance_ragged(xyz1, xyz2, lengths1, lengths2, offsets1, offsets2, self.chunk_size, use_extension=not isTorch and not xyz1.is_cuda)
+        elif isTorch:
+            dist1, dist2 = chamfer_distance_torch(xyz1, xyz2, self.chunk_size)
+        else:
+            dist1, dist2 = ChamferDistanceFunction.apply(xyz1, xyz2, self.cpu_backend)
+
+        if reduction == 'none':
+            return dist1, dist2
+        dist = item_mean(dist1, lengths1, offsets1) + item_mean(dist2, lengths2, offsets2)
+        if reduction == 'mean':
+            return dist.mean()
+        if reduction == 'sum':
+            return dist.sum()
+        return dist
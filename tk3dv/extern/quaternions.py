@@ -28,8 +28,8 @@ they are applied on the left of the vector.  For example:
 import math
 import numpy as np
 
-MAX_FLOAT = np.maximum_sctype(np.float)
-FLOAT_EPS = np.finfo(np.float).eps
+MAX_FLOAT = np.maximum_sctype(np.float64)
+FLOAT_EPS = np.finfo(np.float64).eps
 
 
 def fillpositive(xyz, w2_thresh=None):
@@ -492,3 +492,325 @@ def quat2angle_axis(quat, identity_thresh=None):
         # if vec is nearly 0,0,0, this is an identity rotation
         return 0.0, np.array([1.0, 0, 0])
     return  2 * math.acos(w), vec / n
+
+
+# Batched versions of the functions above. They take arrays of quaternions
+# (..., 4), vectors (..., 3) and matrices (..., 3, 3) and broadcast over the
+# leading dimensions, so a whole trajectory or set of rotations is converted
+# without a Python loop. Results match the single quaternion functions.
+
+def _as_float_array(a):
+    a = np.asarray(a)
+    if not np.issubdtype(a.dtype, np.floating):
+        a = a.astype(np.float64)
+    return a
+
+
+def quat2mat_batch(q):
+    ''' Rotation matrices of quaternions, vectorized `quat2mat`
+
+    Parameters
+    ----------
+    q : (..., 4) array-like
+       w, x, y, z of quaternions
+
+    Returns
+    -------
+    M : (..., 3, 3) array
+      Rotation matrices. Quaternions with norm below ``FLOAT_EPS`` give the
+      identity, like `quat2mat`
+
+    Examples
+    --------
+    >>> M = quat2mat_batch([[1, 0, 0, 0], [0, 1, 0, 0]])
+    >>> np.allclose(M, [np.eye(3), np.diag([1, -1, -1])])
+    True
+    '''
+    q = _as_float_array(q)
+    w, x, y, z = np.moveaxis(q, -1, 0)
+    Nq = w*w + x*x + y*y + z*z
+    isvalid = Nq >= FLOAT_EPS
+    s = np.where(isvalid, 2.0 / np.where(isvalid, Nq, 1.0), 0.0)
+    X = x*s; Y = y*s; Z = z*s
+    wX = w*X; wY = w*Y; wZ = w*Z
+    xX = x*X; xY = x*Y; xZ = x*Z
+    yY = y*Y; yZ = y*Z; zZ = z*Z
+    M = np.empty(q.shape[:-1] + (3, 3), dtype=q.dtype)
+    M[..., 0, 0] = 1.0-(yY+zZ); M[..., 0, 1] = xY-wZ; M[..., 0, 2] = xZ+wY
+    M[..., 1, 0] = xY+wZ; M[..., 1, 1] = 1.0-(xX+zZ); M[..., 1, 2] = yZ-wX
+    M[..., 2, 0] = xZ-wY; M[..., 2, 1] = yZ+wX; M[..., 2, 2] = 1.0-(xX+yY)
+    return M
+
+
+def mat2quat_batch(M):
+    ''' Quaternions of rotation matrices, vectorized `mat2quat`
+
+    Uses the same eigenvector method as `mat2quat`, with one batched
+    Hermitian eigendecomposition.
+
+    Parameters
+    ----------
+    M : (..., 3, 3) array-like
+      Rotation matrices
+
+    Returns
+    -------
+    q : (..., 4) array
+      Closest quaternions to the input matrices, having positive q[..., 0]
+    '''
+    M = _as_float_array(M)
+    Qxx, Qyx, Qzx = M[..., 0, 0], M[..., 0, 1], M[..., 0, 2]
+    Qxy, Qyy, Qzy = M[..., 1, 0], M[..., 1, 1], M[..., 1, 2]
+    Qxz, Qyz, Qzz = M[..., 2, 0], M[..., 2, 1], M[..., 2, 2]
+    # Only the lower half of the symmetric matrix is used by eigh
+    K = np.zeros(M.shape[:-2] + (4, 4), dtype=M.dtype)
+    K[..., 0, 0] = Qxx - Qyy - Qzz
+    K[..., 1, 0] = Qyx + Qxy; K[..., 1, 1] = Qyy - Qxx - Qzz
+    K[..., 2, 0] = Qzx + Qxz; K[..., 2, 1] = Qzy + Qyz; K[..., 2, 2] = Qzz - Qxx - Qyy
+    K[..., 3, 0] = Qyz - Qzy; K[..., 3, 1] = Qzx - Qxz; K[..., 3, 2] = Qxy - Qyx; K[..., 3, 3] = Qxx + Qyy + Qzz
+    K /= 3.0
+    vals, vecs = np.linalg.eigh(K)
+    # Select largest eigenvector, reorder to w,x,y,z quaternion
+    best = np.argmax(vals, axis=-1)[..., np.newaxis, np.newaxis]
+    q = np.take_along_axis(vecs, best, axis=-1)[..., [3, 0, 1, 2], 0]
+    # Prefer quaternion with positive w
+    return np.where(q[..., :1] < 0, -q, q)
+
+
+def mult_batch(q1, q2):
+    ''' Multiply quaternions, vectorized `mult`
+
+    Parameters
+    ----------
+    q1 : (..., 4) array-like
+    q2 : (..., 4) array-like
+
+    Returns
+    -------
+    q12 : (..., 4) array
+       Broadcast products of `q1` and `q2`
+    '''
+    w1, x1, y1, z1 = np.moveaxis(_as_float_array(q1), -1, 0)
+    w2, x2, y2, z2 = np.moveaxis(_as_float_array(q2), -1, 0)
+    w = w1*w2 - x1*x2 - y1*y2 - z1*z2
+    x = w1*x2 + x1*w2 + y1*z2 - z1*y2
+    y = w1*y2 + y1*w2 + z1*x2 - x1*z2
+    z = w1*z2 + z1*w2 + x1*y2 - y1*x2
+    return np.stack([w, x, y, z], axis=-1)
+
+
+def conjugate_batch(q):
+    ''' Conjugates of quaternions (..., 4), vectorized `conjugate` '''
+    return _as_float_array(q) * np.array([1.0, -1, -1, -1])
+
+
+def norm_batch(q):
+    ''' Norms of quaternions (..., 4), vectorized `norm` '''
+    q = _as_float_array(q)
+    return np.einsum('...i,...i->...', q, q)
+
+
+def inverse_batch(q):
+    ''' Multiplicative inverses of quaternions (..., 4), vectorized `inverse` '''
+    return conjugate_batch(q) / norm_batch(q)[..., np.newaxis]
+
+
+def rotate_vector_batch(v, q):
+    ''' Apply the rotations in quaternions `q` to vectors `v`, vectorized
+    `rotate_vector`
+
+    Parameters
+    ----------
+    v : (..., 3) array-like
+       3 dimensional vectors
+    q : (..., 4) array-like
+       w, i, j, k of quaternions
+
+    Returns
+    -------
+    vdash : (..., 3) array
+       Broadcast `v` rotated by `q`
+
+    Notes
+    -----
+    Uses the expanded product q v q* = (w^2 - |u|^2) v + 2 (u.v) u + 2 w (u x v)
+    with u = (x, y, z), which is exact for non-unit quaternions like
+    `rotate_vector`
+    '''
+    v = _as_float_array(v)
+    q = _as_float_array(q)
+    w, u = q[..., :1], q[..., 1:]
+    return ((w*w - np.sum(u*u, axis=-1, keepdims=True)) * v
+            + 2 * np.sum(u*v, axis=-1, keepdims=True) * u
+            + 2 * w * np.cross(u, v))
+
+
+def angle_axis2quat_batch(theta, vector, is_normalized=False):
+    ''' Quaternions for rotations of angles `theta` around `vector`,
+    vectorized `angle_axis2quat`
+
+    Parameters
+    ----------
+    theta : scalar or (...) array-like
+       angles of rotation
+    vector : (..., 3) array-like
+       vectors specifying axes for rotation
+    is_normalized : bool, optional
+       True if the vectors are already normalized. Default False
+
+    Returns
+    -------
+    quat : (..., 4) array
+       quaternions giving the specified rotations
+    '''
+    vector = _as_float_array(vector)
+    if not is_normalized:
+        vector = vector / np.sqrt(np.sum(vector*vector, axis=-1, keepdims=True))
+    t2 = _as_float_array(theta)[..., np.newaxis] / 2.0
+    vector, t2 = np.broadcast_arrays(vector, t2)
+    return np.concatenate((np.cos(t2[..., :1]), vector * np.sin(t2)), axis=-1)
+
+
+def angle_axis2mat_batch(theta, vector, is_normalized=False):
+    ''' Rotation matrices of angles `theta` around `vector`, vectorized
+    `angle_axis2mat`
+
+    Parameters
+    ----------
+    theta : scalar or (...) array-like
+       angles of rotation
+    vector : (..., 3) array-like
+       vectors specifying axes for rotation
+    is_normalized : bool, optional
+       True if the vectors are already normalized. Default False
+
+    Returns
+    -------
+    mat : (..., 3, 3) array
+       rotation matrices of the specified rotations
+    '''
+    vector = _as_float_array(vector)
+    if not is_normalized:
+        vector = vector / np.sqrt(np.sum(vector*vector, axis=-1, keepdims=True))
+    theta = _as_float_array(theta)
+    x, y, z = np.moveaxis(vector, -1, 0)
+    c = np.cos(theta); s = np.sin(theta); C = 1-c
+    xs = x*s;   ys = y*s;   zs = z*s
+    xC = x*C;   yC = y*C;   zC = z*C
+    xyC = x*yC; yzC = y*zC; zxC = z*xC
+    M = np.empty(np.broadcast(x, theta).shape + (3, 3), dtype=np.result_type(vector, theta))
+    M[..., 0, 0] = x*xC+c; M[..., 0, 1] = xyC-zs; M[..., 0, 2] = zxC+ys
+    M[..., 1, 0] = xyC+zs; M[..., 1, 1] = y*yC+c; M[..., 1, 2] = yzC-xs
+    M[..., 2, 0] = zxC-ys; M[..., 2, 1] = yzC+xs; M[..., 2, 2] = z*zC+c
+    return M
+
+
+def quat2angle_axis_batch(quat, identity_thresh=None):
+    ''' Convert quaternions to rotations of angles around axes, vectorized
+    `quat2angle_axis`
+
+    Parameters
+    ----------
+    quat : (..., 4) array-like
+       w, x, y, z forming quaternions
+    identity_thresh : None or scalar, optional
+       threshold below which the norm of the vector part of a quaternion is
+       deemed to be 0. None (the default) estimates it from the precision of
+       the input
+
+    Returns
+    -------
+    theta : (...) array
+       angles of rotation
+    vector : (..., 3) array
+       axes around which rotations occur. Identity rotations get a zero
+       angle and the axis [1, 0, 0]
+
+    Notes
+    -----
+    w is clipped to [-1, 1] before taking the arc cosine, where
+    `quat2angle_axis` would raise for slightly non-unit quaternions
+    '''
+    quat = _as_float_array(quat)
+    if identity_thresh is None:
+        identity_thresh = np.finfo(quat.dtype).eps * 3
+    vec = quat[..., 1:]
+    n = np.sqrt(np.sum(vec*vec, axis=-1))
+    isidentity = n < identity_thresh
+    theta = np.where(isidentity, 0.0, 2 * np.arccos(np.clip(quat[..., 0], -1, 1)))
+    vec = np.where(isidentity[..., np.newaxis], np.array([1.0, 0, 0]), vec / np.where(isidentity, 1.0, n)[..., np.newaxis])
+    return theta, vec
+
+
+def slerp(q1, q2, t, shortest=True):
+    ''' Spherical linear interpolation between unit quaternions
+
+    Parameters
+    ----------
+    q1 : (..., 4) array-like
+       start quaternions (t = 0)
+    q2 : (..., 4) array-like
+       end quaternions (t = 1)
+    t : scalar or (...) array-like
+       interpolation parameters, broadcast against the quaternions
+    shortest : bool, optional
+       Interpolate along the shorter arc, flipping `q2` where the quaternions
+       are more than 90 degrees apart. Default True
+
+    Returns
+    -------
+    q : (..., 4) array
+       interpolated quaternions
+
+    Notes
+    -----
+    Nearly parallel quaternions are interpolated linearly and normalized to
+    avoid dividing by a vanishing sine
+
+    Examples
+    --------
+    >>> q = slerp([1, 0, 0, 0], [0, 1, 0, 0], [0, 0.5, 1])
+    >>> np.allclose(q[1], [math.sqrt(0.5), math.sqrt(0.5), 0, 0])
+    True
+    '''
+    q1 = _as_float_array(q1)
+    q2 = _as_float_array(q2)
+    t = _as_float_array(t)[..., np.newaxis]
+    dot = np.sum(q1*q2, axis=-1, keepdims=True)
+    if shortest:
+        q2 = np.where(dot < 0, -q2, q2)
+        dot = np.abs(dot)
+    dot = np.clip(dot, -1, 1)
+    islinear = dot > 1 - 1e-6
+    angle = np.arccos(dot)
+    sinangle = np.where(islinear, 1.0, np.sin(angle))
+    s1 = np.where(islinear, 1 - t, np.sin((1 - t) * angle) / sinangle)
+    s2 = np.where(islinear, t, np.sin(t * angle) / sinangle)
+    q = s1*q1 + s2*q2
+    return np.where(islinear, q / np.sqrt(np.sum(q*q, axis=-1, keepdims=True)), q)
+
+
+def rotation_matrix(axis, theta):
+    ''' Rotation matrices of counterclockwise rotations about `axis` by `theta`
+    radians
+
+    Parameters
+    ----------
+    axis : (..., 3) array-like
+       rotation axes, need not be normalized
+    theta : scalar or (...) array-like
+       angles of rotation
+
+    Returns
+    -------
+    mat : (..., 3, 3) array
+       rotation matrices, (3, 3) for a single axis and angle
+
+    Examples
+    --------
+    >>> np.allclose(rotation_matrix([0, 0, 1], np.pi / 2), [[0, -1, 0], [1, 0, 0], [0, 0, 1]])
+    True
+    >>> rotation_matrix(np.eye(3), [0.1, 0.2, 0.3]).shape
+    (3, 3, 3)
+    '''
+    return angle_axis2mat_batch(theta, axis)
@@ -1,8 +1,14 @@
 import numpy as np
 import cv2
 import itertools
+from tk3dv.common import utilities
 
-def estimateSimilarityTransform(source: np.array, target: np.array, verbose=False):
+def estimateSimilarityTransform(source: np.array, target: np.array, verbose=False, isBatched=False, Seed=None
+                                , isAdaptive=False, Confidence=0.99, MaxIterations=1000, nPreemptivePoints=0, isReturnStats=False):
+    # isAdaptive: number of RANSAC iterations is derived from the observed inlier ratio and Confidence (up to MaxIterations)
+    # nPreemptivePoints: with isAdaptive, hypotheses are first scored on this many random points and only the best are fully evaluated
+    # isReturnStats: also return a dictionary with iteration counts and timings (ms)
+    Tic = utilities.getCurrentEpochTime()
     SourceHom = np.transpose(np.hstack([source, np.ones([source.shape[0], 1])]))
     TargetHom = np.transpose(np.hstack([target, np.ones([source.shape[0], 1])]))
 
@@ -17,22 +23,37 @@ def estimateSimilarityTransform(source: np.array, target: np.array, verbose=Fals
     if verbose:
         print('Pass threshold: ', PassT)
         print('Stop threshold: ', StopT)
-        print('Number of iterations: ', nIter)
+        print('Number of iterations: ', MaxIterations if isAdaptive else nIter)
 
-    SourceInliersHom, TargetInliersHom, BestInlierRatio = getRANSACInliers(SourceHom, TargetHom, MaxIterations=nIter, PassThreshold=PassT, StopThreshold=StopT)
+    Stats = {}
+    if isAdaptive:
+        SourceInliersHom, TargetInliersHom, BestInlierRatio, Stats = getRANSACInliersAdaptive(SourceHom, TargetHom, PassThreshold=PassT, Confidence=Confidence, MaxIterations=MaxIterations
+                                                                                             , nPreemptivePoints=nPreemptivePoints, Seed=Seed)
+    elif isBatched:
+        SourceInliersHom, TargetInliersHom, BestInlierRatio = getRANSACInliersBatched(SourceHom, TargetHom, MaxIterations=nIter, PassThreshold=PassT, StopThreshold=StopT, Seed=Seed, Stats=Stats)
+    else:
+        SourceInliersHom, TargetInliersHom, BestInlierRatio = getRANSACInliers(SourceHom, TargetHom, MaxIterations=nIter, PassThreshold=PassT, StopThreshold=StopT, Stats=Stats)
+    Stats['InlierRatio'] = BestInlierRatio
 
     if(BestInlierRatio < 0.1):
         print('[ WARN ] - Something is wrong. Small BestInlierRatio: ', BestInlierRatio)
+        Stats['TotalTime'] = (utilities.getCurrentEpochTime() - Tic) * 1e-3
+        if isReturnStats:
+            return None, None, None, None, Stats
         return None, None, None, None
 
     Scales, Rotation, Translation, OutTransform = estimateSimilarityUmeyama(SourceInliersHom, TargetInliersHom)
+    Stats['TotalTime'] = (utilities.getCurrentEpochTime() - Tic) * 1e-3
 
     if verbose:
         print('BestInlierRatio:', BestInlierRatio)
         print('Rotation:\n', Rotation)
         print('Translation:\n', Translation)
         print('Scales:', Scales)
+        print('RANSAC stats:', Stats)
 
+    if isReturnStats:
+        return Scales, Rotation, Translation, OutTransform, Stats
     return Scales, Rotation, Translation, OutTransform
 
 def estimateRestrictedAffineTransform(source: np.array, target: np.array, verbose=False):
@@ -86,7 +107,7 @@ def estimateRestrictedAffineTransform(source: np.array, target: np.array, verbos
 
     return Scales, Rotation, Translation, OutTransform
 
-def getRANSACInliers(SourceHom, TargetHom, MaxIterations=100, PassThreshold=200, StopThreshold=1):
+def getRANSACInliers(SourceHom, TargetHom, MaxIterations=100, PassThreshold=200, StopThreshold=1, Stats=None):
     BestResidual = 1e10
     BestInlierRatio = 0
     BestInlierIdx = np.arange(SourceHom.shape[1])
@@ -106,14 +127,140 @@ def getRANSACInliers(SourceHom, TargetHom, MaxIterations=100, PassThreshold=200,
         # print('Residual: ', Residual)
         # print('Inlier ratio: ', InlierRatio)
 
+    if Stats is not None:
+        Stats['Iterations'] = i + 1
     return SourceHom[:, BestInlierIdx], TargetHom[:, BestInlierIdx], BestInlierRatio
 
+def getRANSACInliersBatched(SourceHom, TargetHom, MaxIterations=100, PassThreshold=200, StopThreshold=1, BatchSize=100, ChunkSize=512, Seed=None, Stats=None):
+    # Same as getRANSACInliers() but BatchSize minimal sets are sampled and solved at once with batched SVD
+    # All hypotheses of a batch are scored against all points in a (BatchSize, N) residual matrix, ChunkSize points at a time
+    Rng = np.random.RandomState(Seed)
+    nPoints = SourceHom.shape[1]
+    BestResidual = 1e10
+    BestTransform = None
+    nDone = 0
+    while nDone < MaxIterations:
+        K = min(BatchSize, MaxIterations - nDone)
+        nDone += K
+        # Pick K sets of 5 random (but corresponding) points from source and target
+        RandIdx = Rng.randint(nPoints, size=(K, 5))
+        SourceSets = np.transpose(SourceHom[:, RandIdx], (1, 0, 2)) # K x 4 x 5
+        TargetSets = np.transpose(TargetHom[:, RandIdx], (1, 0, 2))
+        _, _, _, OutTransforms = estimateSimilarityUmeyamaBatched(SourceSets, TargetSets)
+        Residuals, _ = evaluateModelBatched(OutTransforms, SourceHom, TargetHom, PassThreshold, ChunkSize)
+
+        BestIdx = np.argmin(Residuals)
+        if Residuals[BestIdx] < BestResidual:
+            BestResidual = Residuals[BestIdx]
+            BestTransform = OutTransforms[BestIdx]
+        if BestResidual < StopThreshold:
+            break
+
+    if Stats is not None:
+        Stats['Iterations'] = nDone
+    if BestTransform is None:
+        return SourceHom, TargetHom, 0
+    _, BestInlierRatio, BestInlierIdx = evaluateModel(BestTransform, SourceHom, TargetHom, PassThreshold)
+    return SourceHom[:, BestInlierIdx], TargetHom[:, BestInlierIdx], BestInlierRatio
+
+def getRANSACIterations(InlierRatio, Confidence=0.99, SampleSize=5):
+    # Number of iterations needed to draw at least one outlier-free sample with probability Confidence
+    if InlierRatio <= 0:
+        return np.inf
+    if InlierRatio >= 1:
+        return 1
+    FailProb = 1 - InlierRatio**SampleSize
+    if FailProb <= 0:
+        return 1
+    return int(np.ceil(np.log(1 - Confidence) / np.log(FailProb)))
+
+def getRANSACInliersAdaptive(SourceHom, TargetHom, PassThreshold=200, Confidence=0.99, MaxIterations=1000, BatchSize=32
+                             , nPreemptivePoints=0, PreemptiveKeepRatio=0.1, ChunkSize=512, Seed=None):
+    # Batched RANSAC that keeps the hypothesis with the most inliers and stops once enough iterations have been done
+    # for the best inlier ratio so far (see getRANSACIterations())
+    # With nPreemptivePoints > 0, each batch is first scored on a random subset of points and only the top PreemptiveKeepRatio
+    # of hypotheses are scored on all points
+    # Returns source inliers, target inliers, inlier ratio and a stats dictionary (times are in ms)
+    Tic = utilities.getCurrentEpochTime()
+    Rng = np.random.RandomState(Seed)
+    nPoints = SourceHom.shape[1]
+    SampleSize = 5
+    Stats = {'Iterations': 0, 'RequiredIterations': MaxIterations, 'nFullyEvaluated': 0
+             , 'SampleTime': 0.0, 'FitTime': 0.0, 'PreemptiveTime': 0.0, 'ScoreTime': 0.0}
+
+    BestInlierRatio = -1
+    BestResidual = np.inf
+    BestTransform = None
+    RequiredIterations = MaxIterations
+    nDone = 0
+    while nDone < RequiredIterations:
+        K = min(BatchSize, RequiredIterations - nDone)
+        nDone += K
+
+        T0 = utilities.getCurrentEpochTime()
+        RandIdx = Rng.randint(nPoints, size=(K, SampleSize))
+        SourceSets = np.transpose(SourceHom[:, RandIdx], (1, 0, 2)) # K x 4 x 5
+        TargetSets = np.transpose(TargetHom[:, RandIdx], (1, 0, 2))
+        T1 = utilities.getCurrentEpochTime()
+        _, _, _, OutTransforms = estimateSimilarityUmeyamaBatched(SourceSets, TargetSets)
+        T2 = utilities.getCurrentEpochTime()
+
+        if 0 < nPreemptivePoints < nPoints:
+            SubIdx = Rng.choice(nPoints, nPreemptivePoints, replace=False)
+            SubResiduals, SubRatios = evaluateModelBatched(OutTransforms, SourceHom[:, SubIdx], TargetHom[:, SubIdx], PassThreshold, ChunkSize)
+            nKeep = max(1, int(np.ceil(K * PreemptiveKeepRatio)))
+            OutTransforms = OutTransforms[np.lexsort((SubResiduals, -SubRatios))[:nKeep]]
+        T3 = utilities.getCurrentEpochTime()
+
+        Residuals, InlierRatios = evaluateModelBatched(OutTransforms, SourceHom, TargetHom, PassThreshold, ChunkSize)
+        BestIdx = np.lexsort((Residuals, -InlierRatios))[0] # Most inliers, then smallest residual
+        if InlierRatios[BestIdx] > BestInlierRatio or (InlierRatios[BestIdx] == BestInlierRatio and Residuals[BestIdx] < BestResidual):
+            BestInlierRatio = InlierRatios[BestIdx]
+            BestResidual = Residuals[BestIdx]
+            BestTransform = OutTransforms[BestIdx]
+            RequiredIterations = min(MaxIterations, getRANSACIterations(BestInlierRatio, Confidence, SampleSize))
+        T4 = utilities.getCurrentEpochTime()
+
+        Stats['SampleTime'] += (T1 - T0) * 1e-3
+        Stats['FitTime'] += (T2 - T1) * 1e-3
+        Stats['PreemptiveTime'] += (T3 - T2) * 1e-3
+        Stats['ScoreTime'] += (T4 - T3) * 1e-3
+        Stats['nFullyEvaluated'] += OutTransforms.shape[0]
+
+    Stats['Iterations'] = nDone
+    Stats['RequiredIterations'] = RequiredIterations
+    if BestTransform is None:
+        Stats['RANSACTime'] = (utilities.getCurrentEpochTime() - Tic) * 1e-3
+        return SourceHom, TargetHom, 0, Stats
+    _, BestInlierRatio, BestInlierIdx = evaluateModel(BestTransform, SourceHom, TargetHom, PassThreshold)
+    Stats['RANSACTime'] = (utilities.getCurrentEpochTime() - Tic) * 1e-3
+
+    return SourceHom[:, BestInlierIdx], TargetHom[:, BestInlierIdx], BestInlierRatio, Stats
+
+def evaluateModelBatched(OutTransforms, SourceHom, TargetHom, PassThreshold, ChunkSize=512):
+    # Residual norms and inlier ratios of K transforms (K x 4 x 4) over all points, ChunkSize points at a time
+    K = OutTransforms.shape[0]
+    nPoints = SourceHom.shape[1]
+    SumSquares = np.zeros(K)
+    nInliers = np.zeros(K, dtype=np.int64)
+    for Start in range(0, nPoints, ChunkSize):
+        # One (3K x 4) x (4 x Chunk) product for all hypotheses
+        Diff = np.matmul(OutTransforms[:, :3, :].reshape((-1, 4)), SourceHom[:, Start:Start+ChunkSize]).reshape((K, 3, -1))
+        Diff -= TargetHom[np.newaxis, :3, Start:Start+ChunkSize] # K x 3 x Chunk
+        Diff *= Diff
+        ResidualVecSq = Diff.sum(axis=1)
+        SumSquares += ResidualVecSq.sum(axis=1)
+        nInliers += np.count_nonzero(ResidualVecSq < PassThreshold**2, axis=1)
+    Residuals = np.sqrt(SumSquares)
+    Residuals[~np.isfinite(Residuals)] = np.inf # Degenerate samples
+    return Residuals, nInliers / nPoints
+
 def evaluateModel(OutTransform, SourceHom, TargetHom, PassThreshold):
     Diff = TargetHom - np.matmul(OutTransform, SourceHom)
     ResidualVec = np.linalg.norm(Diff[:3, :], axis=0)
     Residual = np.linalg.norm(ResidualVec)
     InlierIdx = np.where(ResidualVec < PassThreshold)
-    nInliers = np.count_nonzero(InlierIdx)
+    nInliers = InlierIdx[0].shape[0]
     InlierRatio = nInliers / SourceHom.shape[1]
     return Residual, InlierRatio, InlierIdx[0]
 
@@ -179,11 +326,45 @@ def estimateSimilarityUmeyama(SourceHom, TargetHom):
 
     Translation = TargetHom[:3, :].mean(axis=1) - SourceHom[:3, :].mean(axis=1).dot(ScaleFact*Rotation)
 
+    # Rotation is returned transposed, so the transform that maps source to target uses its transpose
     OutTransform = np.identity(4)
-    OutTransform[:3, :3] = ScaleMatrix @ Rotation
+    OutTransform[:3, :3] = ScaleMatrix @ Rotation.T
     OutTransform[:3, 3] = Translation
 
     # # Check
     # Diff = TargetHom - np.matmul(OutTransform, SourceHom)
     # Residual = np.linalg.norm(Diff[:3, :], axis=0)
     return Scales, Rotation, Translation, OutTransform
+
+def estimateSimilarityUmeyamaBatched(SourceHom, TargetHom):
+    # Batched version of estimateSimilarityUmeyama() for K x 4 x n (or K x 3 x n) point sets
+    # Returns K scales, K x 3 x 3 rotations, K x 3 translations and K x 4 x 4 transforms
+    SourceCentroid = np.mean(SourceHom[:, :3, :], axis=2)
+    TargetCentroid = np.mean(TargetHom[:, :3, :], axis=2)
+    nPoints = SourceHom.shape[2]
+
+    CenteredSource = SourceHom[:, :3, :] - SourceCentroid[:, :, np.newaxis]
+    CenteredTarget = TargetHom[:, :3, :] - TargetCentroid[:, :, np.newaxis]
+
+    CovMatrix = np.matmul(CenteredTarget, np.transpose(CenteredSource, (0, 2, 1))) / nPoints
+    CovMatrix[~np.isfinite(CovMatrix).all(axis=(1, 2))] = 0 # Degenerate sets get an identity-like solution and are scored out
+
+    U, D, Vh = np.linalg.svd(CovMatrix, full_matrices=True)
+    d = (np.linalg.det(U) * np.linalg.det(Vh)) < 0.0
+    D[d, -1] = -D[d, -1]
+    U[d, :, -1] = -U[d, :, -1]
+
+    Rotation = np.transpose(np.matmul(U, Vh), (0, 2, 1)) # Transpose is the one that works
+
+    varP = np.var(SourceHom[:, :3, :], axis=2).sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ScaleFact = np.sum(D, axis=1) / varP # scale factor
+    Scales = np.repeat(ScaleFact[:, np.newaxis], 3, axis=1)
+
+    Translation = TargetCentroid - np.einsum('ki,kij->kj', SourceCentroid, ScaleFact[:, np.newaxis, np.newaxis] * Rotation)
+
+    OutTransform = np.tile(np.identity(4), (SourceHom.shape[0], 1, 1))
+    OutTransform[:, :3, :3] = ScaleFact[:, np.newaxis, np.newaxis] * np.transpose(Rotation, (0, 2, 1))
+    OutTransform[:, :3, 3] = Translation
+
+    return Scales, Rotation, Translation, OutTransform
@@ -1,47 +1,286 @@
 import os, sys, json, ctypes
 from tk3dv.extern import quaternions
 
-import OpenGL.GL as gl
-import OpenGL.arrays.vbo as glvbo
 import numpy as np
 
-FileDirPath = os.path.dirname(__file__)
-sys.path.append(os.path.join(FileDirPath, '..'))
 from tk3dv.common import drawing, utilities
+from tk3dv.common.drawing import gl # Imported on first draw
+
+class ArrayBuffer():
+    # Growable row buffer with capacity doubling, so appends are amortized O(1)
+    # Only the first len() rows of Data are valid, View is a zero-copy slice of those
+    def __init__(self, Array=None, nCols=3, dtype=np.float32):
+        if Array is None:
+            Array = np.zeros([0, nCols], dtype=dtype)
+        self.Data = np.asarray(Array)
+        self.Size = self.Data.shape[0]
+
+    def __len__(self):
+        return self.Size
+
+    @property
+    def View(self):
+        return self.Data[:self.Size]
+
+    @property
+    def Capacity(self):
+        return self.Data.shape[0]
+
+    def reserve(self, Capacity, dtype=None):
+        if dtype is None:
+            dtype = self.Data.dtype
+        if Capacity <= self.Capacity and dtype == self.Data.dtype:
+            return
+        NewData = np.empty((max(Capacity, self.Capacity),) + self.Data.shape[1:], dtype=dtype)
+        NewData[:self.Size] = self.Data[:self.Size]
+        self.Data = NewData
+
+    def grow(self, nNew, dtype):
+        Needed = self.Size + nNew
+        if Needed > self.Capacity:
+            self.reserve(max(Needed, 2 * self.Capacity, 16), dtype)
+        elif dtype != self.Data.dtype:
+            self.reserve(self.Capacity, dtype)
+
+    def append(self, Rows):
+        Rows = np.asarray(Rows).reshape((-1,) + self.Data.shape[1:])
+        # Promote like np.vstack would so appending doubles to a float32 buffer does not lose precision
+        self.grow(Rows.shape[0], np.promote_types(self.Data.dtype, Rows.dtype))
+        self.Data[self.Size:self.Size + Rows.shape[0]] = Rows
+        self.Size += Rows.shape[0]
+
+    def appendRow(self, Row, dtype=np.float32):
+        # Fast path for a single row of scalars
+        if self.Size >= self.Capacity or self.Data.dtype != dtype:
+            self.grow(1, np.promote_types(self.Data.dtype, dtype))
+        self.Data[self.Size] = Row
+        self.Size += 1
+
+    def clear(self):
+        self.Size = 0
+
+# Binary PLY I/O. Vertices are float32 x, y, z with uchar colors, faces are triangles
+PLY_TYPES = {'char': 'i1', 'int8': 'i1', 'uchar': 'u1', 'uint8': 'u1', 'short': 'i2', 'int16': 'i2', 'ushort': 'u2', 'uint16': 'u2'
+             , 'int': 'i4', 'int32': 'i4', 'uint': 'u4', 'uint32': 'u4', 'float': 'f4', 'float32': 'f4', 'double': 'f8', 'float64': 'f8'}
+
+def writePLY(OutFile, Points, Colors=None, Faces=None):
+    # Colors are in 0-1, Faces is an N x 3 array of point indices
+    VertexType = [('x', '<f4'), ('y', '<f4'), ('z', '<f4')]
+    if Colors is not None and len(Colors) > 0:
+        VertexType += [('red', 'u1'), ('green', 'u1'), ('blue', 'u1')]
+    Vertices = np.empty(Points.shape[0], dtype=VertexType)
+    Vertices['x'], Vertices['y'], Vertices['z'] = Points[:, 0], Points[:, 1], Points[:, 2]
+    if len(VertexType) > 3:
+        Colors8 = drawing.toColorData(Colors, np.uint8)
+        Vertices['red'], Vertices['green'], Vertices['blue'] = Colors8[:, 0], Colors8[:, 1], Colors8[:, 2]
+
+    Header = ['ply', 'format binary_little_endian 1.0', 'element vertex {}'.format(Points.shape[0])]
+    Header += ['property float {}'.format(Name) for Name in 'xyz']
+    if len(VertexType) > 3:
+        Header += ['property uchar {}'.format(Name) for Name in ['red', 'green', 'blue']]
+    if Faces is not None:
+        Header += ['element face {}'.format(Faces.shape[0]), 'property list uchar int vertex_indices']
+    Header += ['end_header']
+
+    with open(OutFile, 'wb') as f:
+        f.write(('\n'.join(Header) + '\n').encode('ascii'))
+        f.write(Vertices.tobytes())
+        if Faces is not None:
+            FaceData = np.empty(Faces.shape[0], dtype=[('n', 'u1'), ('v', '<i4', (3,))])
+            FaceData['n'] = 3
+            FaceData['v'] = Faces
+            f.write(FaceData.tobytes())
+
+def readPLY(InFile):
+    # Reads binary little-endian PLY files with vertex (x, y, z and optional red, green, blue) and optional face elements
+    # Returns a dictionary with Points, Colors (0-1, or None) and Faces (N x 3, or None). Polygons are fan-triangulated
+    with open(InFile, 'rb') as f:
+        if f.readline().strip() != b'ply':
+            raise RuntimeError('[ ERR ]: {} is not a PLY file.'.format(InFile))
+        Elements = [] # (name, count, properties)
+        while True:
+            Line = f.readline()
+            if len(Line) == 0:
+                raise RuntimeError('[ ERR ]: Unexpected end of PLY header in {}.'.format(InFile))
+            Tokens = Line.decode('ascii').split()
+            if len(Tokens) == 0 or Tokens[0] in ['comment', 'obj_info']:
+                continue
+            if Tokens[0] == 'format' and Tokens[1] != 'binary_little_endian':
+                raise RuntimeError('[ ERR ]: Unsupported PLY format {}.'.format(Tokens[1]))
+            elif Tokens[0] == 'element':
+                Elements.append((Tokens[1], int(Tokens[2]), []))
+            elif Tokens[0] == 'property':
+                Elements[-1][2].append(Tokens[1:])
+            elif Tokens[0] == 'end_header':
+                break
+        Body = f.read()
+
+    Data = {'Points': None, 'Colors': None, 'Faces': None}
+    Offset = 0
+    for Name, Count, Properties in Elements:
+        if any(Prop[0] == 'list' for Prop in Properties):
+            if len(Properties) != 1:
+                raise RuntimeError('[ ERR ]: Unsupported PLY element {} with list and other properties.'.format(Name))
+            CountType, IndexType = '<' + PLY_TYPES[Properties[0][1]], '<' + PLY_TYPES[Properties[0][2]]
+            ListData, Offset = readPLYLists(Body, Offset, Count, CountType, IndexType)
+            if Name == 'face':
+                Data['Faces'] = ListData
+            continue
+        ElementType = np.dtype([(Prop[1], '<' + PLY_TYPES[Prop[0]]) for Prop in Properties])
+        Values = np.frombuffer(Body, dtype=ElementType, count=Count, offset=Offset)
+        Offset += Count * ElementType.itemsize
+        if Name == 'vertex':
+            Data['Points'] = np.stack([Values['x'], Values['y'], Values['z']], axis=1).astype(np.float32)
+            if all(C in ElementType.names for C in ['red', 'green', 'blue']):
+                Colors = np.stack([Values['red'], Values['green'], Values['blue']], axis=1).astype(np.float32)
+                Data['Colors'] = Colors / 255 if Values['red'].dtype == np.uint8 else Colors
+    if Data['Points'] is None:
+        raise RuntimeError('[ ERR ]: No vertex element in {}.'.format(InFile))
+    return Data
+
+def readPLYLists(Body, Offset, Count, CountType, IndexType):
+    # Reads Count lists, returns them fan-triangulated as an N x 3 array and the offset after the lists
+    CountSize, IndexSize = np.dtype(CountType).itemsize, np.dtype(IndexType).itemsize
+    if Count == 0:
+        return np.zeros([0, 3], dtype=np.int32), Offset
+    # Fast path: all triangles
+    Triangles = np.dtype([('n', CountType), ('v', IndexType, (3,))])
+    if len(Body) - Offset >= Count * Triangles.itemsize:
+        Values = np.frombuffer(Body, dtype=Triangles, count=Count, offset=Offset)
+        if np.all(Values['n'] == 3):
+            return Values['v'].astype(np.int32), Offset + Count * Triangles.itemsize
+    Faces = []
+    for i in range(Count):
+        n = int(np.frombuffer(Body, dtype=CountType, count=1, offset=Offset)[0])
+        Idx = np.frombuffer(Body, dtype=IndexType, count=n, offset=Offset + CountSize)
+        Offset += CountSize + n * IndexSize
+        Faces.extend([(Idx[0], Idx[j], Idx[j + 1]) for j in range(1, n - 1)])
+    return np.array(Faces, dtype=np.int32).reshape((-1, 3)), Offset
+
+def readArrays(InFile):
+    # Arrays saved by PointSet3D.serialize() as PLY or NPZ
+    Ext = os.path.splitext(InFile)[1].lower()
+    if Ext == '.ply':
+        return readPLY(InFile)
+    if Ext == '.npz':
+        with np.load(InFile) as Data:
+            return {Name: Data[Name] for Name in Data.files}
+    raise RuntimeError('[ ERR ]: Unsupported file type {}. Use .ply or .npz.'.format(Ext))
 
 class PointSet():
     def __init__(self):
         self.Points = None
 
-class PointSet3D(PointSet):
-    def __init__(self):
+class PointSet3D(PointSet, drawing.VBOAdapter):
+    # Points, colors and bounding box are plain numpy and work without OpenGL. VBOs are created on first draw (see drawing.VBOAdapter)
+    # Host arrays that are uploaded to VBOs: name -> (VBO attribute, kind). Kind is 'Vertex', 'Color' or 'Index'
+    VBO_ATTRIBUTES = {'Points': ('VBOPoints', 'Vertex'), 'Colors': ('VBOColors', 'Color')}
+
+    # ColorType: type of uploaded colors, np.float32 or np.uint8 (normalized by OpenGL). Points are uploaded as float32
+    def __init__(self, ColorType=np.float32):
+        self.DirtyRanges = {} # Rows of host arrays to re-upload on the next draw, see markDirty()
         super().__init__()
+        self.ColorType = ColorType
         self.clear()
 
+    # Points, Colors and Normals are views into growable buffers. Views are invalidated by the next add/append
+    @property
+    def Points(self):
+        return self.PointsBuffer.View
+
+    @Points.setter
+    def Points(self, Value):
+        self.PointsBuffer = ArrayBuffer(Value, nCols=3)
+        self.markDirty('Points')
+
+    @property
+    def Colors(self):
+        return self.ColorsBuffer.View
+
+    @Colors.setter
+    def Colors(self, Value):
+        self.ColorsBuffer = ArrayBuffer(Value, nCols=3)
+        self.markDirty('Colors')
+
+    @property
+    def Normals(self):
+        if self.NormalsBuffer is None:
+            return None
+        return self.NormalsBuffer.View
+
+    @Normals.setter
+    def Normals(self, Value):
+        self.NormalsBuffer = None if Value is None else ArrayBuffer(Value, nCols=3)
+
     def clear(self):
         self.Points = np.zeros([0, 3], dtype=np.float32)  # Each point is a row
         self.Colors = np.zeros([0, 3], dtype=np.float32)
+        self.Normals = None # Optional, created on first use
         self.isVBOBound = False
+        self.isBBDirty = True
         self.BoundingBox = [np.zeros([3, 1]), np.zeros([3, 1])] # Bottom left and top right
         self.BBCenter = (self.BoundingBox[0] + self.BoundingBox[1]) / 2
         self.BBSize = (self.BoundingBox[1] - self.BoundingBox[0])
 
+    def reserve(self, nPoints):
+        # Pre-allocate space for nPoints in total to avoid re-allocations when adding points one at a time
+        self.PointsBuffer.reserve(nPoints)
+        self.ColorsBuffer.reserve(nPoints)
+        if self.NormalsBuffer is not None:
+            self.NormalsBuffer.reserve(nPoints)
+
     def __del__(self):
         if self.isVBOBound:
-            self.VBOPoints.delete()
-            self.VBOColors.delete()
+            self.deleteVBOs()
 
     def __len__(self):
         return self.Points.shape[0]
 
     def serialize(self, OutFile):
-        with open(OutFile, 'w') as f:
-            f.write("# PointSet3D serialized file\n")
-            for i in range(self.nPoints):
+        # The format is picked from the extension: binary PLY (.ply), compressed NPZ (.npz) or OBJ text (anything else)
+        Faces = self.getFaces()
+        Ext = os.path.splitext(OutFile)[1].lower()
+        if Ext == '.ply':
+            writePLY(OutFile, self.Points, self.Colors, Faces)
+        elif Ext == '.npz':
+            np.savez_compressed(OutFile, **self.getArrays())
+        else:
+            with open(OutFile, 'w') as f:
+                f.write("# PointSet3D serialized file\n")
                 if len(self.Colors) > 0:
-                    f.write('v {:.4f} {:.4f} {:.4f} {:.4f} {:.4f} {:.4f}\n'.format(self.Points[i, 0], self.Points[i, 1], self.Points[i, 2], self.Colors[i, 0], self.Colors[i, 1], self.Colors[i, 2]))
+                    np.savetxt(f, np.hstack([self.Points, self.Colors]), fmt='v %.4f %.4f %.4f %.4f %.4f %.4f')
                 else:
-                    f.write('v {:.4f} {:.4f} {:.4f}\n'.format(self.Points[i, 0], self.Points[i, 1], self.Points[i, 2]))
+                    np.savetxt(f, self.Points, fmt='v %.4f %.4f %.4f')
+                if Faces is not None:
+                    f.write("# NOCSMap image connectivity\n")
+                    np.savetxt(f, Faces + 1, fmt='f %d %d %d')
+
+    def getFaces(self):
+        # Triangles as an N x 3 array of point indices, None for point clouds
+        return None
+
+    def getArrays(self):
+        # Arrays saved to NPZ files
+        return {'Points': self.Points, 'Colors': self.Colors}
+
+    @classmethod
+    def deserialize(cls, InFile, ColorType=np.float32):
+        # Loads a point set saved with serialize() as PLY or NPZ
+        PS = cls.fromArrays(readArrays(InFile), ColorType)
+        PS.update()
+        return PS
+
+    @classmethod
+    def fromArrays(cls, Arrays, ColorType=np.float32):
+        # Creates a point set from getArrays() output without creating VBOs, call update() on the GL thread before drawing
+        PS = cls.__new__(cls)
+        PointSet3D.__init__(PS, ColorType)
+        PS.setArrays(Arrays)
+        return PS
+
+    def setArrays(self, Arrays):
+        self.Points = Arrays['Points']
+        self.Colors = Arrays['Colors'] if Arrays.get('Colors') is not None else self.Points
 
     def updateBoundingBox(self):
         self.BoundingBox[0] = np.min(self.Points, axis=0)
@@ -49,46 +288,69 @@ class PointSet3D(PointSet):
 
         self.BBCenter = (self.BoundingBox[0] + self.BoundingBox[1]) / 2
         self.BBSize = (self.BoundingBox[1] - self.BoundingBox[0])
+        self.isBBDirty = False
+        self.nBBPoints = len(self.Points)
 
     def update(self):
+        # Refreshes the point count and bounding box. No OpenGL calls, VBOs are created or updated on the next draw
         if self.Points.shape[0] == 0 or self.Colors.shape[0] == 0:
             return
 
-        # Create VBO
         self.nPoints = len(self.Points)
-        self.createVBO()
-        self.isVBOBound = True
-
-        self.updateBoundingBox()
+        if self.isBBDirty or self.nBBPoints != self.nPoints:
+            self.updateBoundingBox()
 
-    def createVBO(self):
-        self.VBOPoints = glvbo.VBO(self.Points)
-        self.VBOColors = glvbo.VBO(self.Colors)
-
-    def addAll(self, Points, Colors=None):
-        self.Points = Points.astype(np.float)
+    def upload(self):
+        # Needs a current OpenGL context, called by the draw methods
+        self.update()
+        if self.Points.shape[0] == 0 or self.Colors.shape[0] == 0:
+            return False
+        return super().upload()
+
+    def markDirty(self, Name, Start=0, Stop=None):
+        # Marks rows Start:Stop (all by default) of a host array in VBO_ATTRIBUTES to be re-uploaded on the next draw
+        # Needed after modifying an array in place. Assigning Points or Colors marks them automatically
+        if Name == 'Points':
+            self.isBBDirty = True
+        if Stop is None:
+            Stop = len(getattr(self, Name))
+        if Name in self.DirtyRanges:
+            Start, Stop = min(Start, self.DirtyRanges[Name][0]), max(Stop, self.DirtyRanges[Name][1])
+        self.DirtyRanges[Name] = (Start, Stop)
+
+    def addAll(self, Points, Colors=None, Normals=None):
+        self.Points = Points.astype(np.float32)
         MaxVal = np.max(self.Points)
         if np.all(Colors) == None:
             if MaxVal <= 1.0:
                 MaxVal = 1.0
-            self.Colors = Points / MaxVal
+            self.Colors = (Points / MaxVal).astype(np.float32)
         else:
-            self.Colors = Colors
+            self.Colors = np.asarray(Colors, dtype=np.float32)
+        self.Normals = None if Normals is None else np.asarray(Normals, dtype=np.float32)
 
-    def appendAll(self, Points, Colors=None):
-        NewPoints = Points.astype(np.float)
-        self.Points = np.vstack((self.Points, NewPoints))
+    def appendAll(self, Points, Colors=None, Normals=None):
+        NewPoints = Points.astype(np.float32)
+        self.PointsBuffer.append(NewPoints)
         MaxVal = np.max(NewPoints)
         if np.all(Colors) == None:
             if MaxVal <= 1.0:
                 MaxVal = 1.0
             Colors = Points / MaxVal
 
-        self.Colors = np.vstack((self.Colors, Colors))
+        self.ColorsBuffer.append(Colors)
+        if Normals is not None:
+            if self.NormalsBuffer is None:
+                self.NormalsBuffer = ArrayBuffer(nCols=3)
+            self.NormalsBuffer.append(Normals)
 
-    def add(self, x, y, z, r = 0, g = 0, b = 0):
-        self.Points = np.vstack([self.Points, np.array([x, y ,z])])
-        self.Colors = np.vstack([self.Colors, np.array([r, g, b])])
+    def add(self, x, y, z, r = 0, g = 0, b = 0, nx=None, ny=None, nz=None):
+        self.PointsBuffer.appendRow((x, y, z))
+        self.ColorsBuffer.appendRow((r, g, b))
+        if nx is not None:
+            if self.NormalsBuffer is None:
+                self.NormalsBuffer = ArrayBuffer(nCols=3)
+            self.NormalsBuffer.appendRow((nx, ny, nz))
 
     def drawBB(self, LineWidth = 1):
         gl.glMatrixMode(gl.GL_MODELVIEW)
@@ -102,8 +364,8 @@ class PointSet3D(PointSet):
         gl.glPopMatrix()
 
     def draw(self, pointSize = 10):
-        if self.isVBOBound == False:
-            print('[ WARN ]: VBOs not bound. Call update().')
+        if not self.upload():
+            print('[ WARN ]: Nothing to draw, point set is empty.')
             return
 
         gl.glPushAttrib(gl.GL_POINT_BIT)
@@ -111,21 +373,25 @@ class PointSet3D(PointSet):
 
         self.VBOPoints.bind()
         gl.glEnableClientState(gl.GL_VERTEX_ARRAY)
-        gl.glVertexPointer(3, gl.GL_DOUBLE, 0, self.VBOPoints)
+        gl.glVertexPointer(3, gl.GL_FLOAT, 0, self.VBOPoints)
 
         self.VBOColors.bind()
         gl.glEnableClientState(gl.GL_COLOR_ARRAY)
-        gl.glColorPointer(3, gl.GL_DOUBLE, 0, self.VBOColors)
+        gl.glColorPointer(3, drawing.getGLType(self.ColorType), 0, self.VBOColors)
 
         gl.glDrawArrays(gl.GL_POINTS, 0, self.nPoints)
 
         gl.glPopAttrib()
 
 class NOCSMap(PointSet3D):
-    def __init__(self, NOCSMap, RGB=None, Color=None):
-        super().__init__()
+    VBO_ATTRIBUTES = dict(PointSet3D.VBO_ATTRIBUTES, PixV=('VBOPixV', 'Vertex'), PixVC=('VBOPixVC', 'Color'), PixTIdx=('VBOPixTIdx', 'Index'))
+
+    def __init__(self, NOCSMap, RGB=None, Color=None, ColorType=np.float32, PruneSlivers=False, SliverThreshold=0.01):
+        super().__init__(ColorType)
         self.ValidIdx = None
         self.NOCSMap = None
+        self.PruneSlivers = PruneSlivers
+        self.SliverThreshold = SliverThreshold
         self.createNOCSFromNM(NOCSMap, RGB, Color)
         self.Size = NOCSMap.shape
         self.LineWidth = 3
@@ -159,148 +425,68 @@ class NOCSMap(PointSet3D):
         self.addAll(ValidPoints, Colors=RGBColors)
 
     def updateColors(self, RGB):
-        self.Colors = RGB[self.ValidIdx[0], self.ValidIdx[1]] / 255
-        self.PixVC = np.hstack([self.Colors, np.ones((self.Points.shape[0], 1))])
-        self.update()
+        # Only colors are re-uploaded on the next draw, connectivity and points are left as is
+        self.Colors = (RGB[self.ValidIdx[0], self.ValidIdx[1]] / 255).astype(np.float32)
+        self.PixVC[:, :3] = self.Colors
+        self.markDirty('PixVC')
 
     def discardSlivers(self, TriangleSet, PixV, Threshold=0.01):
-        TriangleSideLengths1 = np.vstack([     np.linalg.norm(PixV[TriangleSet[1, :]] - PixV[TriangleSet[0, :]], axis=1)
-                                            , np.linalg.norm(PixV[TriangleSet[2, :]] - PixV[TriangleSet[1, :]], axis=1)
-                                            , np.linalg.norm(PixV[TriangleSet[0, :]] - PixV[TriangleSet[2, :]], axis=1)
-                                         ])
-        Threshed = TriangleSideLengths1 > Threshold
-        DiscardIdx = np.argwhere(np.bitwise_or(Threshed[2, :], np.bitwise_or(Threshed[1, :], Threshed[0, :])))
-        RemTriangles = np.delete(TriangleSet, DiscardIdx, axis=1)
-
-        # print(TriangleSet.shape)
-        # print(RemTriangles.shape)
-
-        return RemTriangles
-
-
-    def createConnectivity(self):
+        # TriangleSet is 3xM, returns the triangles (3xM') with all sides no longer than Threshold
+        Corners = PixV[TriangleSet]
+        Sides = Corners - Corners[[2, 0, 1]]
+        SquaredLengths = np.einsum('ijk,ijk->ij', Sides, Sides)
+        return TriangleSet[:, np.all(SquaredLengths <= Threshold**2, axis=0)]
+
+    def createConnectivity(self, PruneSlivers=None, SliverThreshold=None):
+        # Two triangles for every 2x2 block of valid pixels
+        # PruneSlivers: discard triangles with any side longer than SliverThreshold (NOCS units), defaults to the values given at construction
         if self.ValidIdx is None or self.NOCSMap is None:
             print('[ WARN ]: Call createNOCSFromNM before trying to create connectivty.')
             return
+        if PruneSlivers is not None:
+            self.PruneSlivers = PruneSlivers
+        if SliverThreshold is not None:
+            self.SliverThreshold = SliverThreshold
 
         Width = self.Size[1]
         Height = self.Size[0]
 
         self.PixV = self.Points
-        self.PixVC = np.hstack([self.Colors, np.ones((self.Points.shape[0], 1))])
+        self.PixVC = np.hstack([self.Colors, np.ones((self.Points.shape[0], 1), dtype=np.float32)])
+        self.Alpha = 1.0
         self.ValidIdx1D = (self.ValidIdx[0] * Width + self.ValidIdx[1]).astype(np.int32) #1D index in image space
 
-        # VECTORIZED
-        LeftTop = self.ValidIdx1D
-        LeftBottom = (self.ValidIdx[0] + 1) * Width + self.ValidIdx[1]
-        RightTop = LeftTop + 1
-        RightBottom = LeftBottom + 1
-
-        # RemoveIdx = np.where(np.isin(LeftTop, self.ValidIdx1D, invert=True))
-        RemoveIdx = np.zeros([0, 1], dtype=np.int32)
-        RemoveIdx = np.vstack([RemoveIdx, np.where(np.isin(LeftBottom, self.ValidIdx1D, invert=True))[0].reshape(-1, 1)])
-        RemoveIdx = np.vstack([RemoveIdx, np.where(np.isin(RightTop, self.ValidIdx1D, invert=True))[0].reshape(-1, 1)])
-        RemoveIdx = np.vstack([RemoveIdx, np.where(np.isin(RightBottom, self.ValidIdx1D, invert=True))[0].reshape(-1, 1)])
-        RemoveIdx = np.unique(RemoveIdx.squeeze()).astype(np.int32)
-
-        LeftTop = np.delete(LeftTop, RemoveIdx)
-        LeftBottom = np.delete(LeftBottom, RemoveIdx)
-        RightTop = np.delete(RightTop, RemoveIdx)
-        RightBottom = np.delete(RightBottom, RemoveIdx)
-
-        # METHOD 1
-        # LeftTopMaskIdx = np.nonzero(LeftTop[:, None] == self.ValidIdx1D)[1].reshape(-1, 1).squeeze()
-        # LeftBottomMaskIdx = np.nonzero(LeftBottom[:, None] == self.ValidIdx1D)[1].reshape(-1, 1).squeeze()
-        # RightTopMaskIdx = np.nonzero(RightTop[:, None] == self.ValidIdx1D)[1].reshape(-1, 1).squeeze()
-        # RightBottomMaskIdx = np.nonzero(RightBottom[:, None] == self.ValidIdx1D)[1].reshape(-1, 1).squeeze()
-
-        # METHOD 2 - Fastest!! https://stackoverflow.com/questions/33678543/finding-indices-of-matches-of-one-array-in-another-array
-        sort_idx = self.ValidIdx1D.argsort()
-        LeftTopMaskIdx = sort_idx[np.searchsorted(self.ValidIdx1D, LeftTop, sorter=sort_idx)]
-        LeftBottomMaskIdx = sort_idx[np.searchsorted(self.ValidIdx1D, LeftBottom, sorter=sort_idx)]
-        RightTopMaskIdx = sort_idx[np.searchsorted(self.ValidIdx1D, RightTop, sorter=sort_idx)]
-        RightBottomMaskIdx = sort_idx[np.searchsorted(self.ValidIdx1D, RightBottom, sorter=sort_idx)]
-
-        Triangles1 = np.vstack([LeftBottomMaskIdx, LeftTopMaskIdx, RightTopMaskIdx])
-        Triangles2 = np.vstack([RightTopMaskIdx, RightBottomMaskIdx, LeftBottomMaskIdx])
-
-        PruneSlivers = False
-
-        if PruneSlivers:
-            Threshold = 0.01
-            Triangles1 = self.discardSlivers(Triangles1, self.PixV, Threshold)
-            Triangles2 = self.discardSlivers(Triangles2, self.PixV, Threshold)
-            # print(Triangles1[:, 1:4])
-            # print(Triangles1[:, 1:4].T.reshape((-1, 1)))
-
-            TriangleSoup = np.vstack([Triangles1.T.reshape((-1, 1)), Triangles2.T.reshape((-1, 1))])
-            self.PixTIdx = TriangleSoup.astype(np.int32)
-            # print(TriangleSoup.shape)
-            # exit()
-        else:
-            TriangleSoup = np.vstack([Triangles1, Triangles2])
-            self.PixTIdx = TriangleSoup.T.reshape((-1, 1)).astype(np.int32)
-
-        # # SLOW FOR LOOP
-        # Tic = utilities.getCurrentEpochTime()
-        # for Idx in range(0, self.ValidIdx[1].shape[0]):
-        #     i = self.ValidIdx[1][Idx]
-        #     j = self.ValidIdx[0][Idx]
-        #
-        #     if i == Width-1 or j == Height-1:
-        #         continue
-        #
-        #     LeftTop = np.int32(j*Width + i) # 1D index of pixel in image
-        #     LeftBottom = ((j + 1) * Width + i)
-        #     RightTop = LeftTop + 1
-        #     RightBottom = LeftBottom + 1
-        #
-        #     LeftTopIdx = np.array([np.where(self.ValidIdx1D == LeftTop)])
-        #     LeftBottomIdx = np.array([np.where(self.ValidIdx1D == LeftBottom)])
-        #     RightTopIdx = np.array([np.where(self.ValidIdx1D == RightTop)])
-        #     RightBottomIdx = np.array([np.where(self.ValidIdx1D == RightBottom)])
-        #
-        #     if (LeftTopIdx.size + LeftBottomIdx.size + RightTopIdx.size + RightBottomIdx.size) != 4:
-        #         continue
-        #
-        #     LeftTopIdx = LeftTopIdx.item()
-        #     LeftBottomIdx = LeftBottomIdx.item()
-        #     RightTopIdx = RightTopIdx.item()
-        #     RightBottomIdx = RightBottomIdx.item()
-        #
-        #     # Triangle 1
-        #     Indices = [LeftBottomIdx, LeftTopIdx, RightTopIdx]
-        #     self.PixTIdx = np.vstack([self.PixTIdx, np.asarray(Indices).reshape((-1, 1))])
-        #
-        #     # Triangle 2
-        #     Indices = [RightTopIdx, RightBottomIdx, LeftBottomIdx]
-        #     self.PixTIdx = np.vstack([self.PixTIdx, np.asarray(Indices).reshape((-1, 1))])
-        #
-        # Toc = utilities.getCurrentEpochTime()
-        # print('For loop total time', (Toc-Tic) * 1e-3, 'ms.')
-        # sys.stdout.flush()
-
-        # print(self.PixTIdx)
-        # print('Number of triangles:', int(self.PixTIdx.shape[0] / 3))
+        # Vertex ID of every pixel, -1 if invalid. The extra row and column make neighbors of border pixels invalid
+        VertexID = np.full((Height + 1, Width + 1), -1, dtype=np.int32)
+        VertexID[self.ValidIdx] = np.arange(self.ValidIdx[0].shape[0], dtype=np.int32)
+        LeftTop = VertexID[:-1, :-1]
+        LeftBottom = VertexID[1:, :-1]
+        RightTop = VertexID[:-1, 1:]
+        RightBottom = VertexID[1:, 1:]
+        isQuad = (LeftTop >= 0) & (LeftBottom >= 0) & (RightTop >= 0) & (RightBottom >= 0)
 
-    def update(self):
-        super().update()
-        self.createConnectivityVBO()
-        if self.isVBOBound == False:
-            self.isVBOBound = True
+        # Triangles (LeftBottom, LeftTop, RightTop) and (RightTop, RightBottom, LeftBottom) of every quad, one triangle per row
+        LB, RT = LeftBottom[isQuad], RightTop[isQuad]
+        Triangles = np.stack([LB, LeftTop[isQuad], RT, RT, RightBottom[isQuad], LB], axis=1).reshape((-1, 3))
+
+        if self.PruneSlivers:
+            Triangles = self.discardSlivers(Triangles.T, self.PixV, self.SliverThreshold).T
+        self.PixTIdx = np.ascontiguousarray(Triangles).reshape((-1, 1))
 
-    def createConnectivityVBO(self):
-        self.VBOPixV = glvbo.VBO(self.PixV)
-        self.VBOPixVC = glvbo.VBO(self.PixVC)
-        self.VBOPixTIdx = glvbo.VBO(self.PixTIdx, target=gl.GL_ELEMENT_ARRAY_BUFFER)
+        for Name in ['PixV', 'PixVC', 'PixTIdx']:
+            self.markDirty(Name)
 
     def drawConn(self, Alpha=None, ScaleX=1, ScaleY=1, ScaleZ=1, isWireFrame=False):
-        if self.isVBOBound == False:
-            print('[ WARN ]: Connectivity not created/bound.')
+        if not self.upload():
+            print('[ WARN ]: Nothing to draw, NOCS map is empty.')
+            return
 
-        if Alpha is not None:
+        if Alpha is not None and Alpha != self.Alpha:
             # Change alpha channel in bound VBO
+            self.Alpha = Alpha
             self.PixVC[:, -1] = Alpha
+            self.markDirty('PixVC')
+            self.syncVBO('PixVC')
 
         gl.glPushAttrib(gl.GL_POLYGON_BIT)
         gl.glPushAttrib(gl.GL_COLOR_BUFFER_BIT)
@@ -316,10 +502,10 @@ class NOCSMap(PointSet3D):
 
         self.VBOPixV.bind()
         gl.glEnableClientState(gl.GL_VERTEX_ARRAY)
-        gl.glVertexPointer(3, gl.GL_DOUBLE, 0, self.VBOPixV)
+        gl.glVertexPointer(3, gl.GL_FLOAT, 0, self.VBOPixV)
         self.VBOPixVC.bind()
         gl.glEnableClientState(gl.GL_COLOR_ARRAY)
-        gl.glColorPointer(4, gl.GL_DOUBLE, 0, self.VBOPixVC)
+        gl.glColorPointer(4, drawing.getGLType(self.ColorType), 0, self.VBOPixVC)
 
         self.VBOPixTIdx.bind()
         if isWireFrame:
@@ -335,32 +521,76 @@ class NOCSMap(PointSet3D):
         gl.glPopAttrib()
         gl.glPopAttrib()
 
-    def serialize(self, OutFile):
-        super().serialize(OutFile)
-        with open(OutFile, 'a') as f:
-            f.write("# NOCSMap image connectivity\n")
-            for i in range(0, len(self.PixTIdx), 3):
-                FaceIdx = self.PixTIdx[i:i+3]
-                # f.write('f {}//{} {}//{} {}//{}\n'.format(int(FaceIdx[0]), int(FaceIdx[0]), int(FaceIdx[1]), int(FaceIdx[1]), int(FaceIdx[2]), int(FaceIdx[2])))
-                f.write('f {} {} {}\n'.format(int(FaceIdx[0]+1), int(FaceIdx[1]+1), int(FaceIdx[2]+1)))
+    def getFaces(self):
+        return self.PixTIdx.reshape((-1, 3))
 
-    def __del__(self):
-        super().__del__()
-        if self.isVBOBound:
-            self.VBOPixV.delete()
-            self.VBOPixVC.delete()
-            self.VBOPixTIdx.delete()
+    def getArrays(self):
+        Arrays = super().getArrays()
+        Arrays.update({'Faces': self.getFaces(), 'Size': np.asarray(self.Size)})
+        if self.ValidIdx is not None:
+            Arrays['ValidIdx'] = np.stack(self.ValidIdx)
+        return Arrays
+
+    def setArrays(self, Arrays):
+        # Restores the point set and connectivity without the NOCS map image
+        super().setArrays(Arrays)
+        self.NOCSMap = None
+        self.PruneSlivers = False
+        self.SliverThreshold = 0.01
+        self.ValidIdx = tuple(Arrays['ValidIdx']) if 'ValidIdx' in Arrays else None
+        self.Size = tuple(Arrays['Size']) if 'Size' in Arrays else None
+        self.LineWidth = 3
+        self.Alpha = 1.0
+        self.PixV = self.Points
+        self.PixVC = np.hstack([self.Colors, np.ones((self.Points.shape[0], 1), dtype=np.float32)])
+        self.PixTIdx = np.zeros([0, 1], dtype=np.int32) if Arrays.get('Faces') is None else Arrays['Faces'].reshape((-1, 1)).astype(np.int32)
+        for Name in ['PixV', 'PixVC', 'PixTIdx']:
+            self.markDirty(Name)
+
+# Unit cube corners and the 12 triangles (in corner indices) used for every voxel
+VOXEL_CORNERS = np.array([
+                        [0, 0, 0],
+                        [1, 0, 0],
+                        [1, 1, 0],
+                        [0, 1, 0],
+                        [0, 1, 1],
+                        [1, 1, 1],
+                        [1, 0, 1],
+                        [0, 0, 1],
+                    ], dtype=np.float32)
+VOXEL_INDICES = np.array([
+                        0, 1, 2, 2, 3, 0,
+                        0, 3, 4, 4, 7, 0,
+                        4, 7, 6, 6, 5, 4,
+                        0, 7, 6, 6, 1, 0,
+                        1, 6, 5, 5, 2, 1,
+                        3, 4, 5, 5, 2, 3,
+                    ], dtype=np.int32)
+QUAD_INDICES = np.array([0, 1, 2, 2, 3, 0], dtype=np.int32)
 
 class VoxelGrid(PointSet3D):
-    def __init__(self, BinVoxGrid):
-        super().__init__()
+    VBO_ATTRIBUTES = dict(PointSet3D.VBO_ATTRIBUTES, VGCorners=('VBOVGCorners', 'Vertex'), VGColors=('VBOVGColors', 'Color')
+                          , VGBorderColors=('VBOBorderColors', 'Color'), VGIndices=('VBOIndices', 'Index'))
+
+    def __init__(self, BinVoxGrid, Color=None, isSurfaceOnly=False, isGreedyMerge=False, ColorType=np.float32):
+        super().__init__(ColorType)
         self.VG = BinVoxGrid
         if type(self.VG) is np.ndarray:
             self.GridSize = self.VG.shape[0] # Assuming cube grid
+            self.GridShape = self.VG.shape
             self.VGNZ = np.nonzero(self.VG)
+        elif hasattr(self.VG, 'bits'): # binvox_rw.PackedVoxels, occupied voxels are read without unpacking the grid
+            self.GridSize = self.VG.dims[0]
+            self.GridShape = self.VG.shape
+            self.VGNZ = self.VG.nonzero()
         else:
             self.GridSize = self.VG.dims[0]
+            self.GridShape = self.VG.data.shape
             self.VGNZ = np.nonzero(self.VG.data)
+        # Surface-only meshing skips faces shared by two filled voxels. Greedy merging also joins coplanar faces into larger quads
+        self.isSurfaceOnly = isSurfaceOnly or isGreedyMerge
+        self.isGreedyMerge = isGreedyMerge
+        self.nTrianglesRemoved = 0
         # We are treating VoxelGrid as a point cloud with unit cube size limits
         # All 'on' voxels are a point in the point cloud. The center of a voxel is the position of the point
         self.DefaultColor = (101 / 255, 67 / 255, 33 / 255, 0.8)
@@ -373,74 +603,141 @@ class VoxelGrid(PointSet3D):
         self.isVBOBound = False
         self.LineWidth = 2
 
-        self.createVG()
+        self.createVG(Color)
 
-    def update(self):
-        super().update()
-        self.createVGVBO()
-        if self.isVBOBound == False:
-            self.isVBOBound = True
+    def createVG(self, Color=None):
+        # Color can be a single RGBA tuple or an (N, 4) array with one color per occupied voxel
+        VoxelIdx = np.stack(self.VGNZ, axis=1) # N x 3
+        nVoxels = VoxelIdx.shape[0]
 
-    def createVGVBO(self):
-        self.VBOVGCorners = glvbo.VBO(self.VGCorners)
-        self.VBOVGColors = glvbo.VBO(self.VGColors)
-        self.VBOBorderColors = glvbo.VBO(self.VGBorderColors)
-        self.VBOIndices = glvbo.VBO(self.VGIndices, target=gl.GL_ELEMENT_ARRAY_BUFFER)
+        # We are treating VoxelGrid as a point cloud with unit cube size limits
+        VoxelCenters = ((VoxelIdx + 0.5) / self.GridSize).astype(np.float32)
+        self.Points = VoxelCenters
+        self.Colors = VoxelCenters
+
+        if Color is None:
+            Color = self.DefaultColor
+        Color = np.asarray(Color, dtype=np.float32)
+        if Color.ndim == 2 and Color.shape != (nVoxels, 4):
+            raise RuntimeError('[ ERR ]: Expected per-voxel colors of shape ({}, 4), got {}.'.format(nVoxels, Color.shape))
+
+        if self.isSurfaceOnly:
+            self.createSurfaceMesh(Color)
+        else:
+            self.createCubeMesh(VoxelIdx, Color)
+        self.VGBorderColors = np.tile(np.asarray(self.DefaultBorderColor, dtype=np.float32).reshape((1, 4)), (self.VGCorners.shape[0], 1))
+        self.Alpha = None # Alpha of the given colors
+        for Name in ['VGCorners', 'VGColors', 'VGBorderColors', 'VGIndices']:
+            self.markDirty(Name)
 
-    def __del__(self):
-        super().__del__()
-        if self.isVBOBound:
-            self.VBOVGCorners.delete()
-            self.VBOVGColors.delete()
-            self.VBOBorderColors.delete()
-            self.VBOIndices.delete()
+        self.update()
 
-    def createVG(self, Color=None):
-        for i in range(0, len(self.VGNZ[0])):
-            VoxelCenter = (np.array([self.VGNZ[0][i], self.VGNZ[1][i], self.VGNZ[2][i]]) + 0.5) / self.GridSize
-            self.add(VoxelCenter[0], VoxelCenter[1], VoxelCenter[2], VoxelCenter[0], VoxelCenter[1], VoxelCenter[2])
-
-            # Create vertices of voxels
-            VO = (np.array([self.VGNZ[0][i], self.VGNZ[1][i], self.VGNZ[2][i]])) / self.GridSize # Voxel origin
-            VS = 1 / self.GridSize # Voxel side
-            Corners = [
-                        VO[0], VO[1], VO[2],
-                        VO[0] + VS, VO[1], VO[2],
-                        VO[0] + VS, VO[1] + VS, VO[2],
-                        VO[0], VO[1] + VS, VO[2],
-                        VO[0], VO[1] + VS, VO[2] + VS,
-                        VO[0] + VS, VO[1] + VS, VO[2] + VS,
-                        VO[0] + VS, VO[1], VO[2] + VS,
-                        VO[0], VO[1], VO[2] + VS,
-                    ]
-            self.VGCorners = np.vstack([self.VGCorners, np.asarray(Corners).reshape((-1, 3))])
-
-            SI = i * 8 # start index
-            Indices = [
-                    SI+0, SI+1, SI+2, SI+2, SI+3, SI+0,
-                    SI+0, SI+3, SI+4, SI+4, SI+7, SI+0,
-                    SI+4, SI+7, SI+6, SI+6, SI+5, SI+4,
-                    SI+0, SI+7, SI+6, SI+6, SI+1, SI+0,
-                    SI+1, SI+6, SI+5, SI+5, SI+2, SI+1,
-                    SI+3, SI+4, SI+5, SI+5, SI+2, SI+3,
-                    ]
-            self.VGIndices = np.vstack([self.VGIndices, np.asarray(Indices).reshape((-1, 1))])
-
-            if Color is None:
-                Color = self.DefaultColor
-            for kk in range(0, 8):
-                self.VGColors = np.vstack([self.VGColors, np.asarray(Color).reshape((-1, 4))])
-                self.VGBorderColors = np.vstack([self.VGBorderColors, np.asarray(self.DefaultBorderColor).reshape((-1, 4))])
+    def createCubeMesh(self, VoxelIdx, Color):
+        # All 12 triangles of every voxel
+        nVoxels = VoxelIdx.shape[0]
+        VS = np.float32(1 / self.GridSize) # Voxel side
 
-        self.update()
+        # Create vertices of voxels: 8 corners per voxel offset from the voxel origin
+        VO = (VoxelIdx / self.GridSize).astype(np.float32) # Voxel origins
+        self.VGCorners = (VO[:, np.newaxis, :] + VS * VOXEL_CORNERS[np.newaxis, :, :]).reshape((-1, 3))
+
+        StartIdx = np.arange(nVoxels, dtype=np.int32) * 8
+        self.VGIndices = (StartIdx[:, np.newaxis] + VOXEL_INDICES[np.newaxis, :]).reshape((-1, 1))
+
+        if Color.ndim == 2:
+            self.VGColors = np.repeat(Color, 8, axis=0)
+        else:
+            self.VGColors = np.tile(Color.reshape((1, 4)), (nVoxels * 8, 1))
+
+    def createSurfaceMesh(self, Color):
+        # Only faces between a filled and an empty voxel (or the grid boundary) are emitted
+        # Labels are 0 for empty voxels and (color index + 1) otherwise so that merging never crosses colors
+        Labels = np.zeros(self.GridShape, dtype=np.int32)
+        if Color.ndim == 2:
+            ColorTable, ColorIdx = np.unique(Color, axis=0, return_inverse=True)
+            Labels[self.VGNZ] = ColorIdx.reshape(-1) + 1
+        else:
+            ColorTable = Color.reshape((1, 4))
+            Labels[self.VGNZ] = 1
+        Padded = np.pad(Labels, 1)
+
+        AllCorners = []
+        AllColors = []
+        for Axis in range(0, 3):
+            # Axes spanning the face plane, ordered so that the face normal is along +Axis
+            Perm = (Axis, (Axis + 1) % 3, (Axis + 2) % 3)
+            for Sign in (-1, 1):
+                Slices = [slice(1, -1)] * 3
+                Slices[Axis] = slice(1 + Sign, Padded.shape[Axis] - 1 + Sign)
+                FaceLabels = np.where(Padded[tuple(Slices)] == 0, Labels, 0)
+                # Faces as (slice, row, column, height, width, label) in the (Axis, b, c) frame
+                Quads = self.getFaceQuads(np.transpose(FaceLabels, Perm), self.isGreedyMerge)
+                if Quads.shape[0] == 0:
+                    continue
+
+                Plane = Quads[:, 0] + (1 if Sign > 0 else 0)
+                Rows = np.stack([Quads[:, 1], Quads[:, 1] + Quads[:, 3], Quads[:, 1] + Quads[:, 3], Quads[:, 1]], axis=1)
+                Cols = np.stack([Quads[:, 2], Quads[:, 2], Quads[:, 2] + Quads[:, 4], Quads[:, 2] + Quads[:, 4]], axis=1)
+                if Sign < 0: # Flip winding so that faces point outwards
+                    Rows = Rows[:, ::-1]
+                    Cols = Cols[:, ::-1]
+                Corners = np.zeros((Quads.shape[0], 4, 3), dtype=np.float32)
+                Corners[:, :, Perm[0]] = Plane[:, np.newaxis]
+                Corners[:, :, Perm[1]] = Rows
+                Corners[:, :, Perm[2]] = Cols
+                AllCorners.append(Corners.reshape((-1, 3)) / np.float32(self.GridSize))
+                AllColors.append(np.repeat(ColorTable[Quads[:, 5] - 1], 4, axis=0))
+
+        nQuads = int(sum(C.shape[0] for C in AllCorners) / 4)
+        if nQuads == 0:
+            self.VGCorners = np.zeros([0, 3], dtype=np.float32)
+            self.VGColors = np.zeros([0, 4], dtype=np.float32)
+        else:
+            self.VGCorners = np.vstack(AllCorners)
+            self.VGColors = np.vstack(AllColors)
+        StartIdx = np.arange(nQuads, dtype=np.int32) * 4
+        self.VGIndices = (StartIdx[:, np.newaxis] + QUAD_INDICES[np.newaxis, :]).reshape((-1, 1))
+
+        nFullTriangles = 12 * len(self.VGNZ[0])
+        self.nTrianglesRemoved = nFullTriangles - 2 * nQuads
+        print('[ INFO ]: Surface meshing removed {} of {} triangles ({} remaining).'.format(self.nTrianglesRemoved, nFullTriangles, 2 * nQuads))
+
+    @staticmethod
+    def getFaceQuads(FaceLabels, isGreedyMerge=False):
+        # FaceLabels is a 3D label array of faces indexed by (slice, row, column) with 0 meaning no face
+        # Returns an M x 6 array of quads (slice, row, column, height, width, label)
+        k, j, i = np.nonzero(FaceLabels)
+        Lab = FaceLabels[k, j, i]
+        if not isGreedyMerge or k.shape[0] == 0:
+            return np.stack([k, j, i, np.ones_like(k), np.ones_like(k), Lab], axis=1)
+
+        # Pass 1: merge faces along each row into runs. np.nonzero returns faces sorted by (slice, row, column)
+        RunStart = np.ones(k.shape[0], dtype=bool)
+        RunStart[1:] = (k[1:] != k[:-1]) | (j[1:] != j[:-1]) | (i[1:] != i[:-1] + 1) | (Lab[1:] != Lab[:-1])
+        RunID = np.cumsum(RunStart) - 1
+        Width = np.bincount(RunID)
+        k, j, i, Lab = k[RunStart], j[RunStart], i[RunStart], Lab[RunStart]
+
+        # Pass 2: stack identical runs on consecutive rows into rectangles
+        Order = np.lexsort((j, Lab, Width, i, k))
+        k, j, i, Lab, Width = k[Order], j[Order], i[Order], Lab[Order], Width[Order]
+        QuadStart = np.ones(k.shape[0], dtype=bool)
+        QuadStart[1:] = (k[1:] != k[:-1]) | (i[1:] != i[:-1]) | (Width[1:] != Width[:-1]) | (Lab[1:] != Lab[:-1]) | (j[1:] != j[:-1] + 1)
+        Height = np.bincount(np.cumsum(QuadStart) - 1)
+
+        return np.stack([k[QuadStart], j[QuadStart], i[QuadStart], Height, Width[QuadStart], Lab[QuadStart]], axis=1)
 
     def drawVG(self, Alpha=None, ScaleX=1, ScaleY=1, ScaleZ=1):
-        if self.isVBOBound == False:
-            print('[ WARN ]: Voxel grid VBOs not bound.')
+        if not self.upload():
+            print('[ WARN ]: Nothing to draw, voxel grid is empty.')
+            return
 
-        if Alpha is not None:
+        if Alpha is not None and Alpha != self.Alpha:
             # Change alpha channel in bound VBO
+            self.Alpha = Alpha
             self.VGColors[:, -1] = Alpha
+            self.markDirty('VGColors')
+            self.syncVBO('VGColors')
 
         gl.glPushAttrib(gl.GL_POLYGON_BIT)
         gl.glPushAttrib(gl.GL_COLOR_BUFFER_BIT)
@@ -456,18 +753,18 @@ class VoxelGrid(PointSet3D):
 
         self.VBOVGCorners.bind()
         gl.glEnableClientState(gl.GL_VERTEX_ARRAY)
-        gl.glVertexPointer(3, gl.GL_DOUBLE, 0, self.VBOVGCorners)
+        gl.glVertexPointer(3, gl.GL_FLOAT, 0, self.VBOVGCorners)
 
         self.VBOIndices.bind()
 
         gl.glEnableClientState(gl.GL_COLOR_ARRAY)
         self.VBOVGColors.bind()
-        gl.glColorPointer(4, gl.GL_DOUBLE, 0, self.VBOVGColors)
+        gl.glColorPointer(4, drawing.getGLType(self.ColorType), 0, self.VBOVGColors)
         gl.glPolygonMode(gl.GL_FRONT_AND_BACK, gl.GL_FILL)
         gl.glDrawElements(gl.GL_TRIANGLES, int(len(self.VGIndices)), gl.GL_UNSIGNED_INT, None)
 
         self.VBOBorderColors.bind()
-        gl.glColorPointer(4, gl.GL_DOUBLE, 0, self.VBOBorderColors)
+        gl.glColorPointer(4, drawing.getGLType(self.ColorType), 0, self.VBOBorderColors)
         gl.glPolygonMode(gl.GL_FRONT_AND_BACK, gl.GL_LINE)
         gl.glDrawElements(gl.GL_TRIANGLES, int(len(self.VGIndices)), gl.GL_UNSIGNED_INT, None)
 
@@ -482,24 +779,37 @@ class VoxelGrid(PointSet3D):
 
 
 class DepthImage(PointSet3D):
-    def __init__(self, DepthImage, Intrinsics, mask=None):
+    def __init__(self, DepthImage, Intrinsics, mask=None, PixelIdx=None):
         super().__init__()
-        self.createFromDepthImage(DepthImage, Intrinsics, mask)
+        self.createFromDepthImage(DepthImage, Intrinsics, mask, PixelIdx)
 
-    def createFromDepthImage(self, DepthImage, Intrinsics, mask=None):
-        self.Intrinsics = Intrinsics
+    @staticmethod
+    def decode(DepthImage):
+        # Returns a uint16 depth image or None if the type is not supported
         if len(DepthImage.shape) == 3:
             # This is encoded depth image, let's convert
             Depth16 = np.uint16(DepthImage[:, :, 1]*256) + np.uint16(DepthImage[:, :, 2]) # NOTE: RGB is actually BGR in opencv
-            Depth16 = Depth16.astype(np.uint16)
-            self.DepthImage16 = Depth16
+            return Depth16.astype(np.uint16)
         elif len(DepthImage.shape) == 2 and DepthImage.dtype == 'uint16':
-            self.DepthImage16 = DepthImage
-        else:
+            return DepthImage
+        return None
+
+    def createFromDepthImage(self, DepthImage, Intrinsics, mask=None, PixelIdx=None):
+        # PixelIdx optionally restricts backprojection to these 1D (row-major) pixel indices
+        # Only pixels with non-zero depth are kept, their 1D indices are stored in self.PixelIdx
+        self.Intrinsics = Intrinsics
+        self.DepthImage16 = self.decode(DepthImage)
+        if self.DepthImage16 is None:
             print('[ WARN ]: Unsupported depth type.')
             return
 
-        self.Points = utilities.backproject(DepthImage, Intrinsics, mask)
+        if PixelIdx is None:
+            self.Points = utilities.backproject(self.DepthImage16, Intrinsics, mask)
+        else:
+            z = self.DepthImage16.reshape(-1)[PixelIdx]
+            self.PixelIdx = PixelIdx[z > 0]
+            Backprojector = utilities.getBackprojector(Intrinsics, self.DepthImage16.shape)
+            self.Points = Backprojector.backprojectPixels(self.PixelIdx, z[z > 0])
         self.Colors = np.zeros_like(self.Points)
 
         # print('Max depth:', np.max(self.Points[:, 2]))
@@ -0,0 +1,107 @@
+import sys
+import cv2
+import numpy as np
+import concurrent.futures as cf
+
+from tk3dv.nocstools import datastructures as ds
+from tk3dv.common import utilities
+
+# Batch loading of NOCS maps (and optional RGB images) on a worker pool
+# Workers decode the images and build points and connectivity. Results are GL-free, VBOs are created when a map is first drawn on the GL thread
+
+STAGES = ['Decode', 'Build', 'Wait', 'Total']
+
+def readNOCSMap(NMFile, ColorFile=None, ImageSize=None):
+    # Returns the NOCS map and color image as RGB uint8, resized to ImageSize (width, height) if given
+    NOCSMap = cv2.imread(NMFile, -1)
+    if NOCSMap is None:
+        raise RuntimeError('[ ERR ]: Unable to read NOCS map {}.'.format(NMFile))
+    NOCSMap = cv2.cvtColor(NOCSMap[:, :, :3], cv2.COLOR_BGR2RGB) # Ignore alpha if present. IMPORTANT: OpenCV loads as BGR, so convert to RGB
+    if ImageSize is not None and (NOCSMap.shape[1], NOCSMap.shape[0]) != tuple(ImageSize):
+        NOCSMap = cv2.resize(NOCSMap, tuple(ImageSize), interpolation=cv2.INTER_NEAREST)
+
+    Color = None
+    if ColorFile is not None:
+        Color = cv2.imread(ColorFile)
+        if Color is None:
+            raise RuntimeError('[ ERR ]: Unable to read color image {}.'.format(ColorFile))
+        Color = cv2.cvtColor(Color, cv2.COLOR_BGR2RGB)
+        if Color.shape != NOCSMap.shape: # Re-size only if not the same size as NOCSMap
+            Color = cv2.resize(Color, (NOCSMap.shape[1], NOCSMap.shape[0]), interpolation=cv2.INTER_CUBIC) # Ok to use cubic interpolation for RGB
+    return NOCSMap, Color
+
+def buildNOCSMap(NMFile, ColorFile=None, ImageSize=None, PruneSlivers=False, SliverThreshold=0.01):
+    # Runs in a worker. Returns (NOCSMap image, NOCSMap.getArrays(), Timings)
+    Tic = utilities.getCurrentEpochTime()
+    NOCSMap, Color = readNOCSMap(NMFile, ColorFile, ImageSize)
+    Toc = utilities.getCurrentEpochTime()
+    NOCS = ds.NOCSMap(NOCSMap, RGB=Color, PruneSlivers=PruneSlivers, SliverThreshold=SliverThreshold)
+    Timings = {'Decode': (Toc - Tic) * 1e-3, 'Build': (utilities.getCurrentEpochTime() - Toc) * 1e-3}
+    return NOCSMap, NOCS.getArrays(), Timings
+
+class NOCSMapLoader():
+    # Loads lists of NOCS maps in parallel. Use as a context manager or call stop() to shut the pool down
+    # isProcessPool: use processes instead of threads, most of the work is numpy and OpenCV but NOCSMap construction still holds the GIL
+    def __init__(self, nWorkers=None, isProcessPool=True, ColorType=np.float32, PruneSlivers=False, SliverThreshold=0.01, isVerbose=True):
+        self.nWorkers = nWorkers
+        self.isProcessPool = isProcessPool
+        self.ColorType = ColorType
+        self.PruneSlivers = PruneSlivers
+        self.SliverThreshold = SliverThreshold
+        self.isVerbose = isVerbose
+        self.Pool = None
+        self.nLoaded = 0
+        self.Timings = dict.fromkeys(STAGES, 0.0)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *Args):
+        self.stop()
+
+    def start(self):
+        if self.Pool is None:
+            Executor = cf.ProcessPoolExecutor if self.isProcessPool else cf.ThreadPoolExecutor
+            self.Pool = Executor(max_workers=self.nWorkers)
+
+    def stop(self):
+        if self.Pool is not None:
+            self.Pool.shutdown()
+            self.Pool = None
+
+    def load(self, NMFiles, ColorFiles=None, ImageSize=None):
+        # Yields (NOCSMap image, ds.NOCSMap) in input order as soon as each one is ready
+        # The returned NOCSMap objects have no VBOs yet, they are uploaded when first drawn
+        self.start()
+        if ColorFiles is None:
+            ColorFiles = [None] * len(NMFiles)
+        if len(ColorFiles) != len(NMFiles):
+            raise RuntimeError('[ ERR ]: Number of color images ({}) does not match number of NOCS maps ({}).'.format(len(ColorFiles), len(NMFiles)))
+
+        Tic = utilities.getCurrentEpochTime()
+        Futures = [self.Pool.submit(buildNOCSMap, NMF, CF, ImageSize, self.PruneSlivers, self.SliverThreshold) for NMF, CF in zip(NMFiles, ColorFiles)]
+        for Idx, Future in enumerate(Futures):
+            WaitTic = utilities.getCurrentEpochTime()
+            NOCSMap, Arrays, Timings = Future.result()
+            self.Timings['Wait'] += (utilities.getCurrentEpochTime() - WaitTic) * 1e-3
+            for Stage, Time in Timings.items():
+                self.Timings[Stage] += Time
+            self.nLoaded += 1
+            if self.isVerbose:
+                print('[ INFO ]: Loaded NOCS map {}/{}: {}'.format(Idx + 1, len(Futures), NMFiles[Idx]))
+                sys.stdout.flush()
+            NOCS = ds.NOCSMap.fromArrays(Arrays, self.ColorType)
+            NOCS.NOCSMap, NOCS.PruneSlivers, NOCS.SliverThreshold = NOCSMap, self.PruneSlivers, self.SliverThreshold
+            yield NOCSMap, NOCS
+        self.Timings['Total'] += (utilities.getCurrentEpochTime() - Tic) * 1e-3
+
+    def printTimings(self):
+        # Decode and Build are summed over workers, so they can exceed the wall clock time when running in parallel
+        nLoaded = max(1, self.nLoaded)
+        print('[ INFO ]: Loaded {} NOCS maps.'.format(self.nLoaded))
+        for Stage in STAGES:
+            print('[ INFO ]: {:8s} {:10.2f} ms total, {:8.2f} ms per map'.format(Stage, self.Timings[Stage], self.Timings[Stage] / nLoaded))
+
+    def __del__(self):
+        self.stop()
@@ -1,113 +1,256 @@
 import numpy as np
-import OpenGL.GL as gl
-import OpenGL.arrays.vbo as glvbo
+import os
+from tk3dv.common import drawing
+from tk3dv.common.drawing import gl # Imported on first draw
 
-class Loader(object):
-    def __init__(self, path, isNormalize=False, isOverrideVertexColors=False, isVerbose=True):
+# Bump when the parsed data layout changes so that stale caches are ignored
+OBJ_CACHE_VERSION = 1
+OBJ_CACHE_SUFFIX = '.cache.npz'
+
+def isWhitespace(Bytes):
+    return (Bytes == ord(' ')) | (Bytes == ord('\t')) | (Bytes == ord('\r')) | (Bytes == ord('\n'))
+
+def splitLines(Bytes):
+    # Bytes must end with a newline. Returns the start and end (newline) offsets of each line
+    Ends = np.flatnonzero(Bytes == ord('\n'))
+    Starts = np.concatenate([[0], Ends[:-1] + 1])
+    return Starts, Ends
+
+def getKeyLines(Bytes, Starts, Key):
+    # Lines that start with Key followed by whitespace (Bytes is padded so that reading past short lines is safe)
+    isKey = isWhitespace(Bytes[Starts + len(Key)])
+    for i, Char in enumerate(Key):
+        isKey &= Bytes[Starts + i] == ord(Char)
+    return isKey
+
+def getBlock(Bytes, Starts, Ends, isKey, KeyLength):
+    # Gathers the selected lines (keyword blanked out) into one byte array
+    # Returns the block, the offset of every token in the block and the number of tokens on each line
+    Lines = np.flatnonzero(isKey)
+    Lengths = Ends[Lines] - Starts[Lines] + 1
+    if Lines[-1] - Lines[0] + 1 == Lines.shape[0]:
+        # Lines are contiguous (usual case)
+        Block = Bytes[Starts[Lines[0]]:Ends[Lines[-1]]+1].copy()
+    else:
+        # Mark the start and one past the end of every selected line, the running sum is 1 inside them
+        Inside = np.zeros(Bytes.shape[0] + 1, dtype=np.int8)
+        Inside[Starts[Lines]] += 1
+        Inside[Ends[Lines] + 1] -= 1
+        Block = Bytes[np.cumsum(Inside[:-1], dtype=np.int8).view(bool)]
+    BlockStarts = np.cumsum(Lengths) - Lengths
+    for i in range(KeyLength):
+        Block[BlockStarts + i] = ord(' ')
+    isSpace = isWhitespace(Block)
+    TokenStarts = np.flatnonzero(~isSpace & np.concatenate([[True], isSpace[:-1]]))
+    nTokens = np.bincount(np.searchsorted(BlockStarts, TokenStarts, side='right') - 1, minlength=BlockStarts.shape[0])
+    return Block, TokenStarts, nTokens
+
+def parseBlock(Bytes, Starts, Ends, Key, nCols, dtype=np.float64):
+    # Returns an array with one row per Key line
+    # If all lines have the same number of values (at least nCols) they are converted in bulk and all columns are returned,
+    # otherwise lines are converted one by one (rare) and only the first nCols values are kept
+    isKey = getKeyLines(Bytes, Starts, Key)
+    nLines = int(np.count_nonzero(isKey))
+    if nLines == 0:
+        return np.zeros([0, nCols], dtype=dtype)
+    Block, _, nTokens = getBlock(Bytes, Starts, Ends, isKey, len(Key))
+    if np.all(nTokens == nTokens[0]) and nTokens[0] >= nCols:
+        Values = np.fromstring(Block.tobytes(), dtype=dtype, sep=' ')
+        if Values.shape[0] == nLines * nTokens[0]:
+            return Values.reshape(nLines, nTokens[0])
+    return np.array([Line.split()[:nCols] for Line in Block.tobytes().decode().splitlines()], dtype=dtype)
+
+def resolveIndices(Indices, nBefore):
+    # OBJ indices are 1-based, negative indices are relative to the elements read so far, and 0 marks a missing index
+    # Returns 0-based indices with -1 for missing
+    return np.where(Indices > 0, Indices - 1, np.where(Indices < 0, nBefore + Indices, -1))
+
+def parseFaces(Bytes, Starts, Ends):
+    # Polygons are fan-triangulated. Returns an nTriangles x 3 x 3 array of 0-based (vertex, texcoord, normal) indices with -1 for missing
+    isFace = getKeyLines(Bytes, Starts, 'f')
+    if not np.any(isFace):
+        return np.zeros([0, 3, 3], dtype=np.int64)
+    Block, TokenStarts, Sizes = getBlock(Bytes, Starts, Ends, isFace, 1)
+
+    # Tokens are v, v/vt, v/vt/vn or v//vn. Convert in bulk if all tokens have the same format
+    nTotal = TokenStarts.shape[0]
+    nSlashes = np.bincount(np.searchsorted(TokenStarts, np.flatnonzero(Block == ord('/')), side='right') - 1, minlength=nTotal)
+    Indices = np.zeros([nTotal, 3], dtype=np.int64)
+    Values = None
+    if nTotal > 0 and np.all(nSlashes == nSlashes[0]) and nSlashes[0] <= 2:
+        Values = np.fromstring(Block.tobytes().replace(b'//', b'/0/').replace(b'/', b' '), dtype=np.int64, sep=' ')
+        if Values.shape[0] == nTotal * (nSlashes[0] + 1):
+            Indices[:, :nSlashes[0]+1] = Values.reshape(nTotal, -1)
+        else:
+            Values = None
+    if Values is None:
+        for i, Token in enumerate(Block.tobytes().decode().split()):
+            Values = [int(x) if x else 0 for x in Token.split('/')[:3]]
+            Indices[i, :len(Values)] = Values
+
+    # Number of vertices/texcoords/normals before each face, needed for relative (negative) indices
+    TokenFace = np.repeat(np.arange(Sizes.shape[0]), Sizes)
+    for Col, Key in enumerate(['v', 'vt', 'vn']):
+        nBefore = np.cumsum(getKeyLines(Bytes, Starts, Key))[isFace] if np.any(Indices[:, Col] < 0) else np.zeros(Sizes.shape[0], dtype=np.int64)
+        Indices[:, Col] = resolveIndices(Indices[:, Col], nBefore[TokenFace])
+
+    # Fan triangulation: (0, i, i+1) for i in 1..Size-2
+    nTriangles = np.maximum(Sizes - 2, 0)
+    FaceStarts = np.cumsum(Sizes) - Sizes
+    TriFace = np.repeat(np.arange(Sizes.shape[0]), nTriangles)
+    TriIdx = np.arange(TriFace.shape[0]) - np.repeat(np.cumsum(nTriangles) - nTriangles, nTriangles) + 1
+    Corners = np.stack([FaceStarts[TriFace], FaceStarts[TriFace] + TriIdx, FaceStarts[TriFace] + TriIdx + 1], axis=1)
+    return Indices[Corners]
+
+def parseOBJ(path):
+    # Reads the whole file as bytes and converts each block (v, vn, vt, f) to arrays in bulk
+    # Returns a dictionary with Vertices (N x 3), VertexColors (N x 3 or empty), Normals, TexCoords and Faces (see parseFaces())
+    with open(path, 'rb') as File:
+        Buffer = File.read()
+    # Pad so that keyword checks can read past the end of short lines
+    Bytes = np.frombuffer(Buffer + b'\n\0\0\0', dtype=np.uint8)
+    Starts, Ends = splitLines(Bytes)
+    if np.any(isWhitespace(Bytes[Starts]) & (Starts != Ends)):
+        # Strip leading whitespace (rare)
+        Buffer = b'\n'.join(Line.strip() for Line in Buffer.splitlines())
+        Bytes = np.frombuffer(Buffer + b'\n\0\0\0', dtype=np.uint8)
+        Starts, Ends = splitLines(Bytes)
+
+    Data = {}
+    Vertices = parseBlock(Bytes, Starts, Ends, 'v', 3)
+    Data['Vertices'] = Vertices[:, :3]
+    Data['VertexColors'] = np.zeros([0, 3])
+    if Vertices.shape[1] == 6: # read vertex colors where available
+        Colors = Vertices[:, 3:6].copy()
+        # Check if between 0-1 or 0-255
+        Colors[np.linalg.norm(Colors, axis=1) > 1.74] /= 255
+        Data['VertexColors'] = Colors
+    Data['Normals'] = parseBlock(Bytes, Starts, Ends, 'vn', 3)[:, :3]
+    Data['TexCoords'] = parseBlock(Bytes, Starts, Ends, 'vt', 2)[:, :2]
+    Data['Faces'] = parseFaces(Bytes, Starts, Ends)
+    return Data
+
+def getCacheKey(path):
+    Stat = os.stat(path)
+    return np.array([OBJ_CACHE_VERSION, Stat.st_mtime_ns, Stat.st_size], dtype=np.int64)
+
+def loadOBJ(path, isCache=True, isVerbose=False):
+    # Parses an OBJ file, using a binary cache next to the source (path + OBJ_CACHE_SUFFIX) when it is up to date
+    CachePath = path + OBJ_CACHE_SUFFIX
+    Key = getCacheKey(path)
+    if isCache and os.path.exists(CachePath):
+        try:
+            with np.load(CachePath) as Cache:
+                if np.array_equal(Cache['Key'], Key):
+                    if isVerbose:
+                        print('[ INFO ]: Loaded cached OBJ data from', CachePath)
+                    return {Name: Cache[Name] for Name in Cache.files if Name != 'Key'}
+        except Exception as e:
+            print('[ WARN ]: Ignoring unreadable OBJ cache {}: {}'.format(CachePath, e))
+
+    Data = parseOBJ(path)
+    if isCache:
+        try:
+            # Write to a temporary file first so that concurrent readers never see a partial cache
+            TempPath = CachePath + '.{}.tmp.npz'.format(os.getpid())
+            np.savez(TempPath, Key=Key, **Data)
+            os.replace(TempPath, CachePath)
+        except OSError as e:
+            print('[ WARN ]: Unable to write OBJ cache {}: {}'.format(CachePath, e))
+    return Data
+
+class Loader(drawing.VBOAdapter):
+    # isIndexed: keep unique vertices/colors and draw faces with an element buffer instead of expanding to a triangle soup
+    # ColorType: type of uploaded colors, np.float32 or np.uint8 (normalized by OpenGL). Vertices are uploaded as float32
+    # Loading does not need OpenGL, VBOs are created on first draw
+    VBO_ATTRIBUTES = {'vertices': ('VBOPoints', 'Vertex'), 'Colors': ('VBOColors', 'Color'), 'Indices': ('VBOIndices', 'Index')}
+
+    def __init__(self, path, isNormalize=False, isOverrideVertexColors=False, isVerbose=True, isCache=True, isIndexed=False, ColorType=np.float32):
         self.isVBOBound = False
+        self.DirtyRanges = {}
+        self.ColorType = ColorType
+        self.isIndexed = isIndexed
+        self.Indices = None
 
-        vertices = []
-        normals = []
-        texcoords = []
-        faces = []
-        vertcolors = []
-        for line in open(path, "r"):
-            if line.startswith('#'):
-                continue
-            values = line.split()
-            if not values:
-                continue
-            if values[0] == 'v':
-                vertices.append(tuple(map(float, values[1:4])))
-                if len(values) == 7: # read vertex colors where available in values[4:7]
-                    ColVal = np.array(list(map(float, values[4:7])))
-                    if np.linalg.norm(ColVal) > 1.74: # Check if between 0-1 or 0-255
-                        ColVal /= 255
-                        vertcolors.append((ColVal[0], ColVal[1], ColVal[2]))
-                    else:
-                        vertcolors.append(tuple(map(float, values[4:7])))
-            elif values[0] == 'vn':
-                normals.append(tuple(map(float, values[1:4])))
-            elif values[0] == 'vt':
-                texcoords.append(tuple(map(float, values[1:3])))
-            elif values[0] == 'f':
-                face = []
-                for v in values[1:]:
-                    w = map(lambda x: int(x) if x else None, v.split('/'))
-                    w = map(lambda x: x-1 if x != None and x > 0 else x, w)
-                    face.append(tuple(w))
-                faces.append(tuple(face))
+        Data = loadOBJ(path, isCache=isCache, isVerbose=isVerbose)
 
         # Final data
-        self.vertices = vertices
-        self.normals = normals
-        self.texcoords = texcoords
-        self.faces = faces
-        self.vertcolors = vertcolors
+        # faces is an nTriangles x 3 x 3 array of 0-based (vertex, texcoord, normal) indices, -1 if missing
+        self.vertices = Data['Vertices']
+        self.normals = Data['Normals']
+        self.texcoords = Data['TexCoords']
+        self.faces = Data['Faces']
+        self.vertcolors = Data['VertexColors']
         self.Colors = None
         if len(self.vertcolors) > 0:  # Prefer vertex colors if available
             # print('[ INFO ]: Rendering using available vertex colors.')
-            self.Colors = np.asarray(self.vertcolors)
+            self.Colors = self.vertcolors
 
-        if len(self.faces) > 0:
-            # TODO: This is extremely inefficient
-            self.triangle_vertices = []
-            self.triangle_vertices_colors = []
-            for Face in self.faces:
-                self.triangle_vertices.append((self.vertices[Face[0][0]]))
-                self.triangle_vertices.append((self.vertices[Face[1][0]]))
-                self.triangle_vertices.append((self.vertices[Face[2][0]]))
-                if len(self.vertcolors) > 0:
-                    self.triangle_vertices_colors.append((self.vertcolors[Face[0][0]]))
-                    self.triangle_vertices_colors.append((self.vertcolors[Face[1][0]]))
-                    self.triangle_vertices_colors.append((self.vertcolors[Face[2][0]]))
+        if len(self.faces) > 0 and self.isIndexed:
+            self.Indices = self.faces[:, :, 0].astype(np.int32).reshape((-1, 1)) # Each element is an index
+            if len(self.vertcolors) > 0: # Prefer vertex colors if available
+                print('[ INFO ]: Rendering using available vertex colors.')
+        elif len(self.faces) > 0:
+            # Expand to a triangle soup
+            VertexIdx = self.faces[:, :, 0].reshape(-1)
+            self.triangle_vertices = self.vertices[VertexIdx]
+            self.triangle_vertices_colors = self.vertcolors[VertexIdx] if len(self.vertcolors) > 0 else np.zeros([0, 3])
 
             self.vertices = self.triangle_vertices
             self.vertcolors = self.triangle_vertices_colors
             if len(self.vertcolors) > 0: # Prefer vertex colors if available
                 print('[ INFO ]: Rendering using available vertex colors.')
-                self.Colors = np.asarray(self.vertcolors)
+                self.Colors = self.vertcolors
 
         # TODO: Do the normals need to be recomputed?
-        if isNormalize is True:
+        if isNormalize is True and len(self.vertices) > 0:
             # Normalize model vertices to lie within the NOCS
             VerticesNP = np.asarray(self.vertices)
-            # Compute extents
-            XYZMin = np.min(VerticesNP, axis=0)
-            XYZMax = np.max(VerticesNP, axis=0)
+            # Compute extents (of the vertices used by faces, same as for the triangle soup)
+            UsedNP = VerticesNP if self.Indices is None else VerticesNP[np.unique(self.Indices)]
+            XYZMin = np.min(UsedNP, axis=0)
+            XYZMax = np.max(UsedNP, axis=0)
             DiagonalLength = np.linalg.norm(XYZMax - XYZMin)  # Get diagonal length
             self.vertices = (VerticesNP / DiagonalLength) + 0.5  # Normalize. Similar to ShapeNet normalization
             print('[ INFO ]: Normalization factor (diagonal length) =', DiagonalLength)
         if isOverrideVertexColors or len(self.vertcolors) <= 0 or self.Colors is None:
             self.Colors = np.asarray(self.vertices)
+        self.vertices = np.asarray(self.vertices, dtype=np.float32)
+        self.Colors = np.asarray(self.Colors, dtype=np.float32)
 
         # self.Colors = VerticesNP / DiagonalLength # Normalize. Similar to ShapeNet normalization
 
         if isVerbose:
             print('[ INFO ]: Loaded', path, '\n\t\twith vertices/faces/normals:',
                   len(self.vertices), '/', len(self.faces), '/', len(self.normals))
+            if self.Indices is not None:
+                # Points (float32) and colors (ColorType) per vertex, indices are 32-bit
+                VertexBytes = 3 * 4 + 3 * np.dtype(self.ColorType).itemsize
+                SoupBytes = self.Indices.shape[0] * VertexBytes
+                IndexedBytes = len(self.vertices) * VertexBytes + self.Indices.nbytes
+                print('[ INFO ]: Indexed mesh uses {:.2f} MB of vertex data instead of {:.2f} MB (saved {:.2f} MB).'.format(IndexedBytes / 2**20, SoupBytes / 2**20, (SoupBytes - IndexedBytes) / 2**20))
 
         self.update()
 
     def __del__(self):
         if self.isVBOBound:
-            self.VBOPoints.delete()
-            self.VBOColors.delete()
+            self.deleteVBOs()
 
     def update(self):
+        # VBOs are re-created from the current arrays on the next draw
         self.nPoints = len(self.vertices)
-        if self.nPoints == 0:
-            return
+        for Name in self.VBO_ATTRIBUTES:
+            if getattr(self, Name) is not None:
+                self.DirtyRanges[Name] = (0, len(getattr(self, Name)))
 
-        self.nPoints = len(self.vertices)
-        # Create VBO
-        self.VBOPoints = glvbo.VBO(np.asarray(self.vertices))
-        self.VBOColors = glvbo.VBO(np.asarray(self.Colors))
-        self.isVBOBound = True
+    def upload(self):
+        if self.nPoints == 0:
+            return False
+        return super().upload()
 
     def draw(self, PointSize=10.0, isWireFrame=False):
-        if self.isVBOBound == False:
-            print('[ WARN ]: VBOs not bound. Call update().')
+        if not self.upload():
+            print('[ WARN ]: Nothing to draw, model is empty.')
             return
 
         gl.glPushAttrib(gl.GL_POINT_BIT)
@@ -116,17 +259,22 @@ class Loader(object):
         if self.VBOPoints is not None:
             self.VBOPoints.bind()
             gl.glEnableClientState(gl.GL_VERTEX_ARRAY)
-            gl.glVertexPointer(3, gl.GL_DOUBLE, 0, self.VBOPoints)
+            gl.glVertexPointer(3, gl.GL_FLOAT, 0, self.VBOPoints)
 
         if self.VBOColors is not None:
             self.VBOColors.bind()
             gl.glEnableClientState(gl.GL_COLOR_ARRAY)
-            gl.glColorPointer(3, gl.GL_DOUBLE, 0, self.VBOColors)
+            gl.glColorPointer(3, drawing.getGLType(self.ColorType), 0, self.VBOColors)
 
         if len(self.faces) > 0:
             if isWireFrame:
                 gl.glPolygonMode(gl.GL_FRONT_AND_BACK, gl.GL_LINE)
-            gl.glDrawArrays(gl.GL_TRIANGLES, 0, self.nPoints)
+            if self.Indices is not None:
+                self.VBOIndices.bind()
+                gl.glDrawElements(gl.GL_TRIANGLES, int(len(self.Indices)), gl.GL_UNSIGNED_INT, None)
+                self.VBOIndices.unbind()
+            else:
+                gl.glDrawArrays(gl.GL_TRIANGLES, 0, self.nPoints)
         else:
             gl.glDrawArrays(gl.GL_POINTS, 0, self.nPoints)
 
@@ -1,110 +1,119 @@
 import cv2
 import numpy as np
-import datastructures as ds
-import math
+from tk3dv.nocstools import datastructures as ds
+from tk3dv.extern.quaternions import rotation_matrix
 import random
 
-def rotation_matrix(axis, theta):
-    """
-    Return the rotation matrix associated with counterclockwise rotation about
-    the given axis by theta radians.
-    """
-    axis = np.asarray(axis)
-    axis = axis/math.sqrt(np.dot(axis, axis))
-    a = math.cos(theta/2.0)
-    b, c, d = -axis*math.sin(theta/2.0)
-    aa, bb, cc, dd = a*a, b*b, c*c, d*d
-    bc, ad, ac, ab, bd, cd = b*c, a*d, a*c, a*b, b*d, c*d
-    return np.array([[aa+bb-cc-dd, 2*(bc+ad), 2*(bd-ac)],
-                     [2*(bc-ad), aa+cc-bb-dd, 2*(cd+ab)],
-                     [2*(bd+ac), 2*(cd-ab), aa+dd-bb-cc]])
+def getInstancePixels(LabelImage, Background=255):
+    # Groups the pixels of a label image by label in one pass
+    # Returns the sorted label IDs and, for each ID, its 1D (row-major) pixel indices
+    Labels = LabelImage.reshape(-1)
+    Pix = np.flatnonzero(Labels != Background)
+    if Pix.shape[0] == 0:
+        return [], []
+    Pix = Pix[np.argsort(Labels[Pix], kind='stable')]
+    IDs, Counts = np.unique(Labels[Pix], return_counts=True)
+    return IDs.tolist(), np.split(Pix, np.cumsum(Counts)[:-1])
+
+def getOverlappingInstancePixels(Masks):
+    # Masks is H x W x K with one (possibly overlapping) mask per instance
+    # Returns, for each instance, its 1D (row-major) pixel indices
+    nInstances = Masks.shape[2]
+    if nInstances == 0:
+        return []
+    Rows, Cols, Inst = np.nonzero(Masks)
+    Order = np.argsort(Inst, kind='stable')
+    Pix = (Rows * Masks.shape[1] + Cols)[Order]
+    Counts = np.bincount(Inst, minlength=nInstances)
+    return np.split(Pix, np.cumsum(Counts)[:-1])
 
 class PoseRCNNInput():
     def __init__(self, ColorImage, CoordImage, DepthImage, MaskImage, Intrinsics):
         self.ColorImage, self.CoordImage, self.DepthImage, self.MaskImage = ColorImage, CoordImage, DepthImage, MaskImage
         self.Intrinsics = Intrinsics
 
+        self.NOCs = []
+        self.Metrics = []
+        self.InstancePixels = []
+        self.DepthValid = []
+
         # Get some stats and pre-process
-        if len(self.MaskImage.shape) is not 3:
+        if len(self.MaskImage.shape) != 3:
             print('[ WARN ]: Mask should be 3 channels. Please check input.')
             return
 
         # The red channel (3) contains mask information
         MaskChannel = self.MaskImage[:, :, 2]
-        self.MaskIDs = np.unique(MaskChannel).tolist()
-        if 255 in self.MaskIDs: # Background value
-            self.MaskIDs.remove(255)
+        self.MaskIDs, self.InstancePixels = getInstancePixels(MaskChannel, Background=255)
 
         print(self.MaskIDs)
 
-        self.RGBs = []
-        self.NOCImages = []
-        self.DepthImages = []
-        self.Masks = []
-
-        self.NOCs = []
-        self.Metrics = []
-
-        for ID in self.MaskIDs:
-            IDMask = np.uint8(MaskChannel == ID)
-            self.RGBs.append(cv2.bitwise_and(self.ColorImage, self.ColorImage, mask=IDMask))
-            self.NOCImages.append(cv2.bitwise_and(self.CoordImage, self.CoordImage, mask=IDMask))
-            self.DepthImages.append(cv2.bitwise_and(self.DepthImage, self.DepthImage, mask=IDMask))
-            self.Masks.append(IDMask * 255)
-
         # FOR TESTING PURPOSES ONLY
         DEBUG = False
 
+        self.DepthImage16 = ds.DepthImage.decode(self.DepthImage)
+        Coords = self.CoordImage.reshape(-1, 3)
         for Idx in range(0, len(self.MaskIDs)):
-            if DEBUG:
-                # Random: DEBUG
-                RandRotMat = rotation_matrix(np.array([1, 0, 0]), np.random.uniform(0, 359, 1))
-                RandRotMat = RandRotMat @ rotation_matrix(np.array([0, 1, 0]), np.random.uniform(0, 359, 1))
-                RandRotMat = RandRotMat @ rotation_matrix(np.array([0, 0, 1]), np.random.uniform(0, 359, 1))
-
-                RandScale = np.array([1, 1, 1]) * 17  # np.random.uniform(8, 16, 3)
-                RandTrans = np.random.uniform(-70, 70, 3)
-                RandOutliers = 0.1
-
-            NOC = ds.PointSet3D()
-            NOCIm = self.NOCImages[Idx]
-            DepIm = self.DepthImages[Idx]
+            Pix = self.InstancePixels[Idx]
+            Val = Coords[Pix] / 255
+            # Flip x and z (due to OpenCV) and also left/right handed coordinate systems (due to rendernigs)
+            NOCPoints = np.stack([1 - Val[:, 2], Val[:, 1], Val[:, 0]], axis=1)
             if DEBUG == False:
-                Metric = ds.DepthImage(DepIm, self.Intrinsics.Matrix)
-            else:
-                Metric = ds.PointSet3D() # DEBUG
-            ColIm = self.RGBs[Idx]
-            IDMask = self.Masks[Idx]
-            MaskIdx = np.where((IDMask >= 255))
-            RGBColors = np.zeros([0, 3])
-
-            for i in range(0, MaskIdx[0].shape[0]):
-                Val = NOCIm[MaskIdx[0][i], MaskIdx[1][i], :] / 255
-                Col = ColIm[MaskIdx[0][i], MaskIdx[1][i], :] / 255
-                NOC.add(1 - Val[2], Val[1], Val[0], 1 - Val[2], Val[1], Val[0]) # Flip x and z (due to OpenCV) and also left/right handed coordinate systems (due to rendernigs)
-                RGBColors = np.vstack([RGBColors, np.array([Col[2], Col[1], Col[0]])])
-                if DEBUG:
-                    # DEBUG
-                    Val = np.dot(RandRotMat, Val)
-                    Val = np.multiply(Val, RandScale)
-                    Val = np.add(Val, RandTrans)
-                    if random.uniform(0.0, 1.0) > (1-RandOutliers): # % outliers
-                        Val = Val + np.random.uniform(-500, 500 , 3)
-                        # if random.uniform(0.0, 1.0) > 0.5:
-                        #     Val[0] = 0
-                        # if random.uniform(0.0, 1.0) > 0.5:
-                        #     Val[1] = 0
-                        # if random.uniform(0.0, 1.0) > 0.5:
-                        #     Val[2] = 0
-                    Metric.add(Val[0], Val[1], Val[2])
-
-            Metric.Colors = RGBColors
-            Metric.update()
-            NOC.update()
-
-            print('[ INFO ]: Mask', Idx, 'contains', NOC.Points.shape, 'points.')
-            self.NOCs.append(NOC)
-            self.Metrics.append(Metric)
+                self.addInstance(Pix, NOCPoints)
+                continue
+
+            # Random: DEBUG
+            Rx, Ry, Rz = rotation_matrix(np.eye(3), np.random.uniform(0, 359, 3))
+            RandRotMat = Rx @ Ry @ Rz
+
+            RandScale = np.array([1, 1, 1]) * 17  # np.random.uniform(8, 16, 3)
+            RandTrans = np.random.uniform(-70, 70, 3)
+            RandOutliers = 0.1
+
+            Val = (Val @ RandRotMat.T) * RandScale + RandTrans
+            isOutlier = np.random.uniform(0.0, 1.0, Val.shape[0]) > (1-RandOutliers) # % outliers
+            Val[isOutlier] += np.random.uniform(-500, 500, (np.count_nonzero(isOutlier), 3))
+            Metric = ds.PointSet3D()
+            Metric.addAll(Val, self.getColors(Pix))
+            self.addInstance(Pix, NOCPoints, Metric)
+
+    def getColors(self, Pix):
+        # BGR to RGB, scaled to 0-1
+        return self.ColorImage.reshape(-1, 3)[Pix][:, ::-1] / 255
+
+    def addInstance(self, Pix, NOCPoints, Metric=None):
+        NOC = ds.PointSet3D()
+        NOC.addAll(NOCPoints, NOCPoints)
+        Colors = self.getColors(Pix)
+        if Metric is None and self.DepthImage16 is None:
+            print('[ WARN ]: Unsupported depth type, skipping metric points.')
+            Metric = ds.PointSet3D()
+            Valid = np.zeros(Pix.shape[0], dtype=bool)
+        elif Metric is None:
+            # Only pixels with valid depth are backprojected, DepthValid maps them back to the NOC points
+            Valid = self.DepthImage16.reshape(-1)[Pix] > 0
+            Metric = ds.DepthImage(self.DepthImage16, self.Intrinsics.Matrix, PixelIdx=Pix)
+            Metric.Colors = Colors[Valid]
+        else:
+            Valid = np.ones(Pix.shape[0], dtype=bool)
+        Metric.update()
+        NOC.update()
+
+        print('[ INFO ]: Mask', len(self.NOCs), 'contains', NOC.Points.shape, 'points.')
+        self.NOCs.append(NOC)
+        self.Metrics.append(Metric)
+        self.DepthValid.append(Valid)
+
+    def getInstanceMask(self, Idx):
+        Mask = np.zeros(self.ColorImage.shape[:2], dtype=np.uint8)
+        Mask.reshape(-1)[self.InstancePixels[Idx]] = 255
+        return Mask
+
+    def getInstanceImages(self, Idx):
+        # Returns the color, NOC, and depth images masked to instance Idx, and the mask itself
+        Mask = self.getInstanceMask(Idx)
+        return cv2.bitwise_and(self.ColorImage, self.ColorImage, mask=Mask), cv2.bitwise_and(self.CoordImage, self.CoordImage, mask=Mask), \
+               cv2.bitwise_and(self.DepthImage, self.DepthImage, mask=Mask), Mask
 
     def __del__(self):
         for noc in self.NOCs:
@@ -120,14 +129,11 @@ class PoseRCNNInputOverlapping(PoseRCNNInput):
         self.Data = DetectionData
         self.Intrinsics = Intrinsics
 
-        self.RGBs = []
-        self.NOCImages = []
-        self.DepthImages = []
-        self.Masks = []
-
         self.NOCs = []
         self.Metrics = []
         self.MaskIDs = []
+        self.InstancePixels = []
+        self.DepthValid = []
 
         # Get some stats and pre-process
         self.AllROIs = self.Data['rois']
@@ -151,39 +157,16 @@ class PoseRCNNInputOverlapping(PoseRCNNInput):
 
         print(self.MaskIDs)
 
+        self.DepthImage16 = ds.DepthImage.decode(self.DepthImage)
+        self.InstancePixels = getOverlappingInstancePixels(self.AllMasks[:, :, :len(self.MaskIDs)])
+        Coords = self.AllCoords.reshape(-1, self.AllCoords.shape[2], 3)
         for Idx in range(0, len(self.MaskIDs)):
-            IDMask = self.AllMasks[:, :, Idx]
-            self.RGBs.append(cv2.bitwise_and(self.ColorImage, self.ColorImage, mask=IDMask))
-            self.NOCImages.append(cv2.bitwise_and(self.AllCoords[:, :, Idx, :], self.AllCoords[:, :, Idx, :], mask=IDMask) * 255) # Scale 0-1 to 0-255
-            self.DepthImages.append(cv2.bitwise_and(self.DepthImage, self.DepthImage, mask=IDMask))
-            self.Masks.append(IDMask * 255)
-
-        for Idx in range(0, len(self.MaskIDs)):
-            NOC = ds.PointSet3D()
-            NOCIm = self.NOCImages[Idx]
-            DepIm = self.DepthImages[Idx]
-            Metric = ds.DepthImage(DepIm, self.Intrinsics.Matrix, mask=self.Masks[Idx])
-            ColIm = self.RGBs[Idx]
-            IDMask = self.Masks[Idx]
-            MaskIdx = np.where((IDMask >= 255))
-            RGBColors = np.zeros([0, 3])
-
-            for i in range(0, MaskIdx[0].shape[0]):
-                Val = NOCIm[MaskIdx[0][i], MaskIdx[1][i], :] / 255
-                Col = ColIm[MaskIdx[0][i], MaskIdx[1][i], :] / 255
-                NOC.add(Val[0], Val[1], Val[2], Val[0], Val[1], Val[2])
-                RGBColors = np.vstack([RGBColors, np.array([Col[2], Col[1], Col[0]])])
-
-            Metric.Colors = RGBColors
-            Metric.update()
-            NOC.update()
-
-            print('[ INFO ]: Mask', Idx, 'contains', NOC.Points.shape, 'points.')
-            self.NOCs.append(NOC)
-            self.Metrics.append(Metric)
-
-    def __del__(self):
-        for noc in self.NOCs:
-            noc.__del__()
-        for metric in self.Metrics:
-            metric.__del__()
\ No newline at end of file
+            Pix = self.InstancePixels[Idx]
+            NOCPoints = Coords[Pix, Idx].astype(np.float64)
+            self.addInstance(Pix, NOCPoints)
+
+    def getInstanceImages(self, Idx):
+        Mask = self.getInstanceMask(Idx)
+        NOCImage = cv2.bitwise_and(self.AllCoords[:, :, Idx, :], self.AllCoords[:, :, Idx, :], mask=Mask) * 255 # Scale 0-1 to 0-255
+        return cv2.bitwise_and(self.ColorImage, self.ColorImage, mask=Mask), NOCImage, \
+               cv2.bitwise_and(self.DepthImage, self.DepthImage, mask=Mask), Mask
@@ -0,0 +1,136 @@
+import numpy as np
+import collections
+import concurrent.futures as cf
+
+from tk3dv.nocstools import datastructures as ds, parsing, aligning
+from tk3dv.common import utilities
+
+# Frame-level pose estimation for detection outputs (see PoseRCNNInputOverlapping for the input format)
+# NOCS/metric correspondences are extracted per frame and the per-instance similarity alignments are run on a worker pool
+
+STAGES = ['Extract', 'Align', 'Wait', 'Frame']
+
+def extractInstances(DepthImage, Detections, Intrinsics, MaxPoints=None, Seed=None):
+    # Returns a list of (ClassID, NOCPoints, MetricPoints) with one entry per detected instance
+    # Only pixels with valid depth are kept so that NOCPoints[i] corresponds to MetricPoints[i]
+    # With MaxPoints, instances with more correspondences are randomly subsampled
+    Depth16 = ds.DepthImage.decode(DepthImage)
+    if Depth16 is None:
+        raise RuntimeError('[ ERR ]: Unsupported depth type.')
+    K = Intrinsics.Matrix if hasattr(Intrinsics, 'Matrix') else Intrinsics
+    Masks, Coords, ClassIDs = Detections['masks'], Detections['coords'], Detections['class_ids']
+    if Masks.shape[:2] != Depth16.shape:
+        raise RuntimeError('[ ERR ]: Mask shape {} does not match depth shape {}.'.format(Masks.shape, Depth16.shape))
+
+    Backprojector = utilities.getBackprojector(K, Depth16.shape)
+    Depth = Depth16.reshape(-1)
+    Coords = Coords.reshape(-1, Coords.shape[2], 3)
+    Rng = np.random.RandomState(Seed)
+
+    Instances = []
+    for Idx, Pix in enumerate(parsing.getOverlappingInstancePixels(Masks)):
+        z = Depth[Pix]
+        Pix = Pix[z > 0]
+        if MaxPoints is not None and Pix.shape[0] > MaxPoints:
+            Pix = np.sort(Rng.choice(Pix, MaxPoints, replace=False))
+        NOCPoints = Coords[Pix, Idx].astype(np.float64)
+        MetricPoints = Backprojector.backprojectPixels(Pix, Depth[Pix])
+        Instances.append((ClassIDs[Idx], NOCPoints, MetricPoints))
+
+    return Instances
+
+def estimateInstancePose(NOCPoints, MetricPoints, AlignArgs):
+    # Runs in a worker. Returns (Scales, Rotation, Translation, OutTransform, Stats) with None if alignment failed
+    if NOCPoints.shape[0] < 5:
+        return None, None, None, None, {'InlierRatio': 0, 'TotalTime': 0.0}
+    return aligning.estimateSimilarityTransform(NOCPoints, MetricPoints, isReturnStats=True, **AlignArgs)
+
+class PosePipeline():
+    # Estimates per-instance similarity transforms (NOCS to camera space) for streams of RGB-D frames with detections
+    # At most MaxPendingFrames frames are in flight at a time, so memory stays bounded for long sequences
+    # isProcessPool: use processes instead of threads for alignment (RANSAC is mostly Python and holds the GIL)
+    def __init__(self, nWorkers=None, isProcessPool=True, MaxPendingFrames=2, MaxPoints=None, Seed=None
+                 , isAdaptive=True, Confidence=0.99, MaxIterations=1000, nPreemptivePoints=0):
+        self.nWorkers = nWorkers
+        self.isProcessPool = isProcessPool
+        self.MaxPendingFrames = max(1, MaxPendingFrames)
+        self.MaxPoints = MaxPoints
+        self.Seed = Seed
+        self.AlignArgs = {'isAdaptive': isAdaptive, 'isBatched': True, 'Confidence': Confidence
+                          , 'MaxIterations': MaxIterations, 'nPreemptivePoints': nPreemptivePoints}
+        self.Pool = None
+        self.nFrames = 0
+        self.nInstances = 0
+        self.Timings = dict.fromkeys(STAGES, 0.0)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *Args):
+        self.stop()
+
+    def start(self):
+        if self.Pool is None:
+            Executor = cf.ProcessPoolExecutor if self.isProcessPool else cf.ThreadPoolExecutor
+            self.Pool = Executor(max_workers=self.nWorkers)
+
+    def stop(self):
+        if self.Pool is not None:
+            self.Pool.shutdown()
+            self.Pool = None
+
+    def submitFrame(self, ColorImage, DepthImage, Detections, Intrinsics):
+        self.start()
+        Tic = utilities.getCurrentEpochTime()
+        if ColorImage is not None and ColorImage.shape[:2] != DepthImage.shape[:2]:
+            raise RuntimeError('[ ERR ]: Color shape {} does not match depth shape {}.'.format(ColorImage.shape, DepthImage.shape))
+        FrameSeed = None if self.Seed is None else self.Seed + self.nFrames
+        Instances = extractInstances(DepthImage, Detections, Intrinsics, MaxPoints=self.MaxPoints, Seed=FrameSeed)
+        Futures = []
+        for Idx, (ClassID, NOCPoints, MetricPoints) in enumerate(Instances):
+            AlignArgs = dict(self.AlignArgs, Seed=None if FrameSeed is None else FrameSeed * 1000 + Idx)
+            Futures.append((ClassID, NOCPoints.shape[0], self.Pool.submit(estimateInstancePose, NOCPoints, MetricPoints, AlignArgs)))
+        self.Timings['Extract'] += (utilities.getCurrentEpochTime() - Tic) * 1e-3
+        self.nFrames += 1
+        return Tic, Futures
+
+    def collectFrame(self, Pending):
+        Tic, Futures = Pending
+        WaitTic = utilities.getCurrentEpochTime()
+        Results = []
+        for ClassID, nPoints, Future in Futures:
+            Scales, Rotation, Translation, OutTransform, Stats = Future.result()
+            self.Timings['Align'] += Stats['TotalTime']
+            Results.append({'ClassID': ClassID, 'Scales': Scales, 'Rotation': Rotation, 'Translation': Translation
+                            , 'OutTransform': OutTransform, 'nPoints': nPoints, 'Stats': Stats})
+        Toc = utilities.getCurrentEpochTime()
+        self.Timings['Wait'] += (Toc - WaitTic) * 1e-3
+        self.Timings['Frame'] += (Toc - Tic) * 1e-3
+        self.nInstances += len(Results)
+        return Results
+
+    def processFrame(self, ColorImage, DepthImage, Detections, Intrinsics):
+        # Returns a list with one dictionary per instance (ClassID, Scales, Rotation, Translation, OutTransform, nPoints, Stats)
+        return self.collectFrame(self.submitFrame(ColorImage, DepthImage, Detections, Intrinsics))
+
+    def processSequence(self, Frames):
+        # Frames is an iterable of (ColorImage, DepthImage, Detections, Intrinsics), results are yielded in order
+        # The next frame is extracted while earlier frames are still being aligned
+        Pending = collections.deque()
+        for Frame in Frames:
+            Pending.append(self.submitFrame(*Frame))
+            if len(Pending) >= self.MaxPendingFrames:
+                yield self.collectFrame(Pending.popleft())
+        while len(Pending) > 0:
+            yield self.collectFrame(Pending.popleft())
+
+    def printTimings(self):
+        # Align is summed over workers, so it can exceed the wall clock time when running in parallel
+        nFrames = max(1, self.nFrames)
+        print('[ INFO ]: Processed {} frames with {} instances.'.format(self.nFrames, self.nInstances))
+        for Stage in STAGES:
+            print('[ INFO ]: {:8s} {:10.2f} ms total, {:8.2f} ms per frame'.format(Stage, self.Timings[Stage], self.Timings[Stage] / nFrames))
+
+    def __del__(self):
+        self.stop()
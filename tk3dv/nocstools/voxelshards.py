@@ -0,0 +1,192 @@
+import os, sys, glob, json
+import collections, itertools
+import numpy as np
+import concurrent.futures as cf
+
+from tk3dv.extern.binvox import binvox_rw
+from tk3dv.common import utilities
+
+# Sharded storage of many voxel grids as bit-packed records (see binvox_rw.write_packed)
+# A shard is a file of concatenated records (shard_XXXXX.pvox) with an index (shard_XXXXX.json) listing name, offset, dims, translate,
+# scale and axis order of every grid. The index is written last, so a shard without one is incomplete and gets redone when resuming
+# Grids are named by their path relative to the input directory, without extension
+
+EXTENSIONS = ['.binvox', '.npy', '.npz']
+NPZ_KEY = 'surface_voxel_grid' # Same grid as examples/visualizeVG.py
+SHARD_PREFIX = 'shard_'
+
+def getGridName(FileName, InputDir):
+    return os.path.splitext(os.path.relpath(FileName, InputDir))[0].replace(os.sep, '/')
+
+def findVoxelFiles(InputDir, Extensions=EXTENSIONS):
+    # Returns sorted (Name, FileName) of all voxel files under InputDir
+    Files = []
+    for Root, _, FileNames in os.walk(InputDir):
+        for FileName in FileNames:
+            if os.path.splitext(FileName)[1].lower() in Extensions:
+                FileName = os.path.join(Root, FileName)
+                Files.append((getGridName(FileName, InputDir), FileName))
+    Files.sort()
+    Duplicates = sorted(Name for Name, Count in collections.Counter(Name for Name, _ in Files).items() if Count > 1)
+    if len(Duplicates) > 0:
+        raise RuntimeError('[ ERR ]: Several files map to the same grid name: {}.'.format(', '.join(Duplicates)))
+    return Files
+
+def readPackedVoxels(FileName, NPZKey=NPZ_KEY):
+    # Runs in a worker. Returns a binvox_rw.PackedVoxels, binvox files are packed without building the dense grid
+    Ext = os.path.splitext(FileName)[1].lower()
+    if Ext == '.binvox':
+        with open(FileName, 'rb') as f:
+            return binvox_rw.read_as_packed_array(f)
+    Grid = np.load(FileName)
+    if Ext == '.npz':
+        if NPZKey in Grid.files:
+            Grid = Grid[NPZKey]
+        elif len(Grid.files) == 1:
+            Grid = Grid[Grid.files[0]]
+        else:
+            raise RuntimeError('[ ERR ]: No array {} in {}, found {}.'.format(NPZKey, FileName, Grid.files))
+    if Grid.ndim != 3:
+        raise RuntimeError('[ ERR ]: Expected a 3D voxel grid in {}, got shape {}.'.format(FileName, Grid.shape))
+    # numpy grids have no metadata, dims are chosen so the packed shape is the array shape
+    return binvox_rw.pack(binvox_rw.Voxels(Grid, [Grid.shape[0], Grid.shape[2], Grid.shape[1]], [0.0, 0.0, 0.0], 1.0, 'xyz'))
+
+def packVoxelFile(Name, FileName, NPZKey=NPZ_KEY):
+    # Runs in a worker. Returns (Name, PackedVoxels or None, error message, time in ms)
+    Tic = utilities.getCurrentEpochTime()
+    try:
+        Packed = readPackedVoxels(FileName, NPZKey)
+        Packed.bits = np.ascontiguousarray(Packed.bits)
+        return Name, Packed, None, (utilities.getCurrentEpochTime() - Tic) * 1e-3
+    except Exception as e:
+        return Name, None, str(e), (utilities.getCurrentEpochTime() - Tic) * 1e-3
+
+def getShardPaths(OutputDir, ShardIdx):
+    Prefix = os.path.join(OutputDir, '{}{:05d}'.format(SHARD_PREFIX, ShardIdx))
+    return Prefix + '.pvox', Prefix + '.json'
+
+def loadShardIndices(OutputDir):
+    # Returns {ShardIdx: index entries} of all complete shards
+    Indices = {}
+    for IndexFile in glob.glob(os.path.join(OutputDir, SHARD_PREFIX + '*.json')):
+        ShardIdx = int(os.path.splitext(os.path.basename(IndexFile))[0][len(SHARD_PREFIX):])
+        with open(IndexFile) as f:
+            Indices[ShardIdx] = json.load(f)
+    return Indices
+
+class ShardWriter():
+    # Appends packed grids to numbered shards, each shard is closed after ShardSize grids
+    def __init__(self, OutputDir, ShardSize, ShardIdx=0):
+        self.OutputDir = OutputDir
+        self.ShardSize = ShardSize
+        self.ShardIdx = ShardIdx
+        self.File = None
+        self.Index = []
+        self.Offset = 0
+
+    def add(self, Name, Packed):
+        if self.File is None:
+            self.File = open(getShardPaths(self.OutputDir, self.ShardIdx)[0] + '.tmp', 'wb')
+        self.Index.append({'name': Name, 'offset': self.Offset, 'dims': list(Packed.dims), 'translate': list(Packed.translate)
+                           , 'scale': Packed.scale, 'axis_order': Packed.axis_order})
+        self.Offset += binvox_rw.write_packed(Packed, self.File)
+        if len(self.Index) >= self.ShardSize:
+            self.close()
+
+    def close(self):
+        # Shard first, then its index, so the index only exists for complete shards
+        if self.File is None:
+            return
+        self.File.close()
+        ShardFile, IndexFile = getShardPaths(self.OutputDir, self.ShardIdx)
+        os.replace(ShardFile + '.tmp', ShardFile)
+        with open(IndexFile + '.tmp', 'w') as f:
+            json.dump(self.Index, f)
+        os.replace(IndexFile + '.tmp', IndexFile)
+        self.File, self.Index, self.Offset = None, [], 0
+        self.ShardIdx += 1
+
+def convertVoxels(InputDir, OutputDir, ShardSize=1000, nWorkers=None, NPZKey=NPZ_KEY, isVerbose=True):
+    # Converts all binvox/npy/npz grids under InputDir to shards in OutputDir on a process pool
+    # Grids already in a complete shard are skipped, so an interrupted conversion continues where it stopped
+    # Returns (number of converted grids, names of files that failed)
+    os.makedirs(OutputDir, exist_ok=True)
+    for TempFile in glob.glob(os.path.join(OutputDir, SHARD_PREFIX + '*.tmp')): # Left over from an interrupted run
+        os.remove(TempFile)
+    Indices = loadShardIndices(OutputDir)
+    Done = set(Entry['name'] for Index in Indices.values() for Entry in Index)
+    Files = [(Name, FileName) for Name, FileName in findVoxelFiles(InputDir) if Name not in Done]
+    if isVerbose:
+        print('[ INFO ]: Found {} voxel grids, {} already converted in {} shards.'.format(len(Files) + len(Done), len(Done), len(Indices)))
+
+    Writer = ShardWriter(OutputDir, ShardSize, max(Indices.keys()) + 1 if len(Indices) > 0 else 0)
+    Failed = []
+    nConverted = 0
+    Tic = utilities.getCurrentEpochTime()
+    PackTime = 0.0
+    with cf.ProcessPoolExecutor(max_workers=nWorkers) as Pool:
+        # Only a few grids per worker are in flight, so finished grids are written and freed as the conversion goes
+        nInFlight = 4 * (nWorkers or os.cpu_count() or 1)
+        FileIter = iter(Files)
+        Pending = set()
+        while True:
+            for Name, FileName in itertools.islice(FileIter, nInFlight - len(Pending)):
+                Pending.add(Pool.submit(packVoxelFile, Name, FileName, NPZKey))
+            if len(Pending) == 0:
+                break
+            Finished, Pending = cf.wait(Pending, return_when=cf.FIRST_COMPLETED)
+            for Future in Finished:
+                Name, Packed, Error, Time = Future.result()
+                PackTime += Time
+                if Packed is None:
+                    print('[ WARN ]: Unable to convert {}: {}'.format(Name, Error))
+                    Failed.append(Name)
+                    continue
+                Writer.add(Name, Packed)
+                nConverted += 1
+                if isVerbose and (nConverted % 100 == 0 or nConverted + len(Failed) == len(Files)):
+                    print('[ INFO ]: Converted {}/{} grids.'.format(nConverted, len(Files)))
+                    sys.stdout.flush()
+    Writer.close()
+
+    if isVerbose:
+        Total = (utilities.getCurrentEpochTime() - Tic) * 1e-3
+        print('[ INFO ]: Converted {} grids in {:.2f} ms ({:.2f} ms packing summed over workers), {} failed.'.format(nConverted, Total, PackTime, len(Failed)))
+    return nConverted, Failed
+
+class VoxelShards():
+    # Random access by name to the grids of a shard directory. Shards are memory-mapped on first use, so a lookup is a dictionary
+    # access and a record header parse, and only the bits that are read get loaded from disk
+    def __init__(self, ShardDir):
+        self.ShardDir = ShardDir
+        self.Entries = {}
+        for ShardIdx, Index in sorted(loadShardIndices(ShardDir).items()):
+            for Entry in Index:
+                self.Entries[Entry['name']] = (ShardIdx, Entry)
+        self.Names = sorted(self.Entries.keys())
+        self.Buffers = {}
+
+    def __len__(self):
+        return len(self.Names)
+
+    def __contains__(self, Name):
+        return Name in self.Entries
+
+    def __getitem__(self, Key):
+        # Key is a grid name or an index into self.Names. Returns a binvox_rw.PackedVoxels whose bits are a view into the shard
+        Name = self.Names[Key] if isinstance(Key, (int, np.integer)) else Key
+        if Name not in self.Entries:
+            raise KeyError(Name)
+        ShardIdx, Entry = self.Entries[Name]
+        if ShardIdx not in self.Buffers:
+            self.Buffers[ShardIdx] = np.memmap(getShardPaths(self.ShardDir, ShardIdx)[0], dtype=np.uint8, mode='r')
+        return binvox_rw.read_packed(self.Buffers[ShardIdx], Entry['offset'])
+
+    def __getstate__(self):
+        # Memory maps are reopened after pickling (e.g. in data loader workers) instead of being copied
+        State = self.__dict__.copy()
+        State['Buffers'] = {}
+        return State
+
+    def getEntry(self, Name):
+        return self.Entries[Name][1]
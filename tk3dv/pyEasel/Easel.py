@@ -1,7 +1,7 @@
 import threading
 from time import sleep
 
-import GLViewer as glv
+from tk3dv.pyEasel import GLViewer as glv
 import PyQt5.QtCore as QtCore
 from PyQt5.QtGui import QKeyEvent, QMouseEvent, QWheelEvent
 
@@ -9,7 +9,8 @@ import PyQt5.QtCore as QtCore
 import numpy as np
 import math, tempfile, os
 
-from common import drawing, utilities
+from tk3dv.common import drawing, utilities
+from tk3dv.extern import quaternions
 
 # This class is modeled after the GLViewer class in Easel
 # See https://github.com/drsrinathsridhar/Easel/blob/master/src/gui
@@ -127,25 +128,10 @@ class GLViewer(QOpenGLWidget):
 
         gl.glMatrixMode(gl.GL_MODELVIEW)
 
-    def rotation_matrix(self, axis, theta):
-        """
-        Return the rotation matrix associated with counterclockwise rotation about
-        the given axis by theta radians.
-        """
-        axis = np.asarray(axis)
-        axis = axis / math.sqrt(np.dot(axis, axis))
-        a = math.cos(theta / 2.0)
-        b, c, d = -axis * math.sin(theta / 2.0)
-        aa, bb, cc, dd = a * a, b * b, c * c, d * d
-        bc, ad, ac, ab, bd, cd = b * c, a * d, a * c, a * b, b * d, c * d
-        return np.array([[aa + bb - cc - dd, 2 * (bc + ad), 2 * (bd - ac)],
-                         [2 * (bc - ad), aa + cc - bb - dd, 2 * (cd + ab)],
-                         [2 * (bd + ac), 2 * (cd - ab), aa + dd - bb - cc]])
-
     def makeRotationMatrix(self):
-        Rz = self.rotation_matrix(np.array([0, 0, 1]), self.RollStack[self.activeCamStackIdx])
-        Ry = self.rotation_matrix(Rz.dot(np.array([0, 1, 0])), self.YawStack[self.activeCamStackIdx])
-        Rx = self.rotation_matrix(Ry.dot(np.array([1, 0, 0])), self.PitchStack[self.activeCamStackIdx])
+        Rz = quaternions.rotation_matrix(np.array([0, 0, 1]), self.RollStack[self.activeCamStackIdx])
+        Ry = quaternions.rotation_matrix(Rz.dot(np.array([0, 1, 0])), self.YawStack[self.activeCamStackIdx])
+        Rx = quaternions.rotation_matrix(Ry.dot(np.array([1, 0, 0])), self.PitchStack[self.activeCamStackIdx])
         RotationMatrix = Rx @ Ry @ Rz
 
         return RotationMatrix
@@ -1,9 +1,9 @@
-from EaselModule import EaselModule
+from tk3dv.pyEasel.EaselModule import EaselModule
 from PyQt5.QtGui import QKeyEvent, QMouseEvent, QWheelEvent
 import threading
 from time import sleep
 from tk3dv.common import utilities
-import GLViewer as glv
+from tk3dv.pyEasel import GLViewer as glv
 import PyQt5.QtCore as QtCore
 
 class TestModule(EaselModule, argv=None):
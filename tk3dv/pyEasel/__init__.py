@@ -1,8 +1,13 @@
 # pyEasel written by Srinath Sridhar (http://srinathsridhar.com)
-import sys, os
-FileDirPath = os.path.dirname(__file__)
-sys.path.append(os.path.join(FileDirPath, '.'))
+import importlib
+from .defines import __version__
 
-import defines, Easel, EaselModule, GLViewer, pyEasel
+__all__ = ['defines', 'Easel', 'EaselModule', 'GLViewer', 'pyEasel']
 
-__version__= defines.__version__
+def __getattr__(Name):
+    if Name in __all__:
+        return importlib.import_module('.' + Name, __name__)
+    raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, Name))
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
@@ -1,8 +1,6 @@
 import sys
-sys.path.append('./')
 from PyQt5.QtWidgets import QApplication
-import GLViewer as glv
-import EaselModule
+from tk3dv.pyEasel import GLViewer as glv, EaselModule
 
 from PyQt5.QtWidgets import QMainWindow
 class Easel(QMainWindow):